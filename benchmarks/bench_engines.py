@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Compare the threads and asyncio engines by installing and then updating
+an increasing number of extensions served by the local stub server.
+
+    python benchmarks/bench_engines.py [--counts 100 1000 5000] [--jobs 64]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import configparser
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+from stub_server import StubServer  # noqa: E402
+from conftest import make_ext_id  # noqa: E402
+from maninex import maninex  # noqa: E402
+
+
+def make_configs(base_dir, ext_ids, update_url):
+    json_dir = os.path.join(base_dir, 'json')
+    ext_dir = os.path.join(base_dir, 'ext')
+    os.mkdir(json_dir)
+    os.mkdir(ext_dir)
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.optionxform = lambda option: option
+    config['settings'] = {'update_url': update_url}
+    config['extensions'] = {}
+    for ext_id in ext_ids:
+        config['extensions'][ext_id] = None
+    return maninex.Configs(ext_dir=ext_dir, json_dir=json_dir, config=config,
+                           config_file=os.path.join(base_dir, 'maninex.conf'))
+
+
+def run(function, config_struct, jobs):
+    start = time.perf_counter()
+    results = list(function(config_struct, jobs))
+    elapsed = time.perf_counter() - start
+    failed = sum(result.status == 'failed' for result in results)
+    return elapsed, failed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--counts', type=int, nargs='+',
+                        default=[100, 1000, 5000])
+    parser.add_argument('--jobs', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds the stub server waits per request')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='size of every CRX file in bytes')
+    args = parser.parse_args()
+
+    print('{:>6} {:>8} {:>10} {:>10} {:>7}'.format(
+        'exts', 'engine', 'install', 'update', 'failed'))
+    for count in args.counts:
+        ext_ids = [make_ext_id(n) for n in range(count)]
+        for engine in ('threads', 'asyncio'):
+            server = StubServer({ext_id: '1.0' for ext_id in ext_ids},
+                                crx_size=args.size,
+                                latency=args.latency).start()
+            base_dir = tempfile.mkdtemp(prefix='maninex_bench_')
+            try:
+                config_struct = make_configs(base_dir, ext_ids,
+                                             server.update_url)
+                install, update = maninex.get_engine(engine)
+                install_time, install_failed = run(install, config_struct,
+                                                   args.jobs)
+                # make every tenth extension outdated
+                for ext_id in ext_ids[::10]:
+                    server.extensions[ext_id] = '1.1'
+                update_time, update_failed = run(update, config_struct,
+                                                 args.jobs)
+            finally:
+                server.stop()
+                shutil.rmtree(base_dir)
+            print('{:>6} {:>8} {:>9.2f}s {:>9.2f}s {:>7}'.format(
+                count, engine, install_time, update_time,
+                install_failed + update_failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Measure how long reading the manifest of an extension file takes as the
+file grows.
+
+    python benchmarks/bench_manifest.py [--sizes 1 10 50] [--runs 50]
+
+For every size (in MB), the script writes a CRX3 file with incompressible
+content, once with manifest.json at the start of the archive and once at its
+end, and times maninex.read_crx_manifest on it. For comparison, it also
+times reading the whole file, which is what any approach that loads the
+archive would cost at least. The minor page faults show how many pages of
+the memory-mapped file were actually touched. Files are read from the page
+cache, so the times are for warm caches; on a cold cache, the difference
+only grows.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import resource
+import tempfile
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+from stub_server import make_crx_header  # noqa: E402
+from conftest import make_ext_id  # noqa: E402
+from maninex import maninex  # noqa: E402
+
+
+def write_crx(path, size, manifest_first):
+    """Write a CRX3 file of about size bytes to path."""
+    ext_id = make_ext_id(0)
+    manifest = json.dumps({'name': 'Large Extension', 'version': '1.2.3',
+                           'manifest_version': 2})
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+        if manifest_first:
+            zip_file.writestr('manifest.json', manifest)
+        # many entries make the central directory realistically large
+        part_size = 256 * 1024
+        for number in range(max(size // part_size, 1)):
+            zip_file.writestr('assets/{}.bin'.format(number),
+                              os.urandom(part_size))
+        if not manifest_first:
+            zip_file.writestr('manifest.json', manifest)
+    header = make_crx_header(ext_id)
+    with open(path, 'wb') as crx_file:
+        crx_file.write(b'Cr24' + (3).to_bytes(4, 'little') +
+                       len(header).to_bytes(4, 'little') + header)
+        crx_file.write(archive.getvalue())
+
+
+def measure(function, runs):
+    """Return the median time of calling function runs times and the
+    average number of minor page faults per call."""
+    times = []
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+    return sorted(times)[len(times) // 2], faults / runs
+
+
+def read_whole_file(path):
+    with open(path, 'rb') as crx_file:
+        crx_file.read()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50],
+                        help='file sizes in MB')
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix='maninex_bench_')
+    print('{:>6} {:>9} {:>12} {:>8} {:>12}'.format(
+        'MB', 'manifest', 'read', 'faults', 'whole file'))
+    try:
+        for size in args.sizes:
+            for manifest_first in (True, False):
+                path = os.path.join(base_dir, 'extension.crx')
+                write_crx(path, size * 1024 * 1024, manifest_first)
+                assert maninex.read_crx_manifest(path).version == '1.2.3'
+                read_time, faults = measure(
+                    lambda: maninex.read_crx_manifest(path), args.runs)
+                whole_time, _ = measure(lambda: read_whole_file(path),
+                                        max(args.runs // 10, 1))
+                print('{:>6} {:>9} {:>10.3f}ms {:>8.0f} {:>10.3f}ms'.format(
+                    size, 'first' if manifest_first else 'last',
+                    read_time * 1000, faults, whole_time * 1000))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Run maninex's modes against the local stub server and temporary
+directories, and record the cost of each mode.
+
+    python benchmarks/bench_modes.py [--counts 10 100 1000] [--output FILE]
+                                     [--compare OLD_FILE]
+
+For 10, 100 and 1000 extensions, the script runs these modes in turn: install,
+update (after every tenth extension got a new version), list, clean and
+remove (after every tenth extension was dropped from the config). Some
+extensions are unknown to the server and downloads of some others always
+fail. Every mode runs as a separate maninex process, just like from the
+command line. The script measures:
+
+- the wall time of the process,
+- the number of HTTP requests and body bytes the server handled,
+- the peak RSS of the process,
+- the number of read and write syscalls (from /proc/self/io), and the
+  total number of syscalls if strace is installed.
+
+Results are written to a JSON file. Pass that file to --compare on a later
+run to see how another version of maninex does.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import configparser
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+from stub_server import StubServer  # noqa: E402
+from conftest import make_ext_id  # noqa: E402
+
+# run in the maninex process: start maninex with the remaining arguments and
+# write the resource usage to the file named in MANINEX_BENCH_REPORT on exit
+CHILD = '''
+import atexit, json, os, resource
+
+def read_proc(name):
+    values = {}
+    try:
+        with open('/proc/self/' + name) as proc_file:
+            for line in proc_file:
+                key, _, value = line.partition(':')
+                if value.split() and value.split()[0].isdigit():
+                    values[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+def report():
+    io = read_proc('io')
+    # unlike ru_maxrss, VmHWM isn't inherited from the benchmark process
+    peak_rss = read_proc('status').get('VmHWM')
+    if peak_rss is None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(os.environ['MANINEX_BENCH_REPORT'], 'w') as report_file:
+        json.dump({'peak_rss_kib': peak_rss,
+                   'read_syscalls': io.get('syscr'),
+                   'write_syscalls': io.get('syscw')}, report_file)
+
+atexit.register(report)
+import maninex
+maninex.main()
+'''
+
+MODES = [('install', ['--install']),
+         ('update', ['--update', '--refresh']),
+         ('list', ['--list']),
+         ('clean', ['--clean']),
+         ('remove', ['--remove'])]
+
+
+def write_config(base_dir, ext_ids, settings):
+    """Write a maninex.conf listing ext_ids to base_dir."""
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.optionxform = lambda option: option
+    config['directories'] = {'json_dir': os.path.join(base_dir, 'json'),
+                             'extension_dir': os.path.join(base_dir, 'ext')}
+    config['settings'] = settings
+    config['extensions'] = {}
+    for ext_id in ext_ids:
+        config['extensions'][ext_id] = None
+    with open(os.path.join(base_dir, 'maninex.conf'), 'w') as c_file:
+        config.write(c_file)
+
+
+def count_syscalls(strace_file):
+    """Return the total number of syscalls in the summary written by
+    strace -c."""
+    with open(strace_file) as summary:
+        for line in summary:
+            fields = line.split()
+            if fields and fields[-1] == 'total':
+                return int(fields[2] if len(fields) > 4 else fields[1])
+    return None
+
+
+def run_mode(base_dir, mode_args, jobs, strace):
+    """Run maninex with mode_args and return the wall time and the resource
+    usage reported by the process."""
+    report_file = os.path.join(base_dir, 'report.json')
+    strace_file = os.path.join(base_dir, 'strace.txt')
+    env = dict(os.environ, XDG_CONFIG_HOME=base_dir,
+               MANINEX_BENCH_REPORT=report_file,
+               PYTHONPATH=os.pathsep.join(
+                   [ROOT] + os.environ.get('PYTHONPATH', '').split(
+                       os.pathsep)))
+    if mode_args[0] in ('--install', '--update'):
+        mode_args = mode_args + ['--jobs', str(jobs)]
+    command = [sys.executable, '-c', CHILD] + mode_args
+    if strace:
+        command = ['strace', '-f', '-c', '-o', strace_file] + command
+
+    start = time.perf_counter()
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    wall_time = time.perf_counter() - start
+
+    with open(report_file) as report:
+        usage = json.load(report)
+    usage['syscalls'] = count_syscalls(strace_file) if strace else None
+    return wall_time, usage
+
+
+def run_scenario(count, args, strace):
+    """Run all modes for count extensions and return a list of results."""
+    ext_ids = [make_ext_id(n) for n in range(count)]
+    # every twentieth extension is unknown and downloads of every fiftieth
+    # fail
+    server = StubServer({ext_id: '1.0' for n, ext_id in enumerate(ext_ids)
+                         if n % 20 != 1},
+                        crx_size=args.size, latency=args.latency)
+    server.failing = set(ext_ids[2::50])
+    server.start()
+    base_dir = tempfile.mkdtemp(prefix='maninex_bench_')
+    settings = {'update_url': server.update_url,
+                'retries': str(args.retries)}
+    results = []
+    try:
+        os.mkdir(os.path.join(base_dir, 'json'))
+        os.mkdir(os.path.join(base_dir, 'ext'))
+        write_config(base_dir, ext_ids, settings)
+        for mode, mode_args in MODES:
+            if mode == 'update':
+                for ext_id in ext_ids[::10]:
+                    server.extensions[ext_id] = '1.1'
+            elif mode == 'remove':
+                write_config(base_dir, [ext_id for n, ext_id in
+                                        enumerate(ext_ids) if n % 10 != 5],
+                             settings)
+            server.reset_counters()
+            wall_time, usage = run_mode(base_dir, mode_args, args.jobs,
+                                        strace)
+            hits = server.hits
+            results.append({
+                'extensions': count,
+                'mode': mode,
+                'wall_time': round(wall_time, 4),
+                'requests': sum(number for kind, number in hits.items()
+                                if kind != 'crx_range'),
+                'bytes': server.bytes_sent,
+                'peak_rss_kib': usage['peak_rss_kib'],
+                'read_syscalls': usage['read_syscalls'],
+                'write_syscalls': usage['write_syscalls'],
+                'syscalls': usage['syscalls'],
+            })
+    finally:
+        server.stop()
+        shutil.rmtree(base_dir)
+    return results
+
+
+def get_revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    """Print results as a table. If baseline (a list of results of an
+    earlier run) is given, add the change of the wall time."""
+    old_times = {(old['extensions'], old['mode']): old['wall_time']
+                 for old in baseline or []}
+    # without strace, only read and write syscalls are counted
+    traced = any(result['syscalls'] is not None for result in results)
+    print('{:>6} {:>8} {:>9} {:>9} {:>11} {:>10} {:>9} {:>9}'.format(
+        'exts', 'mode', 'time', 'requests', 'bytes', 'rss KiB',
+        'syscalls' if traced else 'r/w calls', 'vs. old'))
+    for result in results:
+        syscalls = result['syscalls']
+        if syscalls is None and result['read_syscalls'] is not None:
+            syscalls = result['read_syscalls'] + result['write_syscalls']
+        old_time = old_times.get((result['extensions'], result['mode']))
+        change = ('{:+.0%}'.format(result['wall_time'] / old_time - 1)
+                  if old_time else '')
+        print('{:>6} {:>8} {:>8.3f}s {:>9} {:>11} {:>10} {:>9} {:>9}'.format(
+            result['extensions'], result['mode'], result['wall_time'],
+            result['requests'], result['bytes'], result['peak_rss_kib'],
+            '' if syscalls is None else syscalls, change))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--counts', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds the stub server waits per request')
+    parser.add_argument('--size', type=int, default=64 * 1024,
+                        help='size of every CRX file in bytes')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='retries setting used for all runs')
+    parser.add_argument('--no-strace', action='store_true',
+                        help="don't count all syscalls with strace")
+    parser.add_argument('--output', default='bench_modes.json',
+                        help='file the results are written to')
+    parser.add_argument('--compare', metavar='OLD_FILE',
+                        help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    strace = not args.no_strace and shutil.which('strace') is not None
+    results = []
+    for count in args.counts:
+        results += run_scenario(count, args, strace)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as old_file:
+            baseline = json.load(old_file)['results']
+    print_results(results, baseline)
+
+    with open(args.output, 'w') as output:
+        json.dump({'revision': get_revision(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   'strace': strace,
+                   'parameters': {'jobs': args.jobs,
+                                  'latency': args.latency,
+                                  'size': args.size,
+                                  'retries': args.retries},
+                   'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
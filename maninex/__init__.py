@@ -1 +1 @@
-from .maninex import main
+from .maninex import main, Manager, Configs, ExtResult, ConfigError
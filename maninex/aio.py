@@ -0,0 +1,462 @@
+"""An asyncio based alternative to the worker threads used for installing and
+updating extensions. Resolving, downloading and writing files all happen in a
+single event loop, so thousands of extensions don't need thousands of threads.
+Blocking file system calls are handed off to the loop's default executor.
+
+This engine requires aiohttp."""
+
+import time
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+from functools import partial
+from xml.etree import ElementTree
+from . import maninex
+from .maninex import ExtResult
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncExtensionOnline(maninex.ExtensionOnline):
+    """ExtensionOnline whose requests are sent through an aiohttp session.
+    Creating an instance doesn't contact the update service, resolve has to be
+    awaited before the extension can be used."""
+    def __init__(self, config_struct, ext_id, update_info=None, session=None):
+        self.prepare(config_struct, ext_id, update_info, session)
+
+    async def resolve(self, cache=None):
+        """Follow the redirects of requests_url without downloading the
+        extension itself. If cache is given, it is used like in
+        ExtensionOnline.resolve_cached. Nothing is requested if the
+        update_info of the extension is known."""
+        if self.update_info is not None:
+            self.set_url(self.update_info.url)
+            return
+        if cache is None:
+            entry = None
+            headers = {}
+        else:
+            entry = cache.lookup(self.ext_id)
+            headers = cache.conditional_headers(self.ext_id)
+
+        async def request():
+            async with self.session.head(self.requests_url, headers=headers,
+                                         allow_redirects=True) as response:
+                status = response.status
+                url = str(response.url)
+                response_headers = response.headers
+            if status >= 400 and status not in maninex.RETRY_STATUSES:
+                async with self.session.get(self.requests_url,
+                                            headers=headers) as response:
+                    status = response.status
+                    url = str(response.url)
+                    response_headers = response.headers
+            maninex.note(http_status=status)
+            if status in maninex.RETRY_STATUSES:
+                response.raise_for_status()
+            return status, url, response_headers
+
+        if entry is None:
+            with maninex.timed('resolve'):
+                status, url, response_headers = await with_retries(
+                    request, self.retries)
+            if cache is not None and status == 304:
+                entry = cache.revalidated(self.ext_id)
+
+        if entry is not None:
+            self.set_url(entry.url or self.requests_url)
+        else:
+            self.set_url(url)
+            if cache is not None:
+                cache.store(self.ext_id, self.url if self.exists else None,
+                            self.version, response_headers)
+
+    async def fetch(self, part_file):
+        """Coroutine version of ExtensionOnline.fetch."""
+        validator = {}
+        part_file.verifier = maninex.CrxVerifier(self.ext_id, self.expected)
+        limits = self.rate_limits(AsyncRateLimit)
+
+        async def request():
+            headers = maninex.get_range_headers(part_file.size, validator)
+            async with self.session.get(self.url,
+                                        headers=headers) as response:
+                maninex.note(http_status=response.status)
+                response.raise_for_status()
+                if not maninex.resumes_at(response.status, response.headers,
+                                          part_file.size):
+                    await run_blocking(part_file.restart)
+                validator.update(maninex.get_validator(response.headers))
+                size = maninex.get_download_size(
+                    response.headers, part_file.size, self.expected)
+                while True:
+                    chunk = await response.content.read(maninex.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    maninex.note(size=len(chunk))
+                    await run_blocking(part_file.write, chunk)
+                    for limit in limits:
+                        await limit.take(len(chunk), size - part_file.size)
+
+        with maninex.timed('transfer', exclude=['write']), \
+                maninex.gauge('transfers'):
+            await with_retries(request, self.retries)
+        part_file.verify()
+
+
+class AsyncConcurrencyLimit(maninex.ConcurrencyLimit):
+    """ConcurrencyLimit for the coroutines of a single event loop. It has to
+    be created in that loop."""
+    def __init__(self, ceiling, initial=None):
+        super().__init__(ceiling, initial)
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            while not self.ready():
+                try:
+                    await asyncio.wait_for(self.condition.wait(),
+                                           self.pause_left())
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started, status=None, headers=None):
+        async with self.condition:
+            self.record(started, status, headers)
+            self.condition.notify_all()
+
+
+class AsyncRateLimit(maninex.RateLimit):
+    """RateLimit for the coroutines of a single event loop. It has to be
+    created in that loop."""
+    def __init__(self, rate, burst=None):
+        super().__init__(rate, burst)
+        self.condition = asyncio.Condition()
+
+    async def take(self, size, left=float('inf')):
+        async with self.condition:
+            entry = self.enqueue(left)
+            delay = None
+            try:
+                delay = self.delay(entry)
+                while delay != 0:
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    delay = self.delay(entry)
+            finally:
+                self.dequeue(entry, size if delay == 0 else 0)
+                self.condition.notify_all()
+
+
+class LimitedSession(object):
+    """Wrapper around the aiohttp session session that sends requests once
+    the AsyncConcurrencyLimit limit lets them. Like with
+    maninex.LimitedAdapter, requests count as in flight until the headers
+    of their answer arrived. rate_limit is the AsyncRateLimit shared by all
+    downloads or None."""
+    def __init__(self, session, limit, rate_limit=None):
+        self.session = session
+        self.limit = limit
+        self.rate_limit = rate_limit
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    @asynccontextmanager
+    async def request(self, method, url, **kwargs):
+        started = await self.limit.acquire()
+        released = False
+        try:
+            async with self.session.request(method, url,
+                                            **kwargs) as response:
+                await self.limit.release(started, response.status,
+                                         response.headers)
+                released = True
+                yield response
+        finally:
+            if not released:
+                await self.limit.release(started)
+
+
+async def run_blocking(function, *args):
+    """Run function in the default executor of the running loop, in a copy of
+    the current context."""
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, partial(context.run, function,
+                                                    *args))
+
+
+def is_temporary(error):
+    """Check if the aiohttp exception error is worth retrying."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in maninex.RETRY_STATUSES
+    return isinstance(error, (aiohttp.ClientConnectionError,
+                              aiohttp.ClientPayloadError,
+                              asyncio.TimeoutError))
+
+
+async def with_retries(function, retries, *args):
+    """Coroutine version of maninex.with_retries for coroutine functions."""
+    attempt = 0
+    while True:
+        try:
+            return await function(*args)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            if attempt >= retries or not is_temporary(error):
+                raise
+            headers = getattr(error, 'headers', None)
+        maninex.note(retries=1)
+        await asyncio.sleep(maninex.retry_delay(attempt, headers))
+        attempt += 1
+
+
+async def check_updates(config_struct, ext_ids, session, cache):
+    """Coroutine version of maninex.check_updates."""
+    update_url = maninex.get_update_url(config_struct.config)
+
+    async def get_manifest(params):
+        async with session.get(update_url, params=params) as response:
+            response.raise_for_status()
+            return maninex.parse_update_manifest(await response.read())
+
+    results = {}
+    if cache is not None:
+        results = cache.lookup_updates(ext_ids)
+        ext_ids = [ext_id for ext_id in ext_ids if ext_id not in results]
+    for start in range(0, len(ext_ids), maninex.BATCH_SIZE):
+        chunk = ext_ids[start:start + maninex.BATCH_SIZE]
+        params = [('acceptformat', 'crx2,crx3'),
+                  ('prodversion', maninex.PROD_VERSION)]
+        params += [('x', 'id={}&uc'.format(ext_id)) for ext_id in chunk]
+        try:
+            with maninex.timed('check'):
+                manifest = await with_retries(
+                    get_manifest, maninex.get_retries(config_struct.config),
+                    params)
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                ElementTree.ParseError):
+            continue
+
+        for ext_id in chunk:
+            if ext_id in manifest:
+                results[ext_id] = manifest[ext_id]
+                if cache is not None:
+                    cache.store_update(ext_id, manifest[ext_id])
+    return results
+
+
+async def download_ext(ext_obj):
+    """Coroutine version of maninex.download_ext."""
+    await run_blocking(maninex.make_ext_path, ext_obj.ext_path)
+    part_file = await run_blocking(maninex.PartialFile, ext_obj.ext_path_file)
+    try:
+        await ext_obj.fetch(part_file)
+    except BaseException:
+        await run_blocking(part_file.discard)
+        raise
+    return await run_blocking(part_file.commit)
+
+
+async def store_ext(ext_obj, store):
+    """Coroutine version of maninex.CrxStore.fetch followed by linking the
+    stored file into the extension directory."""
+    lock_fd = await run_blocking(store.lock, ext_obj.ext_id)
+    try:
+        file_info = await run_blocking(store.lookup, ext_obj.ext_id,
+                                       ext_obj.filename)
+        if file_info is None:
+            part_file = await run_blocking(store.new_file, ext_obj.filename)
+            try:
+                await ext_obj.fetch(part_file)
+            except BaseException:
+                await run_blocking(part_file.discard)
+                raise
+            file_info = await run_blocking(store.add, ext_obj.ext_id,
+                                           ext_obj.filename, part_file)
+    finally:
+        await run_blocking(store.unlock, lock_fd)
+    await run_blocking(maninex.make_ext_path, ext_obj.ext_path)
+    await run_blocking(store.link, file_info, ext_obj.ext_path_file)
+    return file_info
+
+
+async def install_extension(ext_obj, store=None):
+    if store is None:
+        file_info = await download_ext(ext_obj)
+    else:
+        file_info = await store_ext(ext_obj, store)
+    return await run_blocking(maninex.point_json, ext_obj, file_info)
+
+
+async def update_extension(ext_obj, store=None):
+    state = await install_extension(ext_obj, store)
+    await run_blocking(maninex.archive_old_files, ext_obj.ext_path,
+                       ext_obj.filename)
+    await run_blocking(maninex.discard_staged, ext_obj.ext_path)
+    return state
+
+
+async def process_extension_install(config_struct, ext_ref, session, index,
+                                    cache, store, installed):
+    """Coroutine version of maninex.process_extension_install. installed
+    says if the extension is installed already."""
+    if installed:
+        return ExtResult(ext_ref, 'already_installed')
+    ext_obj = AsyncExtensionOnline(config_struct, ext_ref.idstr,
+                                   session=session)
+    await ext_obj.resolve(cache)
+    if ext_obj.exists is False:
+        return ExtResult(ext_ref, 'not_found')
+    state = await install_extension(ext_obj, store)
+    if index is not None:
+        index.record(ext_ref.idstr, state)
+    return ExtResult(ext_ref, 'installed', ext_obj.version)
+
+
+async def process_extension_update(config_struct, ext_ref, dir_list, updates,
+                                   session, index, cache, store):
+    """Coroutine version of maninex.process_extension_update."""
+    if ext_ref.idstr not in dir_list:
+        return ExtResult(ext_ref, 'not_installed')
+
+    try:
+        local_ver = await run_blocking(maninex.get_installed_version,
+                                       config_struct, ext_ref.idstr, index)
+    except FileNotFoundError:
+        local_ver = None
+    update_info = updates.get(ext_ref.idstr)
+    if ext_ref.idstr in updates and update_info is None:
+        return ExtResult(ext_ref, 'not_found')
+    if update_info is not None and maninex.same_version(update_info.version,
+                                                        local_ver):
+        return ExtResult(ext_ref, 'up_to_date', local_ver)
+
+    ext_obj = AsyncExtensionOnline(config_struct, ext_ref.idstr, update_info,
+                                   session)
+    await ext_obj.resolve(cache)
+    if ext_obj.exists is False:
+        return ExtResult(ext_ref, 'not_found')
+    if maninex.same_version(ext_obj.version, local_ver):
+        return ExtResult(ext_ref, 'up_to_date', local_ver)
+    state = await update_extension(ext_obj, store)
+    if index is not None:
+        index.record(ext_ref.idstr, state)
+    return ExtResult(ext_ref, 'updated', ext_obj.version)
+
+
+async def limited(semaphore, coroutine, ext_ref):
+    """Await coroutine while holding semaphore, turn errors into failed
+    results and track the statistics of ext_ref."""
+    async with semaphore:
+        with maninex.track(ext_ref) as record:
+            try:
+                result = await coroutine
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError,
+                    maninex.VerificationError) as error:
+                result = ExtResult(ext_ref, 'failed', error=error)
+            record.set_result(result)
+        return result._replace(stats=record)
+
+
+def run_loop(start_jobs, jobs, timeout, max_rate=None):
+    """Run the coroutine function start_jobs(session, semaphore) in a new
+    event loop, where session is a LimitedSession with up to jobs requests
+    in flight, whose downloads share max_rate bytes per second if it is
+    given. It has to return a list of tasks, whose results are yielded in
+    order as soon as they are available. timeout is a tuple of the connect
+    and read timeout in seconds."""
+    loop = asyncio.new_event_loop()
+    session = None
+
+    async def start():
+        nonlocal session
+        connector = aiohttp.TCPConnector(limit=jobs)
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout[0],
+                                          sock_read=timeout[1]))
+        rate_limit = AsyncRateLimit(max_rate) if max_rate else None
+        return await start_jobs(
+            LimitedSession(session, AsyncConcurrencyLimit(jobs), rate_limit),
+            asyncio.Semaphore(jobs))
+
+    try:
+        for task in loop.run_until_complete(start()):
+            yield loop.run_until_complete(task)
+    finally:
+        if session is not None:
+            loop.run_until_complete(session.close())
+        loop.close()
+
+
+def install_extensions(config_struct, jobs, index=None, cache=None,
+                       store=None, ext_refs=None, max_rate=None):
+    """Install all extensions listed in config_struct (or the ExtRefs in
+    ext_refs) that aren't installed yet, processing up to jobs extensions at
+    the same time. Yield an ExtResult for every extension. Installations are
+    recorded in index if one is given, lookups are cached in cache and files
+    are shared through store if they are given. Downloads share max_rate
+    bytes per second (see maninex.get_rate_setting)."""
+    if ext_refs is None:
+        ext_refs = list(maninex.get_exts_from_config(config_struct.config))
+    missing = {ext_ref.idstr for ext_ref in maninex.make_plan(
+        config_struct, index, scan=False, ext_refs=ext_refs).install}
+
+    async def start_jobs(session, semaphore):
+        return [asyncio.ensure_future(limited(
+                    semaphore,
+                    process_extension_install(config_struct, ext_ref,
+                                              session, index, cache, store,
+                                              ext_ref.idstr not in missing),
+                    ext_ref))
+                for ext_ref in ext_refs]
+
+    yield from run_loop(start_jobs, jobs,
+                        maninex.get_timeout(config_struct.config),
+                        maninex.get_rate_setting(config_struct.config,
+                                                 'max_rate', max_rate))
+
+
+def update_extensions(config_struct, jobs, index=None, cache=None,
+                      store=None, ext_refs=None, max_rate=None):
+    """Update all extensions listed in config_struct (or the ExtRefs in
+    ext_refs) that are installed, processing up to jobs extensions at the
+    same time. Yield an ExtResult for every extension. If index is given, it
+    is used instead of scanning the extension directory and records all
+    updates. Lookups are cached in cache and files are shared through store
+    if they are given. Downloads share max_rate bytes per second.
+    Afterwards, the Archive is pruned."""
+    if ext_refs is None:
+        ext_refs = list(maninex.get_exts_from_config(config_struct.config))
+    installed = maninex.make_plan(config_struct, index, scan=False,
+                                  ext_refs=ext_refs).update
+    dir_list = {ext_ref.idstr for ext_ref in installed}
+
+    async def start_jobs(session, semaphore):
+        updates = await check_updates(config_struct,
+                                      [ext_ref.idstr for ext_ref in installed],
+                                      session, cache)
+        return [asyncio.ensure_future(limited(
+                    semaphore,
+                    process_extension_update(config_struct, ext_ref,
+                                             dir_list, updates, session,
+                                             index, cache, store),
+                    ext_ref))
+                for ext_ref in ext_refs]
+
+    yield from run_loop(start_jobs, jobs,
+                        maninex.get_timeout(config_struct.config),
+                        maninex.get_rate_setting(config_struct.config,
+                                                 'max_rate', max_rate))
+    maninex.prune_archive(config_struct)
@@ -3,13 +3,34 @@
 import re
 import os
 import sys
-import requests
+import json
+import time
+import uuid
+import stat
+import random
+import fcntl
+import ctypes
+import select
+import signal
+import mmap
+import heapq
+import itertools
+import platform
+import zlib
+import struct
+import hashlib
+import ctypes.util
 import textwrap
+import threading
+import contextvars
 import configparser
-from collections import namedtuple
-from argparse import ArgumentParser
+from collections import namedtuple, Counter
+from contextlib import contextmanager, redirect_stdout
+from xml.etree import ElementTree
+from argparse import ArgumentParser, ArgumentTypeError
+from functools import partial
 from shutil import rmtree
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 
 
 EXAMPLE_CONFIG = '''[directories]
@@ -29,47 +50,1119 @@ extension_dir = ~/.config/inox/extensions
 # extension before the actual id. Like this:
 # uBlock Origin =  cjpalhdlnbpafiamejdnhcphjbkeiagm'''
 
+# default location of the update service; can be overridden with the update_url
+# setting in maninex.conf (e.g. to point maninex at a local mirror)
+UPDATE_URL = 'https://clients2.google.com/service/update2/crx'
+PROD_VERSION = '48.0'
+# number of extension ids looked up with a single update manifest request
+BATCH_SIZE = 50
+# the only status in an update manifest meaning that an extension doesn't exist
+UNKNOWN_APP_STATUS = 'error-unknownApplication'
+# number of extensions processed at the same time unless configured otherwise
+DEFAULT_JOBS = 8
+# size of the pieces extension files are downloaded and written in
+CHUNK_SIZE = 64 * 1024
+# name of the file in extension_dir that records the installed extensions
+STATE_FILE = '.maninex_state.json'
+# name of the file in extension_dir that caches what the update service said
+CACHE_FILE = '.maninex_cache.json'
+# name of the directory in extension_dir that keeps replaced extension files
+ARCHIVE_DIR = '.maninex_archive'
+# replaced versions kept per extension
+DEFAULT_KEEP_VERSIONS = 3
+# name of the directory in extension_dir that holds prefetched updates and
+# of the file describing each of them
+STAGING_DIR = '.maninex_staging'
+STAGED_FILE = 'staged.json'
+# how much --prefetch and --idle lower the CPU priority
+LOW_PRIORITY_NICENESS = 10
+# ioprio_set system call numbers of the architectures that have one
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+              'armv7l': 314, 'ppc64le': 273, 'riscv64': 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+# multipliers of the suffixes rates can have
+RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# seconds for which cached lookups of existing and unknown extensions are used
+# without asking the update service again
+DEFAULT_CACHE_TTL = 300
+DEFAULT_NEGATIVE_CACHE_TTL = 3600
+# seconds to wait for a connection and for data from the server and number of
+# times a failed request is retried unless configured otherwise
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+# the delay before the nth retry is random, but at most BACKOFF_BASE * 2 ** n
+# and never more than BACKOFF_MAX seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# answers of overloaded servers, which are usually gone after a while
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# longest Retry-After header that is honored, in seconds
+MAX_RETRY_AFTER = 300
+# number of requests in flight at first; it grows up to the number of jobs
+# as long as the server answers quickly and without errors
+INITIAL_JOBS = 2
+# requests are sent more slowly if the average latency exceeds the lowest
+# one seen by this factor plus LATENCY_SLACK seconds; the lowest latency
+# grows by LATENCY_DRIFT with every answer that isn't faster
+LATENCY_FACTOR = 2
+LATENCY_SLACK = 0.05
+LATENCY_DRIFT = 0.01
+# seconds between update runs of the daemon unless configured otherwise; every
+# run is delayed by a random number of seconds up to DEFAULT_UPDATE_JITTER, so
+# that many hosts don't contact the update service at the same moment
+DEFAULT_UPDATE_INTERVAL = 3600
+DEFAULT_UPDATE_JITTER = 600
+# seconds between checks of the config file where inotify isn't available
+POLL_INTERVAL = 2
+# results the daemon doesn't report, as they don't change anything
+QUIET_STATUSES = ('already_installed', 'up_to_date', 'not_installed')
+# CRX headers larger than this are rejected rather than buffered
+MAX_CRX_HEADER_SIZE = 1024 * 1024
+# the end of a zip archive that has to be kept to find its end of central
+# directory record, which is 22 bytes plus a comment of up to 65535 bytes
+ZIP_TAIL_SIZE = 22 + 0xffff
+
+MESSAGES = {
+    'installed': 'Extension "{}" installed.',
+    'already_installed': 'Extension "{}" is already installed.',
+    'not_found': 'Extension "{}" not found.',
+    'updated': 'Extension "{}" updated.',
+    'up_to_date': 'Extension "{}" up-to-date.',
+    'not_installed': 'Extension "{}" in config but not installed. Skipping...',
+    'failed': 'Extension "{}" failed: {}',
+    'removed': 'Extension "{}" removed.',
+    'staged': 'Update of extension "{}" staged.',
+    'activated': 'Staged update of extension "{}" activated.',
+    'rolled_back': 'Extension "{}" rolled back.',
+    'nothing_archived': 'Extension "{}" has no previous version to roll '
+                        'back to.',
+    'locked': 'Extension "{}" locked.',
+    'not_locked': 'Extension "{}" is not in the lockfile.',
+    'as_locked': 'Extension "{}" matches the lockfile.',
+    'not_as_locked': 'Extension "{}" differs from the lockfile.',
+    'missing': 'Extension "{}" is not installed.',
+}
+
+
 try:
     term_width = os.get_terminal_size().columns
 except OSError:
     # OSError occurs when not running from real terminal (e.g. when testing)
     term_width = 80
 
+EXT_ID_PATTERN = re.compile('[a-p]{32}')
 ExtRef = namedtuple('ExtensionReference', ['name', 'idstr'])
 Configs = namedtuple('ConfigObjects', ['ext_dir', 'json_dir',
-                                       'config', 'config_file'])
+                                       'config', 'config_file', 'profile'])
+Configs.__new__.__defaults__ = (None,)
+UpdateInfo = namedtuple('UpdateInfo', ['ext_id', 'version', 'url',
+                                       'sha256', 'size'])
+UpdateInfo.__new__.__defaults__ = (None, None)
+# stats is the ExtStats object of the extension, whose phases and elapsed
+# time are only filled in while statistics are collected
+ExtResult = namedtuple('ExtensionResult', ['ext_ref', 'status', 'version',
+                                           'error', 'stats'])
+ExtResult.__new__.__defaults__ = (None, None, None)
+FileInfo = namedtuple('FileInfo', ['size', 'sha256'])
+# what the modes have to do in a profile, see make_plan
+Plan = namedtuple('Plan', ['install', 'update', 'orphaned_folders',
+                           'orphaned_jsons', 'dangling_jsons'])
+ExtState = namedtuple('ExtensionState', ['version', 'filename', 'size',
+                                         'sha256', 'json_path'])
+CacheEntry = namedtuple('CacheEntry', ['url', 'version', 'etag',
+                                       'last_modified', 'checked', 'sha256',
+                                       'size'])
+CacheEntry.__new__.__defaults__ = (None, None)
 
 
 class ExtensionOnline(object):
     """Holds relevant information about an extension including a requests
-    object pointing to its online location."""
-    def __init__(self, config_struct, ext_id):
-        ext_dir = config_struct.ext_dir
-        json_dir = config_struct.json_dir
+    object pointing to its online location. Only the headers are requested
+    until the extension file is fetched. If update_info is given, its
+    download url and version are used instead of asking the update service
+    and the downloaded file has to match its digest and size, without any
+    request before the download. Requests are sent through session if one is
+    provided. If cache (a ResolveCache) is given, the update service is only
+    asked if the cached result is outdated."""
+    def __init__(self, config_struct, ext_id, update_info=None, session=None,
+                 cache=None):
+        self.prepare(config_struct, ext_id, update_info, session)
+        if update_info is not None:
+            self.requests_object = None
+            self.set_url(update_info.url)
+        elif cache is None:
+            self.requests_object = self.resolve()
+            self.set_url(self.requests_object.url)
+        else:
+            self.resolve_cached(cache)
 
+    def prepare(self, config_struct, ext_id, update_info, session):
+        """Set up everything that is known before contacting the update
+        service."""
+        import requests
         self.ext_id = ext_id
-        self.requests_url = (
-                'https://clients2.google.com/service/update2/crx?response=redi'
-                'rect&prodversion=48.0&x=id%3D{}%26installsource%3Dondemand%26'
-                'uc'.format(ext_id))
-        self.requests_object = requests.get(self.requests_url)
-        self.url = self.requests_object.url
+        self.update_info = update_info
+        self.session = session or requests
+        self.timeout = get_timeout(config_struct.config)
+        self.retries = get_retries(config_struct.config)
+        self.download_rate = get_rate_setting(config_struct.config,
+                                              'max_download_rate')
+        # what the downloaded file should look like, if known
+        self.expected = None
+        if update_info is not None:
+            self.expected = FileInfo(size=update_info.size,
+                                     sha256=update_info.sha256)
+        if update_info is None:
+            self.requests_url = (
+                '{}?response=redirect&prodversion={}&x=id%3D{}'
+                '%26installsource%3Dondemand%26uc'.format(
+                    get_update_url(config_struct.config), PROD_VERSION,
+                    ext_id))
+        else:
+            self.requests_url = update_info.url
+        self.ext_path = os.path.join(config_struct.ext_dir, self.ext_id)
+        self.json_path_file = os.path.abspath(
+            os.path.join(config_struct.json_dir, self.ext_id + '.json'))
+
+    def set_url(self, url):
+        """Set the final url of the extension file and everything derived
+        from it."""
+        self.url = url
         self.exists = self.check_exists()
         self.filename = self.url.rsplit('/', 1)[-1]
-        self.version = self.get_version()
-        self.ext_path = os.path.join(ext_dir, self.ext_id)
+        if not self.exists:
+            self.version = None
+        elif self.update_info is None:
+            self.version = self.get_version()
+        else:
+            self.version = self.update_info.version
         self.ext_path_file = os.path.join(self.ext_path, self.filename)
-        self.json_path_file = os.path.abspath(os.path.join(json_dir,
-                                              self.ext_id + '.json'))
+
+    def resolve(self, headers=None):
+        """Follow the redirects of requests_url without downloading the
+        extension itself and return the final response."""
+        def request():
+            response = self.session.head(self.requests_url, headers=headers,
+                                         allow_redirects=True,
+                                         timeout=self.timeout)
+            if (response.status_code >= 400 and
+                    response.status_code not in RETRY_STATUSES):
+                # some servers don't answer HEAD requests properly, so fall
+                # back to a GET request that is closed as soon as the headers
+                # arrived
+                response = self.session.get(self.requests_url,
+                                            headers=headers, stream=True,
+                                            timeout=self.timeout)
+                response.close()
+            note(http_status=response.status_code)
+            # an overloaded server doesn't redirect to the extension, which
+            # mustn't be mistaken for the extension not existing
+            if response.status_code in RETRY_STATUSES:
+                response.raise_for_status()
+            return response
+
+        with timed('resolve'):
+            return with_retries(request, self.retries)
+
+    def resolve_cached(self, cache):
+        """Take the url from cache if its entry is still fresh. Otherwise,
+        revalidate the entry with a conditional request or replace it."""
+        self.requests_object = None
+        entry = cache.lookup(self.ext_id)
+        if entry is None:
+            self.requests_object = self.resolve(
+                cache.conditional_headers(self.ext_id))
+            if self.requests_object.status_code == 304:
+                entry = cache.revalidated(self.ext_id)
+
+        if entry is not None:
+            self.set_url(entry.url or self.requests_url)
+        else:
+            self.set_url(self.requests_object.url)
+            cache.store(self.ext_id, self.url if self.exists else None,
+                        self.version, self.requests_object.headers)
+
+    def fetch(self, part_file):
+        """Download the extension file into the PartialFile part_file in
+        chunks of CHUNK_SIZE bytes. Broken transfers are retried and resumed
+        where they stopped if the server supports Range requests. Otherwise,
+        they start over. The file is checked by a CrxVerifier while it
+        arrives; VerificationError is raised if it turns out to be
+        damaged."""
+        validator = {}
+        part_file.verifier = CrxVerifier(self.ext_id, self.expected)
+        limits = self.rate_limits(RateLimit)
+
+        def request():
+            headers = get_range_headers(part_file.size, validator)
+            with self.session.get(self.url, headers=headers, stream=True,
+                                  timeout=self.timeout) as response:
+                note(http_status=response.status_code)
+                response.raise_for_status()
+                if not resumes_at(response.status_code, response.headers,
+                                  part_file.size):
+                    part_file.restart()
+                validator.update(get_validator(response.headers))
+                size = get_download_size(response.headers, part_file.size,
+                                         self.expected)
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    note(size=len(chunk))
+                    part_file.write(chunk)
+                    for limit in limits:
+                        limit.take(len(chunk), size - part_file.size)
+
+        with timed('transfer', exclude=['write']), gauge('transfers'):
+            with_retries(request, self.retries)
+        part_file.verify()
+
+    def rate_limits(self, rate_limit_class):
+        """Return the rate limits a download has to keep to: its own, if
+        max_download_rate is set, and the one shared by the session, if
+        any. The former is created as an instance of rate_limit_class."""
+        limits = []
+        if self.download_rate is not None:
+            limits.append(rate_limit_class(self.download_rate))
+        if getattr(self.session, 'rate_limit', None) is not None:
+            limits.append(self.session.rate_limit)
+        return limits
 
     def check_exists(self):
         if not self.url.rsplit('.', 1)[-1] == 'crx':
             return False
+        return True
 
     def get_version(self):
-        version = re.findall(r'(\d[\d_]+)', self.filename)[0]
-        version = version.replace('_', '.')
-        return version
+        """Return the version in the filename of the extension file. Once it
+        is downloaded, the version in its manifest takes precedence."""
+        return version_from_filename(self.filename)
+
+
+def get_update_url(config):
+    """Return the url of the update service as set up in config."""
+    return config.get('settings', 'update_url', fallback=UPDATE_URL)
+
+
+def same_version(version_a, version_b):
+    """Check if two version strings refer to the same version. Trailing zero
+    components are ignored, so that 1.2 and 1.2.0 are considered equal."""
+    if version_a is None or version_b is None:
+        return version_a == version_b
+
+    def strip(version):
+        parts = version.split('.')
+        while len(parts) > 1 and parts[-1].strip('0') == '':
+            parts.pop()
+        return [part.lstrip('0') or '0' for part in parts]
+
+    return strip(version_a) == strip(version_b)
+
+
+def parse_update_manifest(manifest):
+    """Parse an update2 xml manifest and return a dict mapping the id of every
+    app contained in it to an UpdateInfo object, or to None if the update
+    service doesn't know the app. Apps the update service reported another
+    error for, or offered no file for, are left out like failed lookups."""
+    results = {}
+    root = ElementTree.fromstring(manifest)
+    for app in root.iter():
+        # ignore the namespace the update service puts on every tag
+        if app.tag.rsplit('}', 1)[-1] != 'app':
+            continue
+        ext_id = app.get('appid')
+        for check in app:
+            if check.tag.rsplit('}', 1)[-1] == 'updatecheck':
+                break
+        else:
+            check = None
+
+        statuses = [app.get('status', 'ok')]
+        if check is not None:
+            statuses.append(check.get('status'))
+        if UNKNOWN_APP_STATUS in statuses:
+            results[ext_id] = None
+        elif statuses == ['ok', 'ok'] and check.get('codebase'):
+            size = check.get('size')
+            results[ext_id] = UpdateInfo(
+                ext_id=ext_id, version=check.get('version'),
+                url=check.get('codebase'),
+                sha256=check.get('hash_sha256') or None,
+                size=int(size) if size and size.isdigit() else None)
+    return results
+
+
+def get_range_headers(offset, validator):
+    """Return the headers asking for the rest of a file starting at offset.
+    validator (as returned by get_validator) makes sure the rest belongs to
+    the same file. Without a validator, the whole file is requested."""
+    if not offset or not validator:
+        return {}
+    headers = {'Range': 'bytes={}-'.format(offset)}
+    headers.update(validator)
+    return headers
+
+
+def get_validator(headers):
+    """Return an If-Range header for the file described by the response
+    headers or an empty dict if it can't be identified reliably."""
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return {'If-Range': etag}
+    if headers.get('Last-Modified'):
+        return {'If-Range': headers['Last-Modified']}
+    return {}
+
+
+def resumes_at(status, headers, offset):
+    """Check if a response with status and headers continues a file at
+    offset instead of starting it over."""
+    if status != 206:
+        return False
+    match = re.match(r'bytes (\d+)-', headers.get('Content-Range', ''))
+    return match is not None and int(match.group(1)) == offset
+
+
+def backoff_delay(attempt):
+    """Return the number of seconds to wait before retry number attempt,
+    counting from 0. The delay is random, so that downloads failing at the
+    same moment don't all retry at the same moment as well."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def get_retry_after(headers):
+    """Return the number of seconds the Retry-After header in headers asks
+    to wait, at most MAX_RETRY_AFTER, or None if there is no such header."""
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+def is_temporary(error):
+    """Check if the requests exception error is worth retrying."""
+    import requests
+    if isinstance(error, requests.HTTPError):
+        return (error.response is not None and
+                error.response.status_code in RETRY_STATUSES)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError))
+
+
+def retry_delay(attempt, headers=None):
+    """Return the number of seconds to wait before retry number attempt of
+    a request whose answer had headers. A Retry-After header is honored."""
+    delay = backoff_delay(attempt)
+    retry_after = get_retry_after(headers or {})
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def with_retries(function, retries, *args, **kwargs):
+    """Call function and return its result. If it fails with a temporary
+    network error, wait and try again up to retries times."""
+    import requests
+    attempt = 0
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except requests.RequestException as error:
+            if attempt >= retries or not is_temporary(error):
+                raise
+            response = error.response
+        note(retries=1)
+        time.sleep(retry_delay(
+            attempt, response.headers if response is not None else None))
+        attempt += 1
+
+
+def check_updates(config_struct, ext_ids, session=None, cache=None):
+    """Look up the latest versions of all extensions in ext_ids, asking the
+    update service about up to BATCH_SIZE extensions per request. Return a
+    dict mapping ids to UpdateInfo objects (or None for unknown extensions).
+    Ids whose lookup failed are left out, so they can be checked
+    individually. Fresh results in cache are used without asking the update
+    service and new results are stored in it."""
+    import requests
+    update_url = get_update_url(config_struct.config)
+    timeout = get_timeout(config_struct.config)
+
+    def get_manifest(params):
+        response = (session or requests).get(update_url, params=params,
+                                             timeout=timeout)
+        response.raise_for_status()
+        return parse_update_manifest(response.content)
+
+    results = {}
+    if cache is not None:
+        results = cache.lookup_updates(ext_ids)
+        ext_ids = [ext_id for ext_id in ext_ids if ext_id not in results]
+    for start in range(0, len(ext_ids), BATCH_SIZE):
+        params = [('acceptformat', 'crx2,crx3'),
+                  ('prodversion', PROD_VERSION)]
+        params += [('x', 'id={}&uc'.format(ext_id))
+                   for ext_id in ext_ids[start:start + BATCH_SIZE]]
+        try:
+            with timed('check'):
+                manifest = with_retries(get_manifest,
+                                        get_retries(config_struct.config),
+                                        params)
+        except (requests.RequestException, ElementTree.ParseError):
+            continue
+
+        for ext_id in ext_ids[start:start + BATCH_SIZE]:
+            if ext_id in manifest:
+                results[ext_id] = manifest[ext_id]
+                if cache is not None:
+                    cache.store_update(ext_id, manifest[ext_id])
+    return results
+
+
+class ResolveCache(object):
+    """What the update service said about each extension (download url,
+    version, ETag and Last-Modified header or that the extension wasn't
+    found), stored as a JSON file in the extension directory. Entries are
+    used without contacting the update service for cache_ttl seconds (or
+    negative_cache_ttl seconds for unknown extensions) and can be revalidated
+    with conditional requests afterwards. If refresh is True, cached entries
+    are ignored but new results are still stored. path overrides the
+    location of the JSON file."""
+    def __init__(self, config_struct, refresh=False, path=None):
+        config = config_struct.config
+        self.path = path or os.path.join(config_struct.ext_dir, CACHE_FILE)
+        self.ttl = get_number_setting(config, 'cache_ttl',
+                                      DEFAULT_CACHE_TTL, minimum=0)
+        self.negative_ttl = get_number_setting(config, 'negative_cache_ttl',
+                                               DEFAULT_NEGATIVE_CACHE_TTL,
+                                               minimum=0)
+        self.refresh = refresh
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the cache file. A missing or damaged file means an empty
+        cache."""
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+            self.entries = {ext_id: CacheEntry(**entry)
+                            for ext_id, entry in data.items()}
+        except (FileNotFoundError, ValueError, TypeError):
+            self.entries = {}
+
+    def save(self):
+        part_file = PartialFile(self.path)
+        part_file.write(json.dumps(
+            {ext_id: entry._asdict()
+             for ext_id, entry in sorted(self.entries.items())}).encode())
+        part_file.commit()
+
+    def entry(self, ext_id):
+        """Return the entry for ext_id regardless of its age, or None if
+        there is none or the cache is being refreshed."""
+        if self.refresh:
+            return None
+        return self.entries.get(ext_id)
+
+    def lookup(self, ext_id):
+        """Return the entry for ext_id if it is still fresh."""
+        entry = self.entry(ext_id)
+        if entry is None:
+            return None
+        ttl = self.ttl if entry.url is not None else self.negative_ttl
+        if time.time() - entry.checked < ttl:
+            return entry
+        return None
+
+    def lookup_updates(self, ext_ids):
+        """Return a dict like the one returned by check_updates for all
+        extensions in ext_ids with a fresh entry."""
+        updates = {}
+        for ext_id in ext_ids:
+            entry = self.lookup(ext_id)
+            if entry is None:
+                continue
+            elif entry.url is None:
+                updates[ext_id] = None
+            else:
+                updates[ext_id] = UpdateInfo(ext_id=ext_id, url=entry.url,
+                                             version=entry.version,
+                                             sha256=entry.sha256,
+                                             size=entry.size)
+        return updates
+
+    def conditional_headers(self, ext_id):
+        """Return the headers for revalidating the entry for ext_id."""
+        entry = self.entry(ext_id)
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def revalidated(self, ext_id):
+        """Mark the entry for ext_id as fresh again and return it."""
+        with self._lock:
+            entry = self.entries.get(ext_id)
+            if entry is not None:
+                entry = self.entries[ext_id] = entry._replace(
+                    checked=time.time())
+            return entry
+
+    def store(self, ext_id, url, version, headers=None, sha256=None,
+              size=None):
+        """Store the result of resolving ext_id. url is None for extensions
+        that don't exist. sha256 and size describe the file at url if the
+        update service announced them."""
+        headers = headers or {}
+        with self._lock:
+            self.entries[ext_id] = CacheEntry(
+                url=url, version=version, etag=headers.get('ETag'),
+                last_modified=headers.get('Last-Modified'),
+                checked=time.time(), sha256=sha256, size=size)
+
+    def store_update(self, ext_id, update_info):
+        """Store an entry of the dict returned by check_updates."""
+        if update_info is None:
+            self.store(ext_id, None, None)
+        else:
+            self.store(ext_id, update_info.url, update_info.version,
+                       sha256=update_info.sha256, size=update_info.size)
+
+
+class ConfigError(Exception):
+    """The config file, one of its settings or a command line option can't
+    be used. The message tells why; the command line prints it and exits
+    with status 1."""
+    def __init__(self, message):
+        super().__init__(re.sub(r'\s+', ' ', message).strip())
+
+
+def get_number_setting(config, key, default, minimum=1):
+    """Return the integer setting key from config. Raise ConfigError if it
+    isn't a number of at least minimum."""
+    try:
+        number = config.getint('settings', key, fallback=default)
+    except ValueError:
+        number = minimum - 1
+    if number < minimum:
+        raise ConfigError("""The {} setting in maninex.conf has to be a
+        number of at least {}.""".format(key, minimum))
+    return number
+
+
+def get_jobs(config, jobs=None):
+    """Return the number of extensions to process at the same time. jobs (as
+    passed on the command line) takes precedence over the jobs setting in
+    config."""
+    if jobs is not None:
+        return jobs
+    return get_number_setting(config, 'jobs', DEFAULT_JOBS)
+
+
+def get_timeout(config):
+    """Return the connect and read timeout in seconds set up in config."""
+    return (get_number_setting(config, 'connect_timeout',
+                               DEFAULT_CONNECT_TIMEOUT),
+            get_number_setting(config, 'read_timeout', DEFAULT_READ_TIMEOUT))
+
+
+def get_retries(config):
+    """Return how often failed requests are retried."""
+    return get_number_setting(config, 'retries', DEFAULT_RETRIES, minimum=0)
+
+
+def parse_rate(value):
+    """Return the number of bytes per second in value, a number with an
+    optional K, M or G suffix (e.g. 2M). Raise ValueError if value isn't
+    one."""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)', value.strip().upper())
+    if not match:
+        raise ValueError('{!r} is not a rate'.format(value))
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2)])
+
+
+def get_rate_setting(config, key, rate=None):
+    """Return the rate setting key from config in bytes per second, or None
+    if downloads aren't limited. rate (as passed on the command line) takes
+    precedence. Raise ConfigError if the setting can't be used."""
+    if rate is None:
+        try:
+            rate = parse_rate(config.get('settings', key, fallback='0'))
+        except ValueError:
+            raise ConfigError("""The {} setting in maninex.conf has to be a
+            number of bytes per second, optionally followed by K, M or
+            G.""".format(key))
+    return rate or None
+
+
+def get_download_size(headers, offset, expected=None):
+    """Return the size of the file whose download continues at offset with
+    an answer with headers, or infinity if it isn't known."""
+    if expected is not None and expected.size is not None:
+        return expected.size
+    length = headers.get('Content-Length', '')
+    return offset + int(length) if length.isdigit() else float('inf')
+
+
+class RateLimit(object):
+    """Token bucket letting through up to rate bytes per second, with bursts
+    of up to burst bytes (a second's worth by default). Downloads take their
+    share after receiving each chunk, which holds them back until the
+    bucket has tokens again. If several of them wait, the one with the
+    fewest bytes left goes first, so that small extensions finish quickly
+    instead of every download getting an equal share."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.waiting = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+
+    def enqueue(self, left):
+        """Queue a download with left bytes to go and return its entry."""
+        entry = (left, next(self.order))
+        heapq.heappush(self.waiting, entry)
+        return entry
+
+    def dequeue(self, entry, size):
+        """Remove entry from the queue, charging it size bytes."""
+        self.tokens -= size
+        self.waiting.remove(entry)
+        heapq.heapify(self.waiting)
+
+    def delay(self, entry):
+        """Return the number of seconds entry has to wait before it may go
+        (0 if it may go now), or None if other downloads go first."""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.waiting[0] != entry:
+            return None
+        # a chunk may overdraw the bucket, the following ones wait longer
+        return 0 if self.tokens > 0 else -self.tokens / self.rate
+
+    def take(self, size, left=float('inf')):
+        """Wait until size bytes may be received by a download with left
+        bytes to go afterwards."""
+        with self.condition:
+            entry = self.enqueue(left)
+            delay = None
+            try:
+                delay = self.delay(entry)
+                while delay != 0:
+                    self.condition.wait(delay)
+                    delay = self.delay(entry)
+            finally:
+                self.dequeue(entry, size if delay == 0 else 0)
+                self.condition.notify_all()
+
+
+class ConcurrencyLimit(object):
+    """Limit on the number of requests in flight that adapts to how well
+    the server copes, much like TCP's congestion control. It starts at
+    INITIAL_JOBS and grows by one for every round of quick and successful
+    answers, up to ceiling. Answers saying that the server is overloaded
+    (429 and server errors) and requests failing without an answer halve
+    it, and latencies well above the lowest one seen shrink it a bit. Only
+    requests sent after the last decrease can cause another one, so a burst
+    of errors from a single round counts once. A Retry-After header in an
+    overloaded answer holds back all requests for as long as it says, up to
+    MAX_RETRY_AFTER seconds."""
+    def __init__(self, ceiling, initial=None):
+        self.ceiling = ceiling
+        self.limit = float(min(initial or INITIAL_JOBS, ceiling))
+        self.in_flight = 0
+        self.min_latency = None
+        self.latency = None
+        self.last_decrease = 0.0
+        self.resume_at = 0.0
+        self.condition = threading.Condition()
+
+    def ready(self):
+        """Check if another request may be sent now."""
+        return (self.in_flight < int(self.limit) and
+                time.monotonic() >= self.resume_at)
+
+    def pause_left(self):
+        """Return the number of seconds left until requests may be sent
+        again after a Retry-After header, or None if there is no pause."""
+        left = self.resume_at - time.monotonic()
+        return left if left > 0 else None
+
+    def acquire(self):
+        """Wait until another request may be sent and return the time at
+        which it started, which has to be passed to release."""
+        with self.condition:
+            while not self.ready():
+                self.condition.wait(self.pause_left())
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, status=None, headers=None):
+        """Record the answer to the request that started at started, whose
+        status and headers are None if it failed without an answer."""
+        with self.condition:
+            self.record(started, status, headers)
+            self.condition.notify_all()
+
+    def record(self, started, status, headers):
+        now = time.monotonic()
+        self.in_flight -= 1
+        if status is None or status in RETRY_STATUSES:
+            retry_after = get_retry_after(headers or {})
+            if retry_after is not None:
+                self.resume_at = max(self.resume_at, now + retry_after)
+            self.decrease(started, now, 0.5)
+            return
+
+        latency = now - started
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        else:
+            # forget old minimums slowly, in case the route to the server
+            # got slower for good
+            self.min_latency *= 1 + LATENCY_DRIFT
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.latency > LATENCY_FACTOR * self.min_latency + LATENCY_SLACK:
+            self.decrease(started, now, 0.8)
+        else:
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+
+    def decrease(self, started, now, factor):
+        if started < self.last_decrease:
+            return
+        self.limit = max(1.0, self.limit * factor)
+        self.last_decrease = now
+
+
+class LimitedAdapter(object):
+    """Transport adapter for requests sessions that sends requests through
+    adapter once the ConcurrencyLimit limit lets them. Requests count as in
+    flight until the headers of their answer arrived."""
+    def __init__(self, adapter, limit):
+        self.adapter = adapter
+        self.limit = limit
+
+    def send(self, request, **kwargs):
+        started = self.limit.acquire()
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except BaseException:
+            self.limit.release(started)
+            raise
+        self.limit.release(started, response.status_code, response.headers)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def make_session(pool_size, max_rate=None):
+    """Return a requests session that keeps up to pool_size connections per
+    host alive and never opens more than that. The number of requests in
+    flight is controlled by a ConcurrencyLimit with pool_size as its
+    ceiling, which is available as the session's limit attribute. If
+    max_rate is given, all downloads through the session share a RateLimit
+    of that many bytes per second, its rate_limit attribute."""
+    import requests
+    session = requests.Session()
+    session.limit = ConcurrencyLimit(pool_size)
+    session.rate_limit = RateLimit(max_rate) if max_rate else None
+    adapter = LimitedAdapter(
+        requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                      pool_maxsize=pool_size,
+                                      pool_block=True),
+        session.limit)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@contextmanager
+def use_session(session, pool_size, max_rate=None):
+    """Yield session or, if it is None, a new session from make_session that
+    is closed afterwards."""
+    if session is not None:
+        yield session
+        return
+    with make_session(pool_size, max_rate) as session:
+        yield session
+
+
+def run_jobs(function, ext_refs, jobs):
+    """Call function for every item in ext_refs using a pool of jobs worker
+    threads and yield the results in the order of ext_refs. Network and file
+    system errors are turned into results with the status 'failed'."""
+    import requests
+    context = contextvars.copy_context()
+
+    def run(ext_ref):
+        with track(ext_ref) as record:
+            try:
+                result = function(ext_ref)
+            except (requests.RequestException, OSError,
+                    VerificationError) as error:
+                result = ExtResult(ext_ref, 'failed', error=error)
+            record.set_result(result)
+        return result._replace(stats=record)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # let every job see the Stats object collecting in this thread
+        yield from executor.map(
+            lambda ext_ref: context.copy().run(run, ext_ref), ext_refs)
+
+
+def format_result(result):
+    """Return the message describing result."""
+    return MESSAGES[result.status].format(result.ext_ref.name, result.error)
+
+
+# the Stats object collecting statistics (if any) and the ExtStats object of
+# the extension that is being processed
+current_stats = contextvars.ContextVar('current_stats', default=None)
+current_ext = contextvars.ContextVar('current_ext', default=None)
+# phases whose durations are recorded, in the order they happen
+PHASES = ['check', 'resolve', 'transfer', 'write', 'chown']
+
+
+class ExtStats(object):
+    """Statistics of a single extension: seconds spent in each phase,
+    downloaded bytes, the last HTTP status, the number of retries and the
+    outcome."""
+    def __init__(self, ext_ref, profile=None):
+        self.ext_ref = ext_ref
+        self.profile = profile
+        self.phases = Counter()
+        self.bytes = 0
+        self.http_status = None
+        self.retries = 0
+        self.status = None
+        self.version = None
+        self.elapsed = None
+
+    def add_time(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def set_result(self, result):
+        self.status = result.status
+        self.version = result.version
+
+    def as_dict(self):
+        return {'profile': self.profile, 'name': self.ext_ref.name,
+                'id': self.ext_ref.idstr, 'status': self.status,
+                'version': self.version, 'elapsed': round(self.elapsed, 4),
+                'phases': {phase: round(self.phases[phase], 4)
+                           for phase in PHASES if phase in self.phases},
+                'bytes': self.bytes, 'http_status': self.http_status,
+                'retries': self.retries}
+
+
+class Stats(object):
+    """Statistics of an install or update run. Every extension processed
+    while the object is collecting (see collecting) gets an ExtStats object.
+    Phases that don't belong to a single extension, like update checks, and
+    concurrency high-water marks are recorded for the whole run."""
+    def __init__(self, mode):
+        self.mode = mode
+        self.profile = None
+        self.extensions = []
+        self.phases = Counter()
+        self.active = Counter()
+        self.peak = Counter()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.elapsed = None
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] += seconds
+
+    @contextmanager
+    def gauge(self, name):
+        """Count name as active while the context lasts."""
+        with self.lock:
+            self.active[name] += 1
+            self.peak[name] = max(self.peak[name], self.active[name])
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[name] -= 1
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.start
+
+    def totals(self):
+        """Return a dict summing up the statistics of all extensions."""
+        phases = Counter(self.phases)
+        statuses = Counter()
+        for record in self.extensions:
+            phases.update(record.phases)
+            statuses[record.status] += 1
+        downloaded = sum(record.bytes for record in self.extensions)
+        return {'extensions': len(self.extensions),
+                'statuses': dict(statuses),
+                'elapsed': round(self.elapsed, 4),
+                'phases': {phase: round(phases[phase], 4)
+                           for phase in PHASES if phase in phases},
+                'bytes': downloaded,
+                'throughput': round(downloaded / self.elapsed)
+                if self.elapsed else None,
+                'retries': sum(record.retries for record in self.extensions),
+                'peak_concurrency': dict(self.peak)}
+
+    def report(self):
+        """Return all statistics as a dict that can be dumped as JSON."""
+        return {'mode': self.mode,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z',
+                                         time.localtime(self.started)),
+                'extensions': [record.as_dict()
+                               for record in self.extensions],
+                'totals': self.totals()}
+
+
+@contextmanager
+def collecting(stats):
+    """Record statistics in stats (unless it is None) while the context
+    lasts."""
+    token = current_stats.set(stats)
+    try:
+        yield
+    finally:
+        current_stats.reset(token)
+        if stats is not None:
+            stats.finish()
+
+
+@contextmanager
+def track(ext_ref):
+    """Yield an ExtStats object for ext_ref, which is added to the
+    collecting Stats object if there is one."""
+    stats = current_stats.get()
+    record = ExtStats(ext_ref, stats and stats.profile)
+    if stats is None:
+        yield record
+        return
+    with stats.lock:
+        stats.extensions.append(record)
+    token = current_ext.set(record)
+    start = time.perf_counter()
+    try:
+        with stats.gauge('extensions'):
+            yield record
+    finally:
+        record.elapsed = time.perf_counter() - start
+        current_ext.reset(token)
+
+
+@contextmanager
+def timed(phase, exclude=()):
+    """Add the time the context lasts to phase of the extension being
+    processed or to the whole run. Time spent in the phases in exclude
+    meanwhile isn't counted twice."""
+    record = current_ext.get() or current_stats.get()
+    if record is None:
+        yield
+        return
+    excluded = sum(record.phases[name] for name in exclude)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        elapsed -= sum(record.phases[name] for name in exclude) - excluded
+        record.add_time(phase, elapsed)
+
+
+@contextmanager
+def gauge(name):
+    """Stats.gauge of the collecting Stats object, if there is one."""
+    stats = current_stats.get()
+    if stats is None:
+        yield
+        return
+    with stats.gauge(name):
+        yield
+
+
+def note(http_status=None, size=0, retries=0):
+    """Add to the statistics of the extension being processed."""
+    record = current_ext.get()
+    if record is None:
+        return
+    if http_status is not None:
+        record.http_status = http_status
+    record.bytes += size
+    record.retries += retries
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit).replace('.0 B', ' B')
+        size /= 1024
+    return '{:.1f} GiB'.format(size)
+
+
+def format_stats(stats):
+    """Return the lines describing stats for humans."""
+    lines = ['{:<20} {:<17} {:>7} {:>7} {:>8} {:>7} {:>7} {:>10} {:>4} '
+             '{:>3}'.format('Extension', 'Status', 'total', 'resolve',
+                            'transfer', 'write', 'chown', 'size', 'HTTP',
+                            'try')]
+    for record in stats.extensions:
+        lines.append(
+            '{:<20} {:<17} {:>6.2f}s {:>6.2f}s {:>7.2f}s {:>6.2f}s {:>6.2f}s '
+            '{:>10} {:>4} {:>3}'.format(
+                record.ext_ref.name[:20], record.status, record.elapsed,
+                record.phases['resolve'], record.phases['transfer'],
+                record.phases['write'], record.phases['chown'],
+                format_size(record.bytes), record.http_status or '-',
+                record.retries))
+    totals = stats.totals()
+    lines.append('{} extensions in {:.2f}s, {} downloaded ({}/s), {} '
+                 'retries.'.format(totals['extensions'], stats.elapsed,
+                                   format_size(totals['bytes']),
+                                   format_size(totals['throughput'] or 0),
+                                   totals['retries']))
+    lines.append('Time per phase: {}.'.format(', '.join(
+        '{} {:.2f}s'.format(phase, seconds)
+        for phase, seconds in totals['phases'].items()) or 'none'))
+    lines.append('Peak concurrency: {} extensions, {} transfers.'.format(
+        stats.peak['extensions'], stats.peak['transfers']))
+    return lines
+
+
+def get_engine(engine):
+    """Return the functions used to install and update extensions with
+    engine, which is either 'threads' or 'asyncio'. Raise ConfigError if
+    engine can't be used."""
+    if engine == 'asyncio':
+        from . import aio
+        if aio.aiohttp is None:
+            raise ConfigError("""The asyncio engine requires aiohttp, which
+            is not installed.""")
+        return aio.install_extensions, aio.update_extensions
+    return install_extensions, update_extensions
 
 
 def get_real_path(path):
@@ -87,23 +1180,22 @@ def get_real_path(path):
 
 def check_folders(config_struct, perm):
     """Check if user has the permissions perm for the directories in the config
-    file. Exit if they don't."""
+    file. Raise ConfigError if they don't."""
     ext_dir = config_struct.ext_dir
     json_dir = config_struct.json_dir
     if not (os.path.exists(ext_dir) and os.path.exists(json_dir)):
-        mline_print("""One or more paths provided in maninex.conf could not be
-                found.""", file=sys.stderr)
-        sys.exit(1)
+        raise ConfigError("""One or more paths provided in maninex.conf could
+                not be found.""")
     elif not (os.access(ext_dir, perm) and os.access(json_dir, perm)):
-        mline_print("""You don't have the necessary permissions for this
-                operation.""", file=sys.stderr)
-        sys.exit(1)
+        raise ConfigError("""You don't have the necessary permissions for
+                this operation.""")
 
 
 def adapt_owner(target):
     """Change owner of target to match the owner of its parent directory."""
-    par_stat = os.stat(os.path.dirname(target))
-    os.chown(target, par_stat.st_uid, par_stat.st_gid)
+    with timed('chown'):
+        par_stat = os.stat(os.path.dirname(target))
+        os.chown(target, par_stat.st_uid, par_stat.st_gid)
 
 
 def mline_print(msg, **kwargs):
@@ -114,64 +1206,1066 @@ def mline_print(msg, **kwargs):
 
 
 def get_existing_jsons(json_dir):
-    """Get a list of all extensions that are already referenced by json
+    """Return the set of all extensions that are already referenced by json
     files."""
     try:
-        json_list = os.listdir(json_dir)
-        json_list = [json[:-5] for json in json_list if json.endswith('.json')]
+        with os.scandir(json_dir) as entries:
+            return {entry.name[:-5] for entry in entries
+                    if entry.name.endswith('.json')}
     except FileNotFoundError:
-        json_list = []
+        return set()
 
-    return json_list
 
-
-def get_existing_folders(ext_dir):
-    """Return a list of all plugin folders that are already present in
-    ext_dir."""
-    folder_list = []
+def get_existing_folders(ext_dir, check_files=True):
+    """Return the set of all plugin folders that are already present in
+    ext_dir. Empty folders are left out unless check_files is False, which
+    saves looking into every folder."""
     try:
-        for entry in os.scandir(path=ext_dir):
-            if (entry.is_dir() and
-                    len(entry.name) == 32 and
-                    os.listdir(entry.path)):
-                folder_list.append(entry.name)
+        with os.scandir(ext_dir) as entries:
+            return {entry.name for entry in entries
+                    if len(entry.name) == 32 and entry.is_dir() and
+                    (not check_files or has_files(entry.path))}
     except FileNotFoundError:
-        pass
+        return set()
 
-    return folder_list
+
+def has_files(path):
+    """Check if the directory path exists and isn't empty."""
+    try:
+        with os.scandir(path) as entries:
+            return next(entries, None) is not None
+    except (FileNotFoundError, NotADirectoryError):
+        return False
 
 
 def get_local_version(ext_dir, ext_id):
-    files = os.listdir(os.path.join(ext_dir, ext_id))
-    for filename in files:
-        if filename[-3:] == 'crx':
-            version = re.findall(r'(\d[\d_]+)', filename)[0]
-            version = version.replace('_', '.')
-            return version
-    return None
+    """Return the version of the extension file in use for ext_id or None if
+    there is none."""
+    ext_path = os.path.join(ext_dir, ext_id)
+    filename = get_current_file(ext_path)
+    if filename is None:
+        return None
+    return get_file_version(os.path.join(ext_path, filename))
 
 
 def create_json(json_file, filepath, version):
-    """Create a json file in json_dir that refers to ext_id and filepath."""
-    with open(json_file, 'w+') as j_file:
-        j_file.write('{\n')
-        j_file.write('  "external_crx": "' + filepath + '",\n')
-        j_file.write('  "external_version": "' + version + '"\n')
-        j_file.write('}')
-
-    adapt_owner(json_file)
+    """Create a json file in json_dir that refers to ext_id and filepath. It
+    replaces an existing one atomically, so the browser never reads half of
+    it."""
+    part_file = PartialFile(json_file)
+    part_file.write(('{\n'
+                     '  "external_crx": "' + filepath + '",\n'
+                     '  "external_version": "' + version + '"\n'
+                     '}').encode())
+    part_file.commit()
+
+
+class PartialFile(object):
+    """A hidden temporary file in the directory of path that atomically
+    replaces path once it is committed. Until then, path is left untouched, so
+    an interrupted download never leaves a truncated file behind. The size
+    and SHA-256 digest of the content are computed while it is written, and
+    so is the check of the CrxVerifier in verifier, if one is set. If chown
+    is False, the owner of the file is left alone."""
+    def __init__(self, path, chown=True):
+        directory, filename = os.path.split(path)
+        self.path = path
+        self.chown = chown
+        self.temp_path = os.path.join(directory, '.{}.{}.part'.format(
+            filename, uuid.uuid4().hex[:8]))
+        self.file = open(self.temp_path, 'xb')
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.verifier = None
+
+    def write(self, chunk):
+        with timed('write'):
+            self.file.write(chunk)
+        self.size += len(chunk)
+        self.hash.update(chunk)
+        if self.verifier is not None:
+            self.verifier.update(chunk)
+
+    def restart(self):
+        """Throw away everything written so far."""
+        if self.size:
+            self.file.seek(0)
+            self.file.truncate()
+            self.size = 0
+            self.hash = hashlib.sha256()
+            if self.verifier is not None:
+                self.verifier.reset()
+
+    def file_info(self):
+        """Return a FileInfo object for what was written so far."""
+        return FileInfo(size=self.size, sha256=self.hash.hexdigest())
+
+    def verify(self):
+        """Raise VerificationError unless the complete content passes the
+        check of verifier."""
+        if self.verifier is not None:
+            self.verifier.finish(self.file_info())
+
+    def commit(self, path=None):
+        """Make sure the content is on disk, move it to path (or the path
+        given when creating the file) and return a FileInfo object for
+        it."""
+        path = path or self.path
+        with timed('write'):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        if self.chown:
+            adapt_owner(self.temp_path)
+        with timed('write'):
+            os.replace(self.temp_path, path)
+            sync_dir(os.path.dirname(path))
+        return self.file_info()
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+
+def sync_dir(path):
+    """Make sure renames in the directory path are on disk."""
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 
-def download_ext(ext_path, ext_path_file, ext_content):
-    """Downloads an extension to ext_dir."""
+def make_ext_path(ext_path):
+    """Create the directory ext_path unless it exists already."""
     if not os.path.exists(ext_path):
-        os.mkdir(ext_path)
+        os.makedirs(ext_path, exist_ok=True)
         adapt_owner(ext_path)
 
-    with open(ext_path_file, 'wb') as ep_file:
-        ep_file.write(ext_content)
 
-    adapt_owner(ext_path_file)
+def download_ext(ext_path, ext_path_file, ext_content):
+    """Downloads an extension to ext_dir. ext_content is either the content of
+    the extension file, an iterable of chunks of it or a function that writes
+    it into the PartialFile passed to it. Return a FileInfo object for the new
+    file."""
+    make_ext_path(ext_path)
+    if isinstance(ext_content, bytes):
+        ext_content = [ext_content]
+
+    part_file = PartialFile(ext_path_file)
+    try:
+        if callable(ext_content):
+            ext_content(part_file)
+        else:
+            for chunk in ext_content:
+                part_file.write(chunk)
+    except BaseException:
+        part_file.discard()
+        raise
+    return part_file.commit()
+
+
+def hash_file(path):
+    """Return a FileInfo object for the file at path."""
+    file_hash = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file_:
+        for chunk in iter(partial(file_.read, CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+            size += len(chunk)
+    return FileInfo(size=size, sha256=file_hash.hexdigest())
+
+
+class VerificationError(ValueError):
+    """A downloaded extension file is damaged or isn't the expected one."""
+
+
+def check_file_info(expected, file_info):
+    """Raise VerificationError unless the FileInfo object file_info matches
+    the size and digest in expected (a FileInfo object or None) that are
+    known."""
+    if expected is None:
+        return
+    if expected.size is not None and expected.size != file_info.size:
+        raise VerificationError('size {} instead of {}'.format(
+            file_info.size, expected.size))
+    if (expected.sha256 is not None and
+            expected.sha256.lower() != file_info.sha256):
+        raise VerificationError('SHA-256 digest mismatch')
+
+
+def read_varint(data, pos):
+    """Return the protobuf varint starting at pos in data and the position
+    after it."""
+    value = shift = 0
+    while True:
+        if pos >= len(data) or shift > 63:
+            raise VerificationError('malformed CRX header')
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def get_proto_fields(data):
+    """Return a list of (field number, value) tuples for the length-delimited
+    fields of the protobuf message data, which is all CRX3 headers consist
+    of. Fields of other types are skipped."""
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            _, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            fields.append((key >> 3, bytes(data[pos:pos + length])))
+            pos += length
+        else:
+            raise VerificationError('malformed CRX header')
+        if pos > len(data):
+            raise VerificationError('malformed CRX header')
+    return fields
+
+
+def get_crx_header_size(data):
+    """Return the CRX version and the size of the CRX header data starts
+    with, or None if data is too short to tell. Raise VerificationError if
+    data doesn't start with a CRX header."""
+    if len(data) >= 4 and data[:4] != b'Cr24':
+        raise VerificationError('not a CRX file')
+    if len(data) < 12:
+        return None
+    version, first = struct.unpack_from('<II', data, 4)
+    if version == 3:
+        return version, 12 + first
+    elif version == 2:
+        if len(data) < 16:
+            return None
+        return version, 16 + first + struct.unpack_from('<I', data, 12)[0]
+    raise VerificationError('unsupported CRX version {}'.format(version))
+
+
+def get_ext_id(crx_id):
+    """Return the extension id for the 16 bytes crx_id, which Chromium
+    writes in hex, using the letters a to p instead of 0 to f."""
+    return ''.join(chr(ord('a') + int(digit, 16)) for digit in crx_id.hex())
+
+
+class CrxVerifier(object):
+    """Check an extension file while it is being written, so that it never
+    has to be read again. The CRX2 or CRX3 header has to be complete, carry
+    a signature and name ext_id as its extension, and the zip archive after
+    it has to start with a file entry and end with a consistent end of
+    central directory record. If expected (a FileInfo object) is given, the
+    size and SHA-256 digest have to match those of its fields that aren't
+    None. The signatures themselves aren't checked, as that would need RSA
+    and ECDSA implementations Python doesn't come with.
+
+    Pass every chunk of the file to update and call finish once the file is
+    complete. Both raise VerificationError when the file is found to be
+    damaged."""
+    def __init__(self, ext_id, expected=None):
+        self.ext_id = ext_id
+        self.expected = expected
+        self.reset()
+
+    def reset(self):
+        """Start over with an empty file."""
+        self.header = bytearray()
+        self.header_size = None
+        self.archive_start = b''
+        self.archive_size = 0
+        self.tail = bytearray()
+
+    def update(self, chunk):
+        if self.header_size is None:
+            self.header += chunk
+            chunk = self.check_header()
+            if chunk is None:
+                return
+        if len(self.archive_start) < 4:
+            self.archive_start += bytes(chunk[:4 - len(self.archive_start)])
+            if (len(self.archive_start) == 4 and
+                    self.archive_start != b'PK\x03\x04'):
+                raise VerificationError('no zip archive after the CRX header')
+        self.archive_size += len(chunk)
+        if len(chunk) >= ZIP_TAIL_SIZE:
+            self.tail = bytearray(chunk[-ZIP_TAIL_SIZE:])
+        else:
+            self.tail += chunk
+            del self.tail[:-ZIP_TAIL_SIZE]
+
+    def check_header(self):
+        """Check the CRX header once it is complete. Return what follows it
+        in the data written so far, or None if it isn't complete yet."""
+        header = self.header
+        prefix = get_crx_header_size(header)
+        if prefix is None:
+            return None
+        version, size = prefix
+        if size > MAX_CRX_HEADER_SIZE:
+            raise VerificationError('CRX header too large')
+        if len(header) < size:
+            return None
+
+        if version == 3:
+            crx_id = self.check_crx3_header(header[12:size])
+        else:
+            key_size, = struct.unpack_from('<I', header, 8)
+            if not key_size or size == 16 + key_size:
+                raise VerificationError('unsigned CRX file')
+            crx_id = hashlib.sha256(header[16:16 + key_size]).digest()[:16]
+        if get_ext_id(crx_id) != self.ext_id:
+            raise VerificationError('CRX file of another extension')
+        self.header_size = size
+        self.header = None
+        return header[size:]
+
+    def check_crx3_header(self, data):
+        """Return the crx id in the protobuf CrxFileHeader data."""
+        proofs = 0
+        crx_id = None
+        for number, value in get_proto_fields(data):
+            # sha256_with_rsa and sha256_with_ecdsa proofs
+            if number in (2, 3):
+                proofs += 1
+            # signed_header_data, a SignedData message holding the crx_id
+            elif number == 10000:
+                for inner_number, inner_value in get_proto_fields(value):
+                    if inner_number == 1:
+                        crx_id = inner_value
+        if not proofs:
+            raise VerificationError('unsigned CRX file')
+        if crx_id is None or len(crx_id) != 16:
+            raise VerificationError('CRX header without extension id')
+        return crx_id
+
+    def finish(self, file_info):
+        """Check the end of the archive and compare the FileInfo object
+        file_info of the complete file with what is expected."""
+        if self.header_size is None:
+            raise VerificationError('incomplete CRX header')
+        if len(self.archive_start) < 4:
+            raise VerificationError('no zip archive after the CRX header')
+        self.check_archive_end()
+        check_file_info(self.expected, file_info)
+
+    def check_archive_end(self):
+        tail = self.tail
+        pos = len(tail) - 22
+        if pos < 0:
+            raise VerificationError('zip archive is truncated')
+        while True:
+            pos = tail.rfind(b'PK\x05\x06', 0, pos + 4)
+            if pos < 0:
+                raise VerificationError('zip archive is truncated')
+            comment_size = struct.unpack_from('<H', tail, pos + 20)[0]
+            if pos + 22 + comment_size == len(tail):
+                break
+            pos -= 1
+        entries, cd_size, cd_offset = struct.unpack_from('<HII', tail,
+                                                         pos + 10)
+        # zip64 archives keep the real values in another record
+        if entries == 0xffff or cd_offset == 0xffffffff:
+            return
+        end_offset = self.archive_size - (len(tail) - pos)
+        if not entries or cd_offset + cd_size != end_offset:
+            raise VerificationError('damaged zip archive')
+        cd_pos = pos - cd_size
+        if cd_pos >= 0 and tail[cd_pos:cd_pos + 4] != b'PK\x01\x02':
+            raise VerificationError('damaged zip archive')
+
+
+CrxManifest = namedtuple('CrxManifest', ['version', 'name'])
+
+
+class CrxArchive(object):
+    """The zip archive in the memory-mapped extension file data. Only the
+    CRX header and the central directory are read when it is created,
+    entries are read when they are asked for. The rest of the file is never
+    touched, so this is about as fast for large files as for small ones.
+    Raise VerificationError if the file is damaged."""
+    def __init__(self, data):
+        self.data = data
+        prefix = get_crx_header_size(data[:16])
+        if prefix is None:
+            raise VerificationError('incomplete CRX header')
+        self.start = prefix[1]
+        self.entries = self.read_directory()
+
+    def read_directory(self):
+        """Return a dict mapping the name of every entry to its compression
+        method, compressed size and offset."""
+        data = self.data
+        end = data.rfind(b'PK\x05\x06',
+                         max(self.start, len(data) - ZIP_TAIL_SIZE))
+        if end < 0:
+            raise VerificationError('zip archive is truncated')
+        count, _, offset = struct.unpack_from('<HII', data, end + 10)
+        if count == 0xffff or offset == 0xffffffff:
+            raise VerificationError('zip64 archives are not supported')
+        pos = self.start + offset
+        entries = {}
+        for _ in range(count):
+            if data[pos:pos + 4] != b'PK\x01\x02':
+                raise VerificationError('damaged zip archive')
+            method, = struct.unpack_from('<H', data, pos + 10)
+            size, = struct.unpack_from('<I', data, pos + 20)
+            name_size, extra_size, comment_size = struct.unpack_from(
+                '<HHH', data, pos + 28)
+            entry_offset, = struct.unpack_from('<I', data, pos + 42)
+            name = data[pos + 46:pos + 46 + name_size].decode('utf-8',
+                                                              'replace')
+            entries[name] = (method, size, entry_offset)
+            pos += 46 + name_size + extra_size + comment_size
+        return entries
+
+    def read(self, name):
+        """Return the content of the entry name or None if there is none."""
+        if name not in self.entries:
+            return None
+        method, size, offset = self.entries[name]
+        pos = self.start + offset
+        if self.data[pos:pos + 4] != b'PK\x03\x04':
+            raise VerificationError('damaged zip archive')
+        name_size, extra_size = struct.unpack_from('<HH', self.data, pos + 26)
+        pos += 30 + name_size + extra_size
+        content = self.data[pos:pos + size]
+        if method == 8:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+        elif method == 0:
+            return content
+        raise VerificationError(
+            'unsupported compression method {}'.format(method))
+
+    def read_json(self, name):
+        content = self.read(name)
+        if content is None:
+            return None
+        try:
+            return json.loads(content.decode('utf-8-sig'))
+        except ValueError:
+            raise VerificationError('{} is no valid JSON'.format(name))
+
+    def manifest(self):
+        """Return a CrxManifest for the extension. Names like
+        __MSG_appName__ are looked up in the messages of the default
+        locale."""
+        manifest = self.read_json('manifest.json')
+        if not isinstance(manifest, dict) or 'version' not in manifest:
+            raise VerificationError('no manifest.json with a version')
+        name = manifest.get('name')
+        match = re.match(r'__MSG_(\w+)__$', name or '')
+        if match and manifest.get('default_locale'):
+            messages = self.read_json('_locales/{}/messages.json'.format(
+                manifest['default_locale'])) or {}
+            for key, message in messages.items():
+                # message names aren't case-sensitive
+                if key.lower() == match.group(1).lower():
+                    name = message.get('message', name)
+        return CrxManifest(version=str(manifest['version']), name=name)
+
+
+def read_crx_manifest(path):
+    """Return a CrxManifest for the extension file at path, which is
+    memory-mapped so that only the parts of it are read that CrxArchive
+    needs. Raise VerificationError if it can't be read."""
+    with open(path, 'rb') as crx_file:
+        try:
+            data = mmap.mmap(crx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped
+            raise VerificationError('empty extension file')
+        with data:
+            try:
+                return CrxArchive(data).manifest()
+            except (struct.error, zlib.error):
+                raise VerificationError('damaged zip archive')
+
+
+def version_from_filename(filename):
+    """Guess the version of an extension file from a filename like
+    extension_1_2_3.crx. Return None if there is no version in it."""
+    versions = re.findall(r'(\d[\d_]+)', filename)
+    if not versions:
+        return None
+    return versions[0].replace('_', '.')
+
+
+def get_file_version(path):
+    """Return the version in the manifest of the extension file at path or,
+    if it can't be read, the version in its filename."""
+    try:
+        return read_crx_manifest(path).version
+    except (OSError, VerificationError):
+        return version_from_filename(os.path.basename(path))
+
+
+def get_current_file(ext_path):
+    """Return the name of the extension file in ext_path that is currently in
+    use or None if there is none."""
+    for filename in os.listdir(ext_path):
+        if filename.endswith('.crx') and not filename.startswith('.'):
+            return filename
+    return None
+
+
+class CrxStore(object):
+    """Extension files shared by all profiles, and by all users whose configs
+    point at the same store_dir. Files are stored under their SHA-256 digest.
+    Each is downloaded once and then hard linked into the extension
+    directories, or copied if linking isn't possible. Concurrent maninex
+    processes take a file lock per extension, so a file is never fetched
+    twice or left half-written.
+
+    The store_dir should be writable by every user sharing it, e.g. with
+    mode 1777. Stored files are readable by everyone and keep their owner
+    when linked, so adapt_owner is only applied to copies."""
+    def __init__(self, path):
+        self.path = path
+        self.mode = stat.S_IMODE(os.stat(path).st_mode)
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, 'blobs', digest[:2], digest + '.crx')
+
+    def ref_path(self, ext_id, filename):
+        return os.path.join(self.path, 'refs', ext_id, filename)
+
+    def make_dir(self, path):
+        """Create the directory path (and its parents) with the permissions
+        of the store's root directory."""
+        if os.path.isdir(path):
+            return
+        parent = os.path.dirname(path)
+        if parent != self.path:
+            self.make_dir(parent)
+        try:
+            os.mkdir(path)
+            os.chmod(path, self.mode)
+        except FileExistsError:
+            pass
+
+    def lock(self, ext_id):
+        """Wait for and take the lock for ext_id. Return a file descriptor
+        that has to be passed to unlock."""
+        lock_dir = os.path.join(self.path, 'locks')
+        self.make_dir(lock_dir)
+        lock_fd = os.open(os.path.join(lock_dir, ext_id + '.lock'),
+                          os.O_RDONLY | os.O_CREAT, 0o666)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        return lock_fd
+
+    def unlock(self, lock_fd):
+        os.close(lock_fd)
+
+    @contextmanager
+    def locked(self, ext_id):
+        lock_fd = self.lock(ext_id)
+        try:
+            yield
+        finally:
+            self.unlock(lock_fd)
+
+    def lookup(self, ext_id, filename):
+        """Return a FileInfo object for the stored file filename of ext_id or
+        None if it isn't stored yet."""
+        try:
+            with open(self.ref_path(ext_id, filename)) as ref_file:
+                digest = ref_file.read().strip()
+            size = os.path.getsize(self.blob_path(digest))
+        except FileNotFoundError:
+            return None
+        return FileInfo(size=size, sha256=digest)
+
+    def new_file(self, filename):
+        """Return a PartialFile to download a file into, which has to be
+        passed to add."""
+        blob_dir = os.path.join(self.path, 'blobs')
+        self.make_dir(blob_dir)
+        return PartialFile(os.path.join(blob_dir, filename), chown=False)
+
+    def add(self, ext_id, filename, part_file):
+        """Store the completely written part_file as filename of ext_id and
+        return a FileInfo object for it. Identical files are only stored
+        once."""
+        digest = part_file.hash.hexdigest()
+        blob_path = self.blob_path(digest)
+        self.make_dir(os.path.dirname(blob_path))
+        if os.path.exists(blob_path):
+            part_file.discard()
+            file_info = FileInfo(size=part_file.size, sha256=digest)
+        else:
+            os.chmod(part_file.temp_path, 0o644)
+            file_info = part_file.commit(blob_path)
+
+        ref_path = self.ref_path(ext_id, filename)
+        self.make_dir(os.path.dirname(ref_path))
+        ref_file = PartialFile(ref_path, chown=False)
+        ref_file.write(digest.encode())
+        os.chmod(ref_file.temp_path, 0o644)
+        ref_file.commit()
+        return file_info
+
+    def fetch(self, ext_id, filename, fetch):
+        """Return a FileInfo object for the file filename of ext_id. If it
+        isn't stored yet, it is downloaded first by calling fetch with the
+        PartialFile to write it to."""
+        with self.locked(ext_id):
+            file_info = self.lookup(ext_id, filename)
+            if file_info is not None:
+                return file_info
+            part_file = self.new_file(filename)
+            try:
+                fetch(part_file)
+            except BaseException:
+                part_file.discard()
+                raise
+            return self.add(ext_id, filename, part_file)
+
+    def link(self, file_info, path):
+        """Atomically replace path with the stored file described by
+        file_info."""
+        blob_path = self.blob_path(file_info.sha256)
+        directory, filename = os.path.split(path)
+        temp_path = os.path.join(directory, '.{}.{}.part'.format(
+            filename, uuid.uuid4().hex[:8]))
+        try:
+            os.link(blob_path, temp_path)
+        except OSError:
+            # different file systems or a file owned by another user
+            part_file = PartialFile(path)
+            with open(blob_path, 'rb') as blob_file:
+                for chunk in iter(partial(blob_file.read, CHUNK_SIZE), b''):
+                    part_file.write(chunk)
+            part_file.commit()
+        else:
+            os.replace(temp_path, path)
+            sync_dir(directory)
+
+
+def get_store(config):
+    """Return the CrxStore set up in config or None if there is none. Raise
+    ConfigError if store_dir can't be used."""
+    store_dir = config.get('settings', 'store_dir', fallback=None)
+    if not store_dir:
+        return None
+    store_dir = get_real_path(store_dir)
+    try:
+        os.makedirs(store_dir, exist_ok=True)
+    except OSError:
+        pass
+    if not os.access(store_dir, os.W_OK | os.X_OK):
+        raise ConfigError("""The store_dir set in maninex.conf doesn't exist
+        or isn't writable.""")
+    return CrxStore(store_dir)
+
+
+class Archive(object):
+    """Replaced extension files of an extension directory, kept in its
+    ARCHIVE_DIR, out of the way of the browser and of directory scans. Like
+    in a CrxStore, files are stored once per SHA-256 digest under blobs/ and
+    refs/<ext_id>/<filename> holds the digest of every archived version.
+    The modification time of a ref tells when the version was archived."""
+    def __init__(self, ext_dir):
+        self.path = os.path.join(ext_dir, ARCHIVE_DIR)
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, 'blobs', digest[:2], digest + '.crx')
+
+    def ref_path(self, ext_id, filename=''):
+        return os.path.join(self.path, 'refs', ext_id, filename)
+
+    def make_dir(self, path):
+        """Create the directory path inside the archive (and its parents)
+        with the owner of the extension directory."""
+        if os.path.isdir(path):
+            return
+        parent = os.path.dirname(path)
+        if parent != os.path.dirname(self.path):
+            self.make_dir(parent)
+        make_ext_path(path)
+
+    def add(self, ext_id, path, digest=None):
+        """Move the file at path into the archive as a version of ext_id. A
+        file that is archived already is only referenced again. The file is
+        only hashed if its SHA-256 digest isn't given."""
+        if digest is None:
+            digest = hash_file(path).sha256
+        filename = os.path.basename(path)
+        if filename.endswith('.old'):
+            # a backup made by earlier versions of maninex or because the
+            # archive couldn't be written to
+            filename = filename[:-4]
+        # the ref goes first, so that a prune running at the same time
+        # doesn't take the file for garbage
+        self.make_dir(self.ref_path(ext_id))
+        ref_file = PartialFile(self.ref_path(ext_id, filename))
+        ref_file.write(digest.encode())
+        ref_file.commit()
+        blob_path = self.blob_path(digest)
+        try:
+            self.make_dir(os.path.dirname(blob_path))
+            if os.path.exists(blob_path):
+                os.remove(path)
+            else:
+                # extension folders and the archive share a file system, so
+                # this doesn't copy anything
+                os.rename(path, blob_path)
+        except OSError:
+            os.remove(self.ref_path(ext_id, filename))
+            raise
+
+    def versions(self):
+        """Return a dict mapping the id of every extension in the archive to
+        a list of (archived, filename, digest) tuples, newest first."""
+        versions = {}
+        try:
+            ext_ids = os.listdir(os.path.join(self.path, 'refs'))
+        except FileNotFoundError:
+            return versions
+        for ext_id in ext_ids:
+            entries = []
+            for entry in os.scandir(self.ref_path(ext_id)):
+                if entry.name.endswith('.part'):
+                    continue
+                with open(entry.path) as ref_file:
+                    digest = ref_file.read().strip()
+                entries.append((entry.stat().st_mtime_ns, entry.name,
+                                digest))
+            versions[ext_id] = sorted(entries, reverse=True)
+        return versions
+
+    def discard(self, ext_id):
+        """Forget all versions of ext_id. Their files are deleted by the
+        next prune."""
+        rmtree(self.ref_path(ext_id), ignore_errors=True)
+
+    def prune(self, keep_versions, max_size=0):
+        """Delete all but the keep_versions newest versions of every
+        extension. Then, if max_size is set, delete the oldest versions
+        until the archived files take up at most max_size bytes. Files no
+        version refers to anymore are deleted as well. Return the number of
+        bytes freed."""
+        versions = self.versions()
+        kept = []
+        for ext_id, entries in versions.items():
+            for entry in entries[keep_versions:]:
+                os.remove(self.ref_path(ext_id, entry[1]))
+            kept += [(archived, ext_id, filename, digest) for
+                     archived, filename, digest in entries[:keep_versions]]
+
+        sizes = {}
+        for digest in {entry[3] for entry in kept}:
+            try:
+                sizes[digest] = os.path.getsize(self.blob_path(digest))
+            except FileNotFoundError:
+                sizes[digest] = 0
+        total = sum(sizes.values())
+        users = Counter(entry[3] for entry in kept)
+        for archived, ext_id, filename, digest in sorted(kept):
+            if not max_size or total <= max_size:
+                break
+            os.remove(self.ref_path(ext_id, filename))
+            users[digest] -= 1
+            if not users[digest]:
+                total -= sizes[digest]
+
+        freed = 0
+        try:
+            blob_dirs = os.scandir(os.path.join(self.path, 'blobs'))
+        except FileNotFoundError:
+            return freed
+        with blob_dirs:
+            for blob_dir in blob_dirs:
+                for entry in os.scandir(blob_dir.path):
+                    if not users[entry.name[:-4]]:
+                        freed += entry.stat().st_size
+                        os.remove(entry.path)
+        for ext_id in versions:
+            try:
+                os.rmdir(self.ref_path(ext_id))
+            except OSError:
+                # there are versions left
+                pass
+        return freed
+
+
+def prune_archive(config_struct):
+    """Apply the keep_versions and archive_size settings of config_struct to
+    the Archive of its extension directory and return the number of bytes
+    freed."""
+    config = config_struct.config
+    return Archive(config_struct.ext_dir).prune(
+        get_number_setting(config, 'keep_versions', DEFAULT_KEEP_VERSIONS,
+                           minimum=0),
+        get_number_setting(config, 'archive_size', 0, minimum=0) *
+        1024 * 1024)
+
+
+class StateIndex(object):
+    """Record of the installed extensions of one extension directory, stored
+    as a JSON file in that directory, so that listing or checking extensions
+    doesn't require scanning every extension folder. Use transaction() to
+    change the index; load_index() is enough for reading it."""
+    def __init__(self, config_struct):
+        self.config_struct = config_struct
+        self.path = os.path.join(config_struct.ext_dir, STATE_FILE)
+        self.entries = {}
+        self.stamp = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, ext_id):
+        return ext_id in self.entries
+
+    def get(self, ext_id):
+        return self.entries.get(ext_id)
+
+    def get_hashed(self, ext_id):
+        """Like get(), but a digest left out by a rebuild without hashing is
+        filled in first."""
+        state = self.entries.get(ext_id)
+        if state is not None and state.sha256 is None:
+            file_info = hash_file(os.path.join(
+                self.config_struct.ext_dir, ext_id, state.filename))
+            state = state._replace(size=file_info.size,
+                                   sha256=file_info.sha256)
+            self.record(ext_id, state)
+        return state
+
+    def record(self, ext_id, state):
+        with self._lock:
+            self.entries[ext_id] = state
+
+    def discard(self, ext_id):
+        with self._lock:
+            self.entries.pop(ext_id, None)
+
+    def load(self):
+        """Read the index file. Return False if there is none."""
+        self.stamp = get_stamp(self.path)
+        try:
+            with open(self.path) as state_file:
+                data = json.load(state_file)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            # a damaged index is rebuilt like a missing one
+            return False
+
+        json_dir = self.config_struct.json_dir
+        self.entries = {}
+        for ext_id, entry in data.get('extensions', {}).items():
+            state = ExtState(**entry)
+            # entries pointing into another json_dir are stale
+            if os.path.dirname(state.json_path) == json_dir:
+                self.entries[ext_id] = state
+        return True
+
+    def save(self):
+        """Atomically replace the index file with the current entries."""
+        data = {'extensions': {ext_id: state._asdict() for ext_id, state
+                               in sorted(self.entries.items())}}
+        part_file = PartialFile(self.path)
+        part_file.write(json.dumps(data, indent=1).encode())
+        part_file.commit()
+        self.stamp = get_stamp(self.path)
+
+    def rebuild(self, hashing=True):
+        """Replace all entries with what is actually found on disk. Without
+        hashing, the digests are left out until get_hashed() needs them."""
+        entries = {}
+        json_dir = self.config_struct.json_dir
+        ext_dir = self.config_struct.ext_dir
+        jsons = get_existing_jsons(json_dir)
+        for ext_id in get_existing_folders(ext_dir):
+            ext_path = os.path.join(ext_dir, ext_id)
+            filename = get_current_file(ext_path)
+            if ext_id not in jsons or filename is None:
+                continue
+            path = os.path.join(ext_path, filename)
+            if hashing:
+                file_info = hash_file(path)
+            else:
+                file_info = FileInfo(size=os.path.getsize(path), sha256=None)
+            entries[ext_id] = ExtState(
+                version=get_local_version(ext_dir, ext_id),
+                filename=filename,
+                size=file_info.size,
+                sha256=file_info.sha256,
+                json_path=os.path.join(json_dir, ext_id + '.json'))
+        self.entries = entries
+
+    @contextmanager
+    def transaction(self):
+        """Lock the index against other maninex processes, load it (or build
+        it from disk if it doesn't exist) and save it when leaving the
+        block. The file isn't read again if it is unchanged since this object
+        last read or wrote it."""
+        lock_path = self.path + '.lock'
+        with open(lock_path, 'a') as lock_file:
+            adapt_owner(lock_path)
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.stamp is None or self.stamp != get_stamp(self.path):
+                if not self.load():
+                    self.rebuild()
+            try:
+                yield self
+            finally:
+                self.save()
+
+
+def get_stamp(path):
+    """Return something that changes whenever the file at path is replaced or
+    written to, or None if it doesn't exist."""
+    try:
+        file_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
+
+def load_index(config_struct):
+    """Return the StateIndex of config_struct for reading. If there is no
+    index file yet, it is built in memory from what is found on disk, and
+    files are only hashed when their digest is needed."""
+    index = StateIndex(config_struct)
+    if not index.load():
+        index.rebuild(hashing=False)
+    return index
+
+
+def get_installed_version(config_struct, ext_id, index=None):
+    """Return the installed version of ext_id, looking it up in index if
+    given. Raise FileNotFoundError if the extension isn't installed."""
+    if index is None:
+        return get_local_version(config_struct.ext_dir, ext_id)
+    state = index.get(ext_id)
+    if state is None:
+        raise FileNotFoundError(ext_id)
+    return state.version
+
+
+def get_installed_file_info(config_struct, ext_id, index=None):
+    """Return a FileInfo object for the installed file of ext_id, taken from
+    index if it is given and by hashing the file otherwise."""
+    state = None if index is None else index.get_hashed(ext_id)
+    if state is not None:
+        return FileInfo(size=state.size, sha256=state.sha256)
+    ext_path = os.path.join(config_struct.ext_dir, ext_id)
+    return hash_file(os.path.join(ext_path, get_current_file(ext_path)))
+
+
+def get_lock_path(config_file):
+    """Return the path of the lockfile belonging to config_file."""
+    return os.path.splitext(config_file)[0] + '.lock'
+
+
+def read_lock(path):
+    """Return a dict mapping the id of every extension in the lockfile at
+    path to an UpdateInfo object. Raise OSError or ValueError if it can't be
+    read."""
+    with open(path) as lock_file:
+        data = json.load(lock_file)
+    try:
+        return {ext_id: UpdateInfo(ext_id=ext_id, **entry)
+                for ext_id, entry in data['extensions'].items()}
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError('damaged lockfile')
+
+
+def write_lock(path, lock):
+    """Atomically replace the lockfile at path with the UpdateInfo objects
+    in the dict lock."""
+    data = {'extensions': {
+        ext_id: {'version': info.version, 'url': info.url,
+                 'sha256': info.sha256, 'size': info.size}
+        for ext_id, info in sorted(lock.items())}}
+    part_file = PartialFile(path)
+    part_file.write(json.dumps(data, indent=1).encode())
+    part_file.commit()
+
+
+def get_file_info(config_struct, update_info, session=None, index=None,
+                  store=None):
+    """Return a FileInfo object for the file of update_info. It is taken
+    from the installed file if that has the same version (from index if it
+    is given). Otherwise, the file is downloaded and checked, into store if
+    it is given and only for hashing otherwise."""
+    ext_id = update_info.ext_id
+    ext_path = os.path.join(config_struct.ext_dir, ext_id)
+    state = None if index is None else index.get(ext_id)
+    if state is not None and same_version(state.version,
+                                          update_info.version):
+        state = index.get_hashed(ext_id)
+        return FileInfo(size=state.size, sha256=state.sha256)
+    elif (index is None and has_files(ext_path) and
+            same_version(get_local_version(config_struct.ext_dir, ext_id),
+                         update_info.version)):
+        return hash_file(os.path.join(ext_path, get_current_file(ext_path)))
+
+    ext_obj = ExtensionOnline(config_struct, ext_id, update_info, session)
+    if store is not None:
+        return store.fetch(ext_id, ext_obj.filename, ext_obj.fetch)
+    part_file = PartialFile(os.path.join(config_struct.ext_dir,
+                                         ext_obj.filename))
+    try:
+        ext_obj.fetch(part_file)
+        return part_file.file_info()
+    finally:
+        part_file.discard()
+
+
+def lock_extension(config_struct, ext_ref, updates, lock, session=None,
+                   index=None, store=None):
+    """Record the UpdateInfo object of ext_ref in updates (as returned by
+    check_updates) in the dict lock and return an ExtResult describing the
+    outcome. If the update service didn't tell the SHA-256 digest and size
+    of the file, they are found with get_file_info."""
+    if ext_ref.idstr not in updates:
+        return ExtResult(ext_ref, 'failed',
+                         error="the update service couldn't be reached")
+    update_info = updates[ext_ref.idstr]
+    if update_info is None:
+        return ExtResult(ext_ref, 'not_found')
+    if update_info.sha256 is None or update_info.size is None:
+        file_info = get_file_info(config_struct, update_info, session, index,
+                                  store)
+        update_info = update_info._replace(sha256=file_info.sha256,
+                                           size=file_info.size)
+    lock[ext_ref.idstr] = update_info
+    return ExtResult(ext_ref, 'locked', update_info.version)
+
+
+def check_lock(config_struct, ext_ref, lock, index):
+    """Compare the installed file of ext_ref, as recorded in index, with its
+    UpdateInfo object in the dict lock without going online. Return an
+    ExtResult with the installed version whose status is 'as_locked',
+    'not_as_locked', 'missing' or 'not_locked'."""
+    locked = lock.get(ext_ref.idstr)
+    state = index.get(ext_ref.idstr)
+    version = None if state is None else state.version
+    if locked is None:
+        return ExtResult(ext_ref, 'not_locked', version)
+    elif state is None:
+        return ExtResult(ext_ref, 'missing')
+    try:
+        # a cheap check that the file is still the one the index describes
+        size = os.path.getsize(os.path.join(
+            config_struct.ext_dir, ext_ref.idstr, state.filename))
+    except FileNotFoundError:
+        size = None
+    if (size != locked.size or
+            index.get_hashed(ext_ref.idstr).sha256 != locked.sha256):
+        return ExtResult(ext_ref, 'not_as_locked', version)
+    return ExtResult(ext_ref, 'as_locked', version)
 
 
 def get_exts_from_config(config):
@@ -187,108 +2281,1077 @@ def get_exts_from_config(config):
 
 def is_installed(config_struct, ext_id):
     """Check if extension with ext_id is installed."""
-    if (ext_id in get_existing_jsons(config_struct.json_dir) and
-            ext_id in get_existing_folders(config_struct.ext_dir)):
-            return True
-
-
-def install_extension(ext_obj):
-    download_ext(ext_obj.ext_path,
-                 ext_obj.ext_path_file,
-                 ext_obj.requests_object.content)
+    return (os.path.isfile(os.path.join(config_struct.json_dir,
+                                        ext_id + '.json')) and
+            has_files(os.path.join(config_struct.ext_dir, ext_id)))
+
+
+def make_plan(config_struct, index=None, scan=True, ext_refs=None):
+    """Compare the extensions in the config file with the json and extension
+    directories of config_struct and return a Plan. It lists the ExtRefs of
+    the extensions to install and of those to check for updates, and the
+    ids of folders and JSON files of extensions that aren't in the config
+    file as well as of JSON files without a folder. Each directory is read
+    once. If index is given, it tells which extensions are installed
+    instead of the files on disk, and the directories are only read if
+    scan is True. Otherwise, the lists of ids are None. Entries of the
+    extensions in question whose files are gone are dropped from index.
+    ext_refs replaces the extensions in the config file if it is given."""
+    if ext_refs is None:
+        ext_refs = list(get_exts_from_config(config_struct.config))
+    wanted = {ext_ref.idstr for ext_ref in ext_refs}
+    orphaned_folders = orphaned_jsons = dangling_jsons = None
+    if index is None or scan:
+        jsons = get_existing_jsons(config_struct.json_dir)
+        folders = get_existing_folders(config_struct.ext_dir,
+                                       check_files=index is None)
+        orphaned_folders = sorted(folders - wanted)
+        orphaned_jsons = sorted(jsons - wanted)
+        dangling_jsons = sorted(jsons - folders)
+    if index is None:
+        installed = jsons & folders
+        present = folders
+    else:
+        # extensions deleted by hand are still in the index
+        for ext_id in wanted & set(index.entries):
+            if not is_installed(config_struct, ext_id):
+                index.discard(ext_id)
+        installed = present = set(index.entries)
+    return Plan(
+        install=[ext_ref for ext_ref in ext_refs
+                 if ext_ref.idstr not in installed],
+        update=[ext_ref for ext_ref in ext_refs if ext_ref.idstr in present],
+        orphaned_folders=orphaned_folders, orphaned_jsons=orphaned_jsons,
+        dangling_jsons=dangling_jsons)
+
+
+def format_plan(plan):
+    """Return the lines describing plan."""
+    sections = [
+        ('To install', [ext_ref.name for ext_ref in plan.install]),
+        ('To check for updates', [ext_ref.name for ext_ref in plan.update]),
+        ('Folders to remove', plan.orphaned_folders),
+        ('JSON files to remove', [ext_id + '.json'
+                                  for ext_id in plan.orphaned_jsons]),
+        ('JSON files without a folder', [ext_id + '.json'
+                                         for ext_id in plan.dangling_jsons]),
+    ]
+    lines = []
+    for title, names in sections:
+        if names:
+            lines.append('{} ({}):'.format(title, len(names)))
+            lines.extend('    ' + name for name in names)
+    return lines or ['Nothing to do.']
+
+
+def install_extension(ext_obj, store=None):
+    """Download the extension in ext_obj, point its JSON file at it and
+    return an ExtState object describing it. If store is given, the file is
+    taken from (or first downloaded into) the store. Stored files have to
+    match what the update service or the lockfile announced, like downloaded
+    ones."""
+    if store is None:
+        file_info = download_ext(ext_obj.ext_path,
+                                 ext_obj.ext_path_file,
+                                 ext_obj.fetch)
+    else:
+        file_info = store.fetch(ext_obj.ext_id, ext_obj.filename,
+                                ext_obj.fetch)
+        check_file_info(ext_obj.expected, file_info)
+        make_ext_path(ext_obj.ext_path)
+        store.link(file_info, ext_obj.ext_path_file)
+    return point_json(ext_obj, file_info)
+
+
+def point_json(ext_obj, file_info):
+    """Point the JSON file of ext_obj at its newly installed file, which is
+    described by the FileInfo object file_info, and return an ExtState
+    object for it. The version is taken from the file's manifest, as the
+    browser ignores files whose version doesn't match."""
+    ext_obj.version = (get_file_version(ext_obj.ext_path_file) or
+                       ext_obj.version)
     create_json(ext_obj.json_path_file,
                 ext_obj.ext_path_file,
                 ext_obj.version)
-
-
-def process_extension_install(config_struct, ext_ref):
-    if not is_installed(config_struct, ext_ref.idstr):
-        ext_obj = ExtensionOnline(config_struct, ext_ref.idstr)
+    return ExtState(version=ext_obj.version, filename=ext_obj.filename,
+                    size=file_info.size, sha256=file_info.sha256,
+                    json_path=ext_obj.json_path_file)
+
+
+def process_extension_install(config_struct, ext_ref, session=None,
+                              index=None, cache=None, store=None,
+                              installed=None, update_info=None):
+    """Install a single extension unless it is already installed and return
+    an ExtResult describing the outcome. Unless installed says if the
+    extension is installed, index is used to find out if it is given and
+    the files on disk otherwise. index records the installation. Lookups
+    are cached in cache and files are shared through store if they are
+    given. If update_info is given, exactly its version is installed and
+    other installed versions are replaced by it."""
+    if installed is None and index is not None:
+        installed = (ext_ref.idstr in index and
+                     is_installed(config_struct, ext_ref.idstr))
+    elif installed is None:
+        installed = is_installed(config_struct, ext_ref.idstr)
+    if update_info is not None:
+        try:
+            local_ver = get_installed_version(config_struct, ext_ref.idstr,
+                                              index)
+        except FileNotFoundError:
+            local_ver = None
+        ext_obj = ExtensionOnline(config_struct, ext_ref.idstr, update_info,
+                                  session)
+        if installed and same_version(update_info.version, local_ver):
+            check_file_info(ext_obj.expected, get_installed_file_info(
+                config_struct, ext_ref.idstr, index))
+            return ExtResult(ext_ref, 'already_installed')
+        if installed:
+            state = update_extension(ext_obj, store)
+        else:
+            state = install_extension(ext_obj, store)
+        if index is not None:
+            index.record(ext_ref.idstr, state)
+        return ExtResult(ext_ref, 'updated' if installed else 'installed',
+                         ext_obj.version)
+    if not installed:
+        ext_obj = ExtensionOnline(config_struct, ext_ref.idstr,
+                                  session=session, cache=cache)
         if ext_obj.exists is False:
-            print('Extension "{}" not found.'.format(ext_ref.name))
+            return ExtResult(ext_ref, 'not_found')
         else:
-            install_extension(ext_obj)
-            print('Extension "{}" installed.'.format(ext_ref.name))
+            state = install_extension(ext_obj, store)
+            if index is not None:
+                index.record(ext_ref.idstr, state)
+            return ExtResult(ext_ref, 'installed', ext_obj.version)
     else:
-        print('Extension "{}" is already installed.'.format(ext_ref.name))
-
+        return ExtResult(ext_ref, 'already_installed')
+
+
+def archive_old_files(ext_path, current_filename, old_state=None):
+    """Move all files in ext_path except current_filename (and unfinished
+    downloads) to the Archive of the extension directory. The digest of the
+    file described by the ExtState object old_state is taken from it if its
+    size still matches. Files that can't be archived (e.g. because another
+    user owns the archive) are kept as backups with the suffix .old, which
+    the browser ignores, and archived by the next update."""
+    archive = Archive(os.path.dirname(ext_path))
+    for filename in os.listdir(ext_path):
+        if filename != current_filename and not filename.endswith('.part'):
+            path = os.path.join(ext_path, filename)
+            digest = None
+            if (old_state is not None and old_state.filename == filename and
+                    old_state.size == os.path.getsize(path)):
+                digest = old_state.sha256
+            try:
+                archive.add(os.path.basename(ext_path), path, digest)
+            except OSError:
+                # the update itself is done already
+                if not filename.endswith('.old'):
+                    os.replace(path, path + '.old')
+
+
+def update_extension(ext_obj, store=None):
+    """Update extension in ext_obj and archive the old extension file.
+    Return an ExtState object describing the new file."""
+    state = install_extension(ext_obj, store)
+    archive_old_files(ext_obj.ext_path, ext_obj.filename)
+    discard_staged(ext_obj.ext_path)
+    return state
+
+
+def get_staging_path(ext_path):
+    """Return the directory in which updates of the extension in ext_path
+    are staged."""
+    ext_dir, ext_id = os.path.split(ext_path)
+    return os.path.join(ext_dir, STAGING_DIR, ext_id)
+
+
+def read_staged(ext_path):
+    """Return the ExtState object of the update staged for the extension in
+    ext_path or None if there is none."""
+    try:
+        with open(os.path.join(get_staging_path(ext_path),
+                               STAGED_FILE)) as staged_file:
+            return ExtState(**json.load(staged_file))
+    except (FileNotFoundError, ValueError, TypeError):
+        return None
+
+
+def discard_staged(ext_path):
+    """Throw away the update staged for the extension in ext_path, if
+    any."""
+    rmtree(get_staging_path(ext_path), ignore_errors=True)
+
+
+def stage_extension(ext_obj, store=None):
+    """Download the extension in ext_obj into the staging area, where the
+    browser doesn't see it, replacing any update staged for it before.
+    Return an ExtState object describing the staged file. Nothing is
+    downloaded if the same file is staged already."""
+    state = read_staged(ext_obj.ext_path)
+    if state is not None and state.filename == ext_obj.filename:
+        ext_obj.version = state.version
+        return state
+    discard_staged(ext_obj.ext_path)
+    staging_path = get_staging_path(ext_obj.ext_path)
+    path = os.path.join(staging_path, ext_obj.filename)
+    make_ext_path(os.path.dirname(staging_path))
+    if store is None:
+        file_info = download_ext(staging_path, path, ext_obj.fetch)
+    else:
+        file_info = store.fetch(ext_obj.ext_id, ext_obj.filename,
+                                ext_obj.fetch)
+        make_ext_path(staging_path)
+        store.link(file_info, path)
+    ext_obj.version = get_file_version(path) or ext_obj.version
+    state = ExtState(version=ext_obj.version, filename=ext_obj.filename,
+                     size=file_info.size, sha256=file_info.sha256,
+                     json_path=ext_obj.json_path_file)
+    # written last, so that only complete downloads count as staged
+    part_file = PartialFile(os.path.join(staging_path, STAGED_FILE))
+    part_file.write(json.dumps(state._asdict()).encode())
+    part_file.commit()
+    return state
+
+
+def get_staged(ext_dir):
+    """Return the ids of all extensions with a staged update in ext_dir."""
+    try:
+        return sorted(ext_id for ext_id in os.listdir(
+            os.path.join(ext_dir, STAGING_DIR))
+            if EXT_ID_PATTERN.fullmatch(ext_id))
+    except FileNotFoundError:
+        return []
+
+
+def switch_file(config_struct, ext_ref, state, index=None):
+    """Point the JSON file of ext_ref at the file described by the ExtState
+    object state, which has to be in its folder already, move the file that
+    was in use before to the Archive and record the change in index if it is
+    given. The digest of that file is taken from index, if it has one."""
+    ext_path = os.path.join(config_struct.ext_dir, ext_ref.idstr)
+    old_state = None if index is None else index.get(ext_ref.idstr)
+    state = state._replace(json_path=os.path.join(config_struct.json_dir,
+                                                  ext_ref.idstr + '.json'))
+    create_json(state.json_path, os.path.join(ext_path, state.filename),
+                state.version)
+    archive_old_files(ext_path, state.filename, old_state)
+    if index is not None:
+        index.record(ext_ref.idstr, state)
+
+
+def activate_extension(config_struct, ext_ref, index=None):
+    """Make the update staged for ext_ref the version in use and return an
+    ExtResult describing the outcome. Nothing is downloaded: the staged file
+    is renamed into the extension's folder and its JSON file is rewritten.
+    The activation is recorded in index if it is given."""
+    ext_path = os.path.join(config_struct.ext_dir, ext_ref.idstr)
+    state = read_staged(ext_path)
+    if state is None or not has_files(ext_path):
+        # incomplete, or the extension was removed since
+        discard_staged(ext_path)
+        return ExtResult(ext_ref, 'not_installed')
+    try:
+        local_ver = get_installed_version(config_struct, ext_ref.idstr,
+                                          index)
+    except FileNotFoundError:
+        local_ver = None
+    if same_version(state.version, local_ver):
+        # updated in the meantime
+        discard_staged(ext_path)
+        return ExtResult(ext_ref, 'up_to_date', local_ver)
+    os.replace(os.path.join(get_staging_path(ext_path), state.filename),
+               os.path.join(ext_path, state.filename))
+    switch_file(config_struct, ext_ref, state, index)
+    discard_staged(ext_path)
+    return ExtResult(ext_ref, 'activated', state.version)
+
+
+def rollback_extension(config_struct, ext_ref, index=None):
+    """Go back to the newest archived version of ext_ref whose file differs
+    from the one in use and return an ExtResult describing the outcome. The
+    file that was in use goes to the Archive, so rolling back twice returns
+    to it. The change is recorded in index if it is given."""
+    ext_path = os.path.join(config_struct.ext_dir, ext_ref.idstr)
+    if not has_files(ext_path):
+        return ExtResult(ext_ref, 'not_installed')
+    current = get_current_file(ext_path)
+    archive = Archive(config_struct.ext_dir)
+    for _, filename, digest in archive.versions().get(ext_ref.idstr, []):
+        if filename != current:
+            break
+    else:
+        return ExtResult(ext_ref, 'nothing_archived')
+    blob_path = archive.blob_path(digest)
+    part_file = PartialFile(os.path.join(ext_path, filename))
+    with open(blob_path, 'rb') as blob_file:
+        for chunk in iter(partial(blob_file.read, CHUNK_SIZE), b''):
+            part_file.write(chunk)
+    file_info = part_file.commit()
+    os.remove(archive.ref_path(ext_ref.idstr, filename))
+    path = os.path.join(ext_path, filename)
+    state = ExtState(version=get_file_version(path), filename=filename,
+                     size=file_info.size, sha256=file_info.sha256,
+                     json_path=None)
+    switch_file(config_struct, ext_ref, state, index)
+    return ExtResult(ext_ref, 'rolled_back', state.version)
+
+
+def lower_priority():
+    """Let every other process on the machine go first: lower the CPU
+    priority and, where the ioprio_set system call is known, switch to the
+    idle I/O scheduling class, which only gets to use the disk when nobody
+    else does."""
+    os.nice(LOW_PRIORITY_NICENESS)
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None:
+        return
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.syscall(number, IOPRIO_WHO_PROCESS, 0,
+                     IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    except (OSError, AttributeError):
+        # the CPU priority is lowered at least
+        pass
 
-def update_extension(ext_obj):
-    """Update extension in ext_obj and rename old extension file."""
-    install_extension(ext_obj)
-    files = os.listdir(os.path.join(ext_obj.ext_path))
-    for filename in files:
-        if (filename != ext_obj.filename and not filename.endswith('.old')):
-            f = os.path.join(ext_obj.ext_path, filename)
-            os.rename(f, f + '.old')
 
+def process_extension_update(config_struct, ext_ref, dir_list, updates=None,
+                             session=None, index=None, cache=None,
+                             store=None, stage=False):
+    """Look up and apply updates for a single extension and return an
+    ExtResult describing the outcome. If updates (as returned by
+    check_updates) contains the extension, it is only downloaded if its
+    version differs from the local one. If index is given, the local version
+    is read from it and updates are recorded in it. Lookups are cached in
+    cache and files are shared through store if they are given. If stage is
+    True, updates are only staged (see stage_extension)."""
+    def update(ext_obj):
+        if stage:
+            stage_extension(ext_obj, store)
+            return ExtResult(ext_ref, 'staged', ext_obj.version)
+        state = update_extension(ext_obj, store)
+        if index is not None:
+            index.record(ext_ref.idstr, state)
+        return ExtResult(ext_ref, 'updated', ext_obj.version)
 
-def process_extension_update(config_struct, ext_ref, dir_list):
-    """Look up and apply updates for a single extension. Afterwards, print the
-    result."""
     if ext_ref.idstr in dir_list:
-        ext_obj = ExtensionOnline(config_struct, ext_ref.idstr)
+        if updates is not None and ext_ref.idstr in updates:
+            update_info = updates[ext_ref.idstr]
+            if update_info is None:
+                return ExtResult(ext_ref, 'not_found')
+            try:
+                local_ver = get_installed_version(config_struct,
+                                                  ext_ref.idstr, index)
+            except FileNotFoundError:
+                local_ver = None
+            if same_version(update_info.version, local_ver):
+                return ExtResult(ext_ref, 'up_to_date', local_ver)
+            return update(ExtensionOnline(config_struct, ext_ref.idstr,
+                                          update_info, session))
+
+        ext_obj = ExtensionOnline(config_struct, ext_ref.idstr,
+                                  session=session, cache=cache)
+        if ext_obj.exists is False:
+            return ExtResult(ext_ref, 'not_found')
         try:
-            local_ver = get_local_version(config_struct.ext_dir, ext_ref.idstr)
-            if ext_obj.version != local_ver:
-                update_extension(ext_obj)
-                print('Extension "{}" updated.'.format(ext_ref.name))
+            local_ver = get_installed_version(config_struct, ext_ref.idstr,
+                                              index)
+            if not same_version(ext_obj.version, local_ver):
+                return update(ext_obj)
             else:
-                print('Extension "{}" up-to-date.'.format(ext_ref.name))
+                return ExtResult(ext_ref, 'up_to_date', local_ver)
         except FileNotFoundError:
-            update_extension(ext_obj)
-            print('Extension "{}" updated.'.format(ext_ref.name))
+            return update(ext_obj)
     else:
-        print('Extension "{}" in config but not installed. '
-              'Skipping...'.format(ext_ref.name))
+        return ExtResult(ext_ref, 'not_installed')
+
+
+def install_extensions(config_struct, jobs, index=None, cache=None,
+                       store=None, session=None, ext_refs=None, lock=None,
+                       max_rate=None):
+    """Install all extensions listed in config_struct (or the ExtRefs in
+    ext_refs) that aren't installed yet, processing up to jobs extensions at
+    the same time. Yield an ExtResult for every extension. Installations are
+    recorded in index if one is given, lookups are cached in cache and files
+    are shared through store if they are given. Requests are sent through
+    session if it is given and through a new session otherwise, whose
+    downloads share max_rate bytes per second (see get_rate_setting). If
+    lock (as returned by read_lock) is given, the locked versions are
+    installed and extensions missing from it are skipped."""
+    if ext_refs is None:
+        ext_refs = list(get_exts_from_config(config_struct.config))
+    missing = {ext_ref.idstr for ext_ref in make_plan(
+        config_struct, index, scan=False, ext_refs=ext_refs).install}
+    max_rate = get_rate_setting(config_struct.config, 'max_rate', max_rate)
+    with use_session(session, jobs, max_rate) as session:
+        def install(ext_ref):
+            if lock is not None and ext_ref.idstr not in lock:
+                return ExtResult(ext_ref, 'not_locked')
+            return process_extension_install(
+                config_struct, ext_ref, session=session, index=index,
+                cache=cache, store=store,
+                installed=ext_ref.idstr not in missing,
+                update_info=None if lock is None else lock[ext_ref.idstr])
+
+        yield from run_jobs(install, ext_refs, jobs)
+
+
+def update_extensions(config_struct, jobs, index=None, cache=None,
+                      store=None, session=None, ext_refs=None, stage=False,
+                      max_rate=None):
+    """Update all extensions listed in config_struct (or the ExtRefs in
+    ext_refs) that are installed, processing up to jobs extensions at the
+    same time. Yield an ExtResult for every extension. If index is given, it
+    is used instead of scanning the extension directory and records all
+    updates. Lookups are cached in cache and files are shared through store
+    if they are given. Requests are sent through session if it is given and
+    through a new session otherwise, whose downloads share max_rate bytes
+    per second. If stage is True, updates are only staged. Afterwards, the
+    Archive is pruned."""
+    if ext_refs is None:
+        ext_refs = list(get_exts_from_config(config_struct.config))
+    installed = make_plan(config_struct, index, scan=False,
+                          ext_refs=ext_refs).update
+    dir_list = {ext_ref.idstr for ext_ref in installed}
+    max_rate = get_rate_setting(config_struct.config, 'max_rate', max_rate)
+    with use_session(session, jobs, max_rate) as session:
+        updates = check_updates(config_struct,
+                                [ext_ref.idstr for ext_ref in installed],
+                                session, cache)
+        yield from run_jobs(partial(process_extension_update, config_struct,
+                                    dir_list=dir_list, updates=updates,
+                                    session=session, index=index,
+                                    cache=cache, store=store, stage=stage),
+                            ext_refs, jobs)
+    prune_archive(config_struct)
+
+
+class ConfigWatcher(object):
+    """Notice changes of the file at path. inotify is used to wake up as
+    soon as something happens in its directory if it's available (and
+    use_inotify is True). Otherwise, the file is checked every
+    POLL_INTERVAL seconds."""
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    def __init__(self, path, use_inotify=True):
+        self.path = path
+        self.stamp = get_stamp(path)
+        self.inotify_fd = self.watch() if use_inotify else None
+
+    def watch(self):
+        """Return an inotify file descriptor watching the directory of path
+        or None if inotify isn't available."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if inotify_fd < 0:
+            return None
+        mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO |
+                self.IN_CREATE | self.IN_DELETE)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if libc.inotify_add_watch(inotify_fd, os.fsencode(directory),
+                                  mask) < 0:
+            os.close(inotify_fd)
+            return None
+        return inotify_fd
+
+    def changed(self):
+        """Check if the file changed since the last call."""
+        stamp = get_stamp(self.path)
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
+
+    def wait(self, timeout, wakeup_fd=None):
+        """Wait up to timeout seconds for something to happen to the file.
+        Return early if wakeup_fd becomes readable."""
+        read_fds = [fd for fd in (self.inotify_fd, wakeup_fd)
+                    if fd is not None]
+        if self.inotify_fd is None:
+            timeout = min(timeout, POLL_INTERVAL)
+        readable, _, _ = select.select(read_fds, [], [], max(timeout, 0))
+        for fd in readable:
+            # the events themselves don't matter, changed() tells if the
+            # file is different
+            drain(fd)
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+def drain(fd):
+    """Read everything available from the non-blocking file descriptor fd."""
+    data = b''
+    while True:
+        try:
+            chunk = os.read(fd, 4096)
+        except BlockingIOError:
+            break
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class Daemon(object):
+    """Keep the extensions of all profiles installed and up-to-date. The
+    connection pool, the state index and the lookup cache stay in memory
+    between runs. Extensions added to the config file are installed as soon
+    as the file changes. SIGHUP rereads the config file and all state from
+    disk, SIGTERM and SIGINT stop the daemon once the current run is
+    finished."""
+    def __init__(self, jobs=None, max_rate=None):
+        self.jobs = jobs
+        self.max_rate = max_rate
+        self.profiles = []
+        self.states = {}
+        self.session = None
+        self.pool_size = None
+        self.stopping = False
+        self.reloading = False
+
+    def load_config(self, reset=False):
+        """Read the config file and set up everything that depends on it.
+        Keep the state of profiles that didn't change unless reset is
+        True."""
+        self.profiles = get_checked_profiles(os.W_OK)
+        config = self.profiles[0].config
+        self.store = get_store(config)
+        self.interval = get_number_setting(config, 'update_interval',
+                                           DEFAULT_UPDATE_INTERVAL)
+        self.jitter = get_number_setting(config, 'update_jitter',
+                                         DEFAULT_UPDATE_JITTER, minimum=0)
+        pool_size = max(get_jobs(config_struct.config, self.jobs)
+                        for config_struct in self.profiles)
+        if pool_size != self.pool_size:
+            if self.session is not None:
+                self.session.close()
+            self.session = make_session(pool_size)
+            self.pool_size = pool_size
+        max_rate = get_rate_setting(config, 'max_rate', self.max_rate)
+        if max_rate is None:
+            self.session.rate_limit = None
+        elif (self.session.rate_limit is None or
+                self.session.rate_limit.rate != max_rate):
+            self.session.rate_limit = RateLimit(max_rate)
+
+        states = {}
+        for config_struct in self.profiles:
+            key = (config_struct.ext_dir, config_struct.json_dir)
+            if key in self.states and not reset:
+                index = self.states[key][0]
+                index.config_struct = config_struct
+            else:
+                index = StateIndex(config_struct)
+            cache = ResolveCache(config_struct)
+            cache.load()
+            states[key] = (index, cache)
+        self.states = states
+
+    def run_all(self, function):
+        """Run install_extensions or update_extensions for all profiles and
+        print the results that changed something."""
+        for config_struct in self.profiles:
+            index, cache = self.states[(config_struct.ext_dir,
+                                        config_struct.json_dir)]
+            with index.transaction():
+                for result in function(config_struct,
+                                       get_jobs(config_struct.config,
+                                                self.jobs),
+                                       index, cache, self.store,
+                                       session=self.session):
+                    if result.status not in QUIET_STATUSES:
+                        print(format_result(result), flush=True)
+                cache.save()
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
+
+    def next_update(self):
+        return time.monotonic() + self.interval + random.uniform(0,
+                                                                 self.jitter)
+
+    def run(self):
+        self.load_config()
+        watcher = ConfigWatcher(self.profiles[0].config_file)
+        # signals only set flags, so they have to wake up the main loop
+        wakeup_read, wakeup_write = os.pipe()
+        for fd in (wakeup_read, wakeup_write):
+            os.set_blocking(fd, False)
+        old_wakeup_fd = signal.set_wakeup_fd(wakeup_write)
+        old_handlers = {signum: signal.signal(signum, self.handle_signal)
+                        for signum in (signal.SIGTERM, signal.SIGINT,
+                                       signal.SIGHUP)}
+        print('maninex daemon started.', flush=True)
+        try:
+            self.run_all(install_extensions)
+            next_update = time.monotonic() + random.uniform(0, self.jitter)
+            while not self.stopping:
+                if self.reloading or watcher.changed():
+                    reset, self.reloading = self.reloading, False
+                    try:
+                        self.load_config(reset)
+                    except ConfigError as error:
+                        mline_print(str(error), file=sys.stderr)
+                        print('Keeping the previous configuration.',
+                              flush=True)
+                    else:
+                        print('Configuration reloaded.', flush=True)
+                        self.run_all(install_extensions)
+                elif time.monotonic() >= next_update:
+                    self.run_all(update_extensions)
+                    next_update = self.next_update()
+                else:
+                    watcher.wait(next_update - time.monotonic(),
+                                 wakeup_read)
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+            os.close(wakeup_read)
+            os.close(wakeup_write)
+            watcher.close()
+            self.session.close()
+        print('maninex daemon stopped.', flush=True)
+
+
+def remove_extension(config_struct, ext_ref, index=None):
+    """Delete the JSON file and the folder of ext_ref and return an
+    ExtResult describing the outcome. The removal is recorded in index if it
+    is given."""
+    removed = False
+    try:
+        # the browser stops loading the extension once the JSON file is gone
+        os.remove(os.path.join(config_struct.json_dir,
+                               ext_ref.idstr + '.json'))
+        removed = True
+    except FileNotFoundError:
+        pass
+    ext_path = os.path.join(config_struct.ext_dir, ext_ref.idstr)
+    if os.path.isdir(ext_path):
+        rmtree(ext_path)
+        removed = True
+    Archive(config_struct.ext_dir).discard(ext_ref.idstr)
+    if index is not None:
+        index.discard(ext_ref.idstr)
+    return ExtResult(ext_ref, 'removed' if removed else 'not_installed')
+
+
+class Manager(object):
+    """Install, update and remove extensions from Python code:
+
+        with Manager('/etc/maninex.conf') as manager:
+            for result in manager.install([ext_id]):
+                print(result.status, result.version, result.stats.bytes)
+
+    config is the path of a config file, a Configs object or a list of them
+    (one per profile) and defaults to the config file the command line
+    uses. Every call works on all profiles and returns a list of ExtResult
+    objects, whose stats attribute is an ExtStats object with the profile,
+    the downloaded bytes and the seconds spent in each phase. ids default to
+    the extensions in the config file, but any extension id can be given.
+    The connection pool, the state indexes and the lookup caches are kept
+    between calls until close is called. max_rate (in bytes per second)
+    overrides the max_rate setting. Settings that can't be used raise
+    ConfigError."""
+    def __init__(self, config=None, jobs=None, engine='threads',
+                 max_rate=None):
+        if config is None or isinstance(config, str):
+            self.profiles = get_profiles(config)
+        elif isinstance(config, Configs):
+            self.profiles = [config]
+        else:
+            self.profiles = list(config)
+        self.jobs = jobs
+        self.engine = engine
+        self.max_rate = max_rate
+        self.session = None
+        self.states = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def get_session(self):
+        """Return the session shared by all calls, creating it on first
+        use."""
+        if self.session is None:
+            config = self.profiles[0].config
+            self.session = make_session(
+                max(get_jobs(config_struct.config, self.jobs)
+                    for config_struct in self.profiles),
+                get_rate_setting(config, 'max_rate', self.max_rate))
+        return self.session
+
+    def get_state(self, config_struct):
+        """Return the StateIndex and ResolveCache of config_struct."""
+        key = (config_struct.ext_dir, config_struct.json_dir)
+        if key not in self.states:
+            cache = ResolveCache(config_struct)
+            cache.load()
+            self.states[key] = (StateIndex(config_struct), cache)
+        return self.states[key]
+
+    def get_ext_refs(self, config_struct, ids=None):
+        """Return ExtRefs for the extensions in ids, named like in the
+        config file where possible, or for all extensions in the config
+        file. Raise ValueError for ids that can't be extension ids."""
+        ext_refs = list(get_exts_from_config(config_struct.config))
+        if ids is None:
+            return ext_refs
+        names = {ext_ref.idstr: ext_ref for ext_ref in ext_refs}
+        for ext_id in ids:
+            if not EXT_ID_PATTERN.fullmatch(ext_id):
+                raise ValueError('{!r} is no extension id'.format(ext_id))
+        return [names.get(ext_id, ExtRef(name=ext_id[0:11], idstr=ext_id))
+                for ext_id in ids]
+
+    def run(self, action, ids=None, profiles=None, refresh=False,
+            stats=None, locked=False):
+        """Yield an ExtResult for every extension in ids in each of profiles
+        (by default all of them) as soon as action ('install', 'update',
+        'prefetch', 'activate', 'rollback' or 'remove') is done with it.
+        Statistics are collected in stats, a new Stats object by default. If
+        refresh is True, cached lookups are ignored. If locked is True,
+        installs follow the lockfile (see read_lock)."""
+        if action not in ('install', 'update', 'prefetch', 'activate',
+                          'rollback', 'remove'):
+            raise ValueError('unknown action {!r}'.format(action))
+        if stats is None:
+            stats = Stats(action)
+        for config_struct in profiles or self.profiles:
+            stats.profile = config_struct.profile
+            index, cache = self.get_state(config_struct)
+            cache.refresh = refresh
+            with collecting(stats), index.transaction():
+                if action == 'remove':
+                    yield from self.remove_all(config_struct, index, ids)
+                    continue
+                elif action == 'activate':
+                    yield from self.apply(
+                        activate_extension, config_struct, index,
+                        self.get_ext_refs(config_struct, ids or get_staged(
+                            config_struct.ext_dir)))
+                    continue
+                elif action == 'rollback':
+                    yield from self.apply(rollback_extension, config_struct,
+                                          index, self.get_ext_refs(
+                                              config_struct, ids))
+                    continue
+                yield from self.process(action, config_struct, index, cache,
+                                        self.get_ext_refs(config_struct, ids),
+                                        locked)
+                cache.save()
+
+    def process(self, action, config_struct, index, cache, ext_refs,
+                locked=False):
+        """Yield the results of installing, updating or prefetching
+        ext_refs. Prefetching and locked installs always use the threads
+        engine."""
+        install, update = get_engine(self.engine)
+        extra = {'ext_refs': ext_refs}
+        if action == 'prefetch':
+            update = partial(update_extensions, stage=True)
+        elif locked:
+            install = partial(install_extensions, lock=read_lock(
+                get_lock_path(config_struct.config_file)))
+        if self.engine == 'threads' or action == 'prefetch' or locked:
+            extra['session'] = self.get_session()
+        else:
+            extra['max_rate'] = self.max_rate
+        yield from (install if action == 'install' else update)(
+            config_struct, get_jobs(config_struct.config, self.jobs), index,
+            cache, get_store(config_struct.config), **extra)
+
+    def apply(self, function, config_struct, index, ext_refs):
+        """Yield the results of calling function (e.g. remove_extension)
+        for each of ext_refs, one after the other."""
+        for ext_ref in ext_refs:
+            with track(ext_ref) as record:
+                try:
+                    result = function(config_struct, ext_ref, index)
+                except OSError as error:
+                    result = ExtResult(ext_ref, 'failed', error=error)
+                record.set_result(result)
+            yield result._replace(stats=record)
+
+    def remove_all(self, config_struct, index, ids):
+        """Yield the results of removing the extensions in ids or, if ids is
+        None, of those that aren't in the config file."""
+        if ids is None:
+            # whatever the config file doesn't list goes, even names that
+            # aren't valid ids
+            plan = make_plan(config_struct)
+            ext_refs = [ExtRef(name=ext_id[0:11], idstr=ext_id) for ext_id in
+                        sorted(set(plan.orphaned_folders +
+                                   plan.orphaned_jsons))]
+        else:
+            ext_refs = self.get_ext_refs(config_struct, ids)
+        yield from self.apply(remove_extension, config_struct, index,
+                              ext_refs)
+
+    def install(self, ids=None, refresh=False, locked=False):
+        """Install the extensions in ids that aren't installed yet. If locked
+        is True, the versions in the lockfile are installed instead of the
+        latest ones, replacing other installed versions."""
+        return list(self.run('install', ids, refresh=refresh, locked=locked))
+
+    def update(self, ids=None, refresh=False):
+        """Update the extensions in ids that are installed."""
+        return list(self.run('update', ids, refresh=refresh))
+
+    def prefetch(self, ids=None, refresh=False):
+        """Download updates of the extensions in ids that are installed
+        without activating them."""
+        return list(self.run('prefetch', ids, refresh=refresh))
+
+    def activate(self, ids=None):
+        """Activate the updates staged for the extensions in ids or, by
+        default, all staged updates. Nothing is downloaded."""
+        return list(self.run('activate', ids))
+
+    def rollback(self, ids):
+        """Go back to the previous version of each extension in ids."""
+        return list(self.run('rollback', ids))
+
+    def remove(self, ids=None):
+        """Delete the files of the extensions in ids or, by default, of all
+        extensions that aren't in the config file. The config file isn't
+        changed."""
+        return list(self.run('remove', ids))
+
+    def status(self, ids=None, profiles=None):
+        """Return an ExtResult for every extension in ids in each of
+        profiles, with the status 'installed' and the installed version or
+        'not_installed'. Only the state indexes are read."""
+        results = []
+        for config_struct in profiles or self.profiles:
+            index = load_index(config_struct)
+            for ext_ref in self.get_ext_refs(config_struct, ids):
+                state = index.get(ext_ref.idstr)
+                if state is None:
+                    result = ExtResult(ext_ref, 'not_installed')
+                else:
+                    result = ExtResult(ext_ref, 'installed', state.version)
+                record = ExtStats(ext_ref, config_struct.profile)
+                record.set_result(result)
+                results.append(result._replace(stats=record))
+        return results
+
+    def lock(self, refresh=False):
+        """Look up the latest version of every extension in the config file
+        and write them, with their urls, sizes and SHA-256 digests, to the
+        lockfile next to the config file. Return an ExtResult for every
+        extension. The lockfile is left alone if any lookup failed."""
+        config_struct = self.profiles[0]
+        config = config_struct.config
+        _, cache = self.get_state(config_struct)
+        cache.refresh = refresh
+        ext_refs = self.get_ext_refs(config_struct)
+        session = self.get_session()
+        updates = check_updates(config_struct,
+                                [ext_ref.idstr for ext_ref in ext_refs],
+                                session, cache)
+        lock = {}
+        results = list(run_jobs(partial(
+            lock_extension, config_struct, updates=updates, lock=lock,
+            session=session, index=load_index(config_struct),
+            store=get_store(config)), ext_refs, get_jobs(config, self.jobs)))
+        cache.save()
+        if all(result.status != 'failed' for result in results):
+            write_lock(get_lock_path(config_struct.config_file), lock)
+        return results
+
+    def verify(self, ids=None, profiles=None):
+        """Compare the installed extensions in ids in each of profiles with
+        the lockfile (see check_lock) and return an ExtResult for each. Only
+        the state indexes and the lockfile are read."""
+        results = []
+        for config_struct in profiles or self.profiles:
+            lock = read_lock(get_lock_path(config_struct.config_file))
+            index = load_index(config_struct)
+            for ext_ref in self.get_ext_refs(config_struct, ids):
+                result = check_lock(config_struct, ext_ref, lock, index)
+                record = ExtStats(ext_ref, config_struct.profile)
+                record.set_result(result)
+                results.append(result._replace(stats=record))
+        return results
+
+    def plan(self, profiles=None):
+        """Return the Plan of each of profiles without changing anything."""
+        return [make_plan(config_struct, load_index(config_struct))
+                for config_struct in profiles or self.profiles]
+
+
+def prefetch_mode(jobs=None, refresh=False, max_rate=None):
+    """Download updates of all installed extensions into the staging area
+    with a low priority, leaving the files in use alone. Downloads share
+    max_rate bytes per second if it is given."""
+    lower_priority()
+    run_mode('prefetch', jobs, refresh=refresh, max_rate=max_rate)
+
+
+def activate_mode():
+    """Switch all extensions with a staged update to it."""
+    run_mode('activate')
+
+
+def rollback_mode(ids):
+    """Go back to the previous version of each extension in ids."""
+    run_mode('rollback', ids=ids)
 
 
 def clean_mode():
-    """Remove all *.old files."""
-    config_struct = get_config()
-    check_folders(config_struct, os.W_OK)
-
-    for ext_ref in get_exts_from_config(config_struct.config):
-        path = os.path.join(config_struct.ext_dir, ext_ref.idstr)
-        try:
-            for f in os.scandir(path):
-                if f.name.endswith('.old'):
-                    os.remove(os.path.abspath(f.path))
-                    print('File "{}" of Extension "{}" removed.'.format(
-                        f.name, ext_ref.name
-                        ))
-        except FileNotFoundError:
-            pass
-
+    """Empty the Archive and remove *.old files and leftovers of interrupted
+    downloads."""
+    profiles = get_checked_profiles(os.W_OK)
+
+    for config_struct in profiles:
+        print_profile(config_struct, profiles)
+        for ext_ref in make_plan(config_struct).update:
+            path = os.path.join(config_struct.ext_dir, ext_ref.idstr)
+            try:
+                for f in os.scandir(path):
+                    if f.name.endswith(('.old', '.part')):
+                        os.remove(os.path.abspath(f.path))
+                        print('File "{}" of Extension "{}" removed.'.format(
+                            f.name, ext_ref.name
+                            ))
+            except FileNotFoundError:
+                pass
+        freed = Archive(config_struct.ext_dir).prune(0)
+        if freed:
+            print('Archived versions removed, {:.1f} MB freed.'.format(
+                freed / 1024 / 1024))
+
+
+def daemon_mode(jobs=None, max_rate=None):
+    """Keep running and install or update extensions whenever necessary.
+    Downloads share max_rate bytes per second if it is given."""
+    Daemon(jobs, max_rate).run()
+
+
+def serve_mode(jobs=None):
+    """Run a caching mirror of the update service until stopped."""
+    # imported here, so that only this mode pulls in http.server
+    from . import mirror
+    mirror.serve(get_config(), jobs)
+
+
+def run_mode(action, jobs=None, engine='threads', refresh=False,
+             stats=None, ids=None, locked=False, max_rate=None):
+    """Run action (see Manager.run) on ids (by default the extensions in the
+    config file) in all profiles and print the results. Statistics are
+    recorded in stats if it is given and downloads share max_rate bytes per
+    second if it is given."""
+    profiles = get_checked_profiles(os.W_OK)
+    if locked:
+        # exit right away if there's no usable lockfile
+        get_lock(profiles[0])
+    with Manager(profiles, jobs, engine, max_rate) as manager:
+        for config_struct in profiles:
+            print_profile(config_struct, profiles)
+            for result in manager.run(action, ids, profiles=[config_struct],
+                                      refresh=refresh, stats=stats,
+                                      locked=locked):
+                print(format_result(result))
+
+
+def install_mode(jobs=None, engine='threads', refresh=False, stats=None,
+                 locked=False, max_rate=None):
+    """Install all extensions listed in config, in the versions in the
+    lockfile if locked is True. Statistics are recorded in stats if it is
+    given and downloads share max_rate bytes per second if it is given."""
+    run_mode('install', jobs, engine, refresh, stats, locked=locked,
+             max_rate=max_rate)
+
+
+def get_lock(config_struct):
+    """Return the contents of the lockfile of config_struct (see read_lock).
+    Raise ConfigError if it can't be read."""
+    path = get_lock_path(config_struct.config_file)
+    try:
+        return read_lock(path)
+    except (OSError, ValueError):
+        raise ConfigError("""The lockfile {} doesn't exist or can't be read.
+        Create it with maninex --lock.""".format(path))
+
+
+def lock_mode(jobs=None, refresh=False):
+    """Write the latest versions of all extensions in config to the
+    lockfile."""
+    # the cache of lookups in the extension directory is written as well
+    profiles = get_checked_profiles(os.W_OK)
+    with Manager(profiles, jobs) as manager:
+        results = manager.lock(refresh)
+    for result in results:
+        print(format_result(result))
+    path = get_lock_path(profiles[0].config_file)
+    if any(result.status == 'failed' for result in results):
+        print('Lockfile {} not written.'.format(path))
+        sys.exit(1)
+    print('Lockfile {} written.'.format(path))
+
+
+def status_mode():
+    """Compare the installed extensions with the lockfile without going
+    online. Exit with status 1 unless all of them match."""
+    profiles = get_checked_profiles(os.R_OK)
+    # exit right away if there's no usable lockfile
+    get_lock(profiles[0])
+
+    manager = Manager(profiles)
+    matching = True
+    for config_struct in profiles:
+        print_profile(config_struct, profiles)
+        for result in manager.verify(profiles=[config_struct]):
+            print(format_result(result))
+            matching = matching and result.status == 'as_locked'
+    if not matching:
+        sys.exit(1)
 
-def install_mode():
-    """Install all extensions listed in config."""
-    config_struct = get_config()
-    check_folders(config_struct, os.W_OK)
 
-    threads = []
-    for ext_ref in get_exts_from_config(config_struct.config):
-        ext_thread = Thread(target=process_extension_install,
-                            args=(config_struct, ext_ref))
-        ext_thread.start()
-        threads.append(ext_thread)
+def list_mode():
+    profiles = get_checked_profiles(os.R_OK)
+
+    manager = Manager(profiles)
+    for config_struct in profiles:
+        print_profile(config_struct, profiles)
+        for result in manager.status(profiles=[config_struct]):
+            if result.status == 'installed':
+                print('{}: Installed.'.format(result.ext_ref.name))
+            else:
+                print('{}: Not installed.'.format(result.ext_ref.name))
 
-    for ext_thread in threads:
-        ext_thread.join()
 
+def plan_mode():
+    """Print what the other modes would do without changing anything."""
+    profiles = get_checked_profiles(os.R_OK)
 
-def list_mode():
-    config_struct = get_config()
-    check_folders(config_struct, os.R_OK)
-    installed_jsons = get_existing_jsons(config_struct.json_dir)
-    installed_folders = get_existing_folders(config_struct.ext_dir)
-
-    for ext_ref in get_exts_from_config(config_struct.config):
-        if (ext_ref.idstr in installed_jsons and
-                ext_ref.idstr in installed_folders):
-            print('{}: Installed.'.format(ext_ref.name))
-        else:
-            print('{}: Not installed.'.format(ext_ref.name))
+    manager = Manager(profiles)
+    for config_struct in profiles:
+        print_profile(config_struct, profiles)
+        plan, = manager.plan(profiles=[config_struct])
+        print('\n'.join(format_plan(plan)))
 
 
 def print_skel_mode():
@@ -299,60 +3362,73 @@ def print_skel_mode():
 def remove_mode():
     """Remove json file and ext directory for files that are no longer in
     config_file."""
-    config_struct = get_config()
-    check_folders(config_struct, os.W_OK)
-    ext_ids = [ext_ref.idstr for ext_ref in
-               get_exts_from_config(config_struct.config)]
+    run_mode('remove')
+
 
-    for folder in get_existing_folders(config_struct.ext_dir):
-        if folder not in ext_ids:
-            rmtree(os.path.join(config_struct.ext_dir, folder))
-            print('Extension folder {} removed.'.format(folder))
+def reindex_mode():
+    """Rebuild the state index from the files on disk."""
+    profiles = get_checked_profiles(os.W_OK)
 
-    for json in get_existing_jsons(config_struct.json_dir):
-        if json not in ext_ids:
-            filename = json + '.json'
-            os.remove(os.path.join(config_struct.json_dir, filename))
-            print('JSON file {} removed.'.format(filename))
+    for config_struct in profiles:
+        print_profile(config_struct, profiles)
+        with StateIndex(config_struct).transaction() as index:
+            index.rebuild()
+        print('Index of {} extensions rebuilt.'.format(len(index.entries)))
+
+
+def get_config_name(config_struct, ext_id):
+    """Return the name in the manifest of the installed extension ext_id,
+    cleaned up for use as a key in the [extensions] section, or None if
+    there is no usable name."""
+    ext_path = os.path.join(config_struct.ext_dir, ext_id)
+    try:
+        filename = get_current_file(ext_path)
+        if filename is None:
+            return None
+        name = read_crx_manifest(os.path.join(ext_path, filename)).name
+    except (OSError, VerificationError):
+        return None
+    if not isinstance(name, str):
+        return None
+    # characters that separate keys from values or start comments and
+    # sections in config files
+    name = ' '.join(re.sub(r'[=:]', ' ', name).split()).lstrip('#;[')
+    return name.strip() or None
 
 
 def scan_mode():
-    """Scan for already installed files and add them to config_file."""
-    config_struct = get_config()
-    check_folders(config_struct, os.R_OK)
-    jsons = get_existing_jsons(config_struct.json_dir)
-    exts = list(get_exts_from_config(config_struct.config))
-    exts_ids = [exts[ext].idstr for ext in range(len(exts))]
-
-    for ext_id in jsons:
-        if ext_id not in exts_ids:
-            config_struct.config['extensions'].update({ext_id: None})
-            print('Extension {} added.'.format(ext_id[0:11] + '…'))
-    with open(config_struct.config_file, 'w') as c_file:
-        config_struct.config.write(c_file)
-
-
-def update_mode():
-    """Update all extensions that are in config and are also present in the
-    extension directory."""
-    config_struct = get_config()
-    check_folders(config_struct, os.W_OK)
+    """Scan for already installed files and add them to config_file, named
+    after their manifests where possible."""
+    profiles = get_checked_profiles(os.R_OK)
+    config = profiles[0].config
+
+    # all profiles share config, so extensions added for one profile are
+    # in the plans of the following ones
+    for config_struct in profiles:
+        for ext_id in make_plan(config_struct).orphaned_jsons:
+            name = get_config_name(config_struct, ext_id)
+            if name is None or config.has_option('extensions', name):
+                config['extensions'].update({ext_id: None})
+                name = ext_id[0:11] + '…'
+            else:
+                config['extensions'][name] = ext_id
+            print('Extension {} added.'.format(name))
+    with open(profiles[0].config_file, 'w') as c_file:
+        config.write(c_file)
 
-    dir_list = get_existing_folders(config_struct.ext_dir)
-    threads = []
-    for ext_ref in get_exts_from_config(config_struct.config):
-        ext_thread = Thread(target=process_extension_update,
-                            args=(config_struct, ext_ref, dir_list))
-        ext_thread.start()
-        threads.append(ext_thread)
 
-    for ext_thread in threads:
-        ext_thread.join()
+def update_mode(jobs=None, engine='threads', refresh=False, stats=None,
+                max_rate=None):
+    """Update all extensions that are in config and are also present in the
+    extension directory. Statistics are recorded in stats if it is given and
+    downloads share max_rate bytes per second if it is given."""
+    run_mode('update', jobs, engine, refresh, stats, max_rate=max_rate)
 
 
 def get_config_location():
     """Return the location of the config file. A file in $XDG_CONFIG_HOME takes
-    precedence over a file present in the script directory."""
+    precedence over a file present in the script directory. Raise
+    ConfigError if there is none."""
     xdg_config_home = (os.getenv('XDG_CONFIG_HOME') or
                        os.path.join(os.getenv('HOME'), '.config'))
     xdg_config_file = os.path.join(get_real_path(xdg_config_home),
@@ -365,76 +3441,262 @@ def get_config_location():
     elif os.path.exists(script_dir_file):
         return script_dir_file
     else:
-        mline_print("""maninex depends on a config file named maninex.conf.
-        This file can be located either in your $XDG_CONFIG_HOME directory or
-        in the location of maninex.py.""")
-        sys.exit(1)
-
-
-def get_config():
-    config_file = get_config_location()
+        raise ConfigError("""maninex depends on a config file named
+        maninex.conf. This file can be located either in your
+        $XDG_CONFIG_HOME directory or in the location of maninex.py.""")
+
+
+def get_profiles(config_file=None):
+    """Return a Configs object for every profile in config_file, which
+    defaults to the one found by get_config_location. Each profile is a
+    [directories] or [directories:name] section with its own json and
+    extension directory. All profiles share the same extensions and
+    settings. Raise ConfigError if there is no profile."""
+    if config_file is None:
+        config_file = get_config_location()
     config = configparser.ConfigParser(allow_no_value=True)
     # don't process option names in the config file, i.e. don't convert them to
     # lowercase
     config.optionxform = lambda option: option
+    profiles = []
     try:
         config.read(config_file)
-        json_dir = get_real_path(config['directories']['json_dir'])
-        ext_dir = get_real_path(config['directories']['extension_dir'])
+        for section in config.sections():
+            if section != 'directories' and not section.startswith(
+                    'directories:'):
+                continue
+            json_dir = get_real_path(config[section]['json_dir'])
+            ext_dir = get_real_path(config[section]['extension_dir'])
+            profiles.append(Configs(
+                ext_dir=ext_dir, json_dir=json_dir, config_file=config_file,
+                config=config,
+                profile=section.partition(':')[2].strip() or 'default'))
+        if not profiles:
+            raise KeyError('directories')
     except (KeyError, configparser.MissingSectionHeaderError):
-        mline_print("""maninex requires a [directories] section specifying
-        directories for json and extension files in maninex.conf. Try maninex
-        --print-skel for reference.""")
-        sys.exit(1)
+        raise ConfigError("""maninex requires a [directories] section
+        specifying directories for json and extension files in maninex.conf.
+        Try maninex --print-skel for reference.""")
+
+    return profiles
+
+
+def get_config():
+    """Return the Configs object of the first profile in the config file."""
+    return get_profiles()[0]
+
+
+def get_checked_profiles(perm):
+    """Return all profiles after making sure the user has the permissions
+    perm for all of their directories."""
+    profiles = get_profiles()
+    for config_struct in profiles:
+        check_folders(config_struct, perm)
+    return profiles
+
+
+def print_profile(config_struct, profiles):
+    """Print the name of the profile config_struct if there is more than one
+    in profiles."""
+    if len(profiles) > 1:
+        print('Profile "{}":'.format(config_struct.profile))
+
 
-    return Configs(ext_dir=ext_dir, json_dir=json_dir,
-                   config_file=config_file, config=config)
+def rate(value):
+    """Argument type for options that take a rate like 2M."""
+    try:
+        return parse_rate(value)
+    except ValueError:
+        raise ArgumentTypeError('{} is not a rate like 500K or 2M'.format(
+            value))
+
+
+def positive_int(value):
+    """Argument type for options that take a positive number."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError('{} is not a positive number'.format(value))
+    return number
+
+
+# options that select what maninex does; only one of them may be given
+MODES = ['activate', 'clean', 'daemon', 'install', 'list', 'lock', 'plan',
+         'prefetch', 'print_skel', 'reindex', 'remove', 'rollback', 'scan',
+         'serve', 'status', 'update']
+
+
+def make_parser():
+    """Return the parser for maninex's command line options."""
+    parser = ArgumentParser(
+        usage='%(prog)s [option]',
+        epilog='set up paths and extensions in maninex.conf')
+    parser._optionals.title = 'options'
+    parser.add_argument('--activate', action='store_true',
+                        help='''switch all extensions to their prefetched
+                        updates without going online''')
+    parser.add_argument('-c', '--clean', action='store_true',
+                        help='''clean up (i.e. remove) backed up extension
+                        files''')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='''keep running, install extensions added to the
+                        config file and look for updates regularly''')
+    parser.add_argument('-i', '--install', action='store_true',
+                        help="""install all extensions that aren't already
+                        installed""")
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='''list all extensions and their current
+                        status''')
+    parser.add_argument('--lock', action='store_true',
+                        help='''write the latest versions of all extensions
+                        to the lockfile next to the config file''')
+    parser.add_argument('--plan', '--dry-run', action='store_true',
+                        help='''show what installing, updating and removing
+                        would do without changing anything''')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='''download updates with a low priority without
+                        activating them (see --activate)''')
+    parser.add_argument('-p', '--print-skel', action='store_true',
+                        help='''print the contents of a skeleton config file
+                        to stdout''')
+    parser.add_argument('-r', '--remove', action='store_true',
+                        help='''remove all extensions that are installed but
+                        not in the config file''')
+    parser.add_argument('--reindex', action='store_true',
+                        help='''rebuild the index of installed extensions from
+                        the files on disk''')
+    parser.add_argument('--rollback', nargs='+', metavar='ID',
+                        help='''go back to the previous version of the
+                        extensions with the ids ID''')
+    parser.add_argument('-s', '--scan', action='store_true',
+                        help='''scan for installed extensions not in the
+                        config file and add them to the config file''')
+    parser.add_argument('--status', action='store_true',
+                        help='''compare the installed extensions with the
+                        lockfile without going online''')
+    parser.add_argument('--serve', action='store_true',
+                        help='''run a caching mirror of the update service
+                        for other machines''')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='update all extensions')
+    parser.add_argument('-j', '--jobs', type=positive_int, metavar='N',
+                        help='''process up to N extensions at the same time
+                        when installing or updating, or up to N upstream
+                        requests when serving''')
+    parser.add_argument('-e', '--engine', choices=['threads', 'asyncio'],
+                        default='threads',
+                        help='''process extensions with a pool of threads
+                        (default) or with asyncio (requires aiohttp)''')
+    parser.add_argument('--max-rate', type=rate, metavar='RATE',
+                        help='''download at most RATE bytes per second (e.g.
+                        500K or 2M) over all downloads''')
+    parser.add_argument('--idle', action='store_true',
+                        help='''run with idle I/O priority and a low CPU
+                        priority''')
+    parser.add_argument('--locked', action='store_true',
+                        help='''install the versions in the lockfile''')
+    parser.add_argument('--refresh', action='store_true',
+                        help='''ignore cached results of previous lookups
+                        when installing or updating''')
+    parser.add_argument('--stats', action='store_true',
+                        help='''print how long each extension spent in each
+                        phase of installing or updating and overall
+                        throughput''')
+    parser.add_argument('--report', choices=['json'],
+                        help='''print statistics of installing or updating in
+                        a machine-readable format''')
+    return parser
+
+
+def main(argv=None):
+    """Main function to be run from CLI. argv defaults to the arguments the
+    script was started with."""
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    try:
+        run_options(parser, args)
+    except ConfigError as error:
+        mline_print(str(error), file=sys.stderr)
+        sys.exit(1)
 
 
-def main():
-    """Main function to be run from CLI."""
+def run_options(parser, args):
+    """Do what the command line options args, as parsed by parser, ask
+    for."""
+    args_count = [bool(getattr(args, mode)) for mode in MODES].count(True)
     # display help message if no arguments are supplied
     if args_count == 0:
         parser.print_help()
     # display error message if more than one argument is supplied
     elif args_count > 1:
         print('Only one argument at a time is supported.')
+    elif (args.stats or args.report) and not (args.install or args.update):
+        print('--stats and --report only work with --install and --update.')
+    elif args.locked and not args.install:
+        print('--locked only works with --install.')
+    elif (args.max_rate is not None or args.idle) and not (
+            args.install or args.update or args.prefetch or args.daemon):
+        print('--max-rate and --idle only work with --install, --update, '
+              '--prefetch and --daemon.')
+    elif args.install or args.update:
+        if args.idle:
+            lower_priority()
+        stats = None
+        if args.stats or args.report:
+            stats = Stats('install' if args.install else 'update')
+        mode = partial(update_mode, max_rate=args.max_rate)
+        if args.install:
+            mode = partial(install_mode, locked=args.locked,
+                           max_rate=args.max_rate)
+        if args.report == 'json':
+            # keep stdout free for the report
+            with redirect_stdout(sys.stderr):
+                mode(args.jobs, args.engine, args.refresh, stats)
+            json.dump(stats.report(), sys.stdout, indent=2)
+            print()
+        else:
+            mode(args.jobs, args.engine, args.refresh, stats)
+        if args.stats:
+            print('\n'.join(format_stats(stats)),
+                  file=sys.stderr if args.report else sys.stdout)
+    elif args.prefetch:
+        prefetch_mode(args.jobs, args.refresh, args.max_rate)
+    elif args.activate:
+        activate_mode()
+    elif args.rollback:
+        try:
+            rollback_mode(args.rollback)
+        except ValueError as error:
+            print(error)
     elif args.clean:
         clean_mode()
-    elif args.install:
-        install_mode()
+    elif args.daemon:
+        if args.engine != 'threads':
+            print('--daemon only works with the threads engine.')
+        else:
+            if args.idle:
+                lower_priority()
+            daemon_mode(args.jobs, args.max_rate)
     elif args.list:
         list_mode()
+    elif args.lock:
+        lock_mode(args.jobs, args.refresh)
+    elif args.status:
+        status_mode()
+    elif args.plan:
+        plan_mode()
     elif args.print_skel:
         print_skel_mode()
+    elif args.reindex:
+        reindex_mode()
     elif args.remove:
         remove_mode()
     elif args.scan:
         scan_mode()
-    elif args.update:
-        update_mode()
-
-
-parser = ArgumentParser(usage='%(prog)s [option]',
-                        epilog='set up paths and extensions in maninex.conf')
-parser._optionals.title = 'options'
-parser.add_argument('-c', '--clean', action='store_true',
-                    help='clean up (i.e. remove) backed up extension files')
-parser.add_argument('-i', '--install', action='store_true',
-                    help="""install all extensions that aren't already
-                    installed""")
-parser.add_argument('-l', '--list', action='store_true',
-                    help='''list all extensions and their current status''')
-parser.add_argument('-p', '--print-skel', action='store_true',
-                    help='''print the contents of a skeleton config file to
-                    stdout''')
-parser.add_argument('-r', '--remove', action='store_true',
-                    help='''remove all extensions that are installed but not
-                    in the config file''')
-parser.add_argument('-s', '--scan', action='store_true',
-                    help='''scan for installed extensions not in the config
-                    file and add them to the config file''')
-parser.add_argument('-u', '--update', action='store_true',
-                    help='update all extensions')
-args = parser.parse_args()
-args_count = list(vars(args).values()).count(True)
+    elif args.serve:
+        if args.engine != 'threads':
+            print('--serve only works with the threads engine.')
+        else:
+            serve_mode(args.jobs)
@@ -0,0 +1,396 @@
+"""A caching mirror of the update service for fleets of machines using the
+same extensions. It answers redirect and update manifest requests the way the
+update service does, but points clients at extension files it serves itself.
+Each file is downloaded from the upstream service (the update_url of the
+machine running the mirror) when the first client asks for it and kept in a
+CrxStore, so the whole fleet causes a single download per extension version.
+If the upstream service can't be reached, clients get the latest version the
+mirror knows about.
+
+Only --serve imports this module, as it pulls in http.server."""
+
+import os
+import re
+import sys
+import time
+import socket
+import signal
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import quoteattr
+from . import maninex
+
+UPDATE_PATH = '/service/update2/crx'
+# what the update service said about each extension, kept in the store
+MIRROR_CACHE_FILE = '.maninex_mirror.json'
+DEFAULT_SERVE_ADDRESS = 'localhost:8080'
+MANIFEST_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?><gupdate xmlns='
+                     '"http://www.google.com/update2/response" protocol="2.0" '
+                     'server="maninex">{}</gupdate>')
+CRX_PATH_PATTERN = re.compile(r'/crx/([a-p]{32})/(extension_[\d_]+\.crx)')
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)')
+# seconds during which a failed upstream isn't asked again
+UPSTREAM_BACKOFF = 30
+
+
+def mirror_filename(version):
+    """Return the name the file of version is served under. Clients take the
+    version from it until they have the file."""
+    return 'extension_{}.crx'.format(version.replace('.', '_'))
+
+
+def get_serve_address(config):
+    """Return the host and port the mirror listens on as set up in config.
+    Raise ConfigError if the setting can't be used."""
+    address = config.get('settings', 'serve_address',
+                         fallback=DEFAULT_SERVE_ADDRESS)
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        port = -1
+    if not 0 <= port <= 0xffff:
+        raise maninex.ConfigError("""The serve_address setting in maninex.conf
+        has to be a host name or address followed by a colon and a port.""")
+    return host.strip('[]'), port
+
+
+def get_mirror_store(config):
+    """Return the CrxStore the mirror keeps its files in: the store_dir set
+    up in config or a directory in $XDG_CACHE_HOME."""
+    store = maninex.get_store(config)
+    if store is not None:
+        return store
+    cache_home = (os.getenv('XDG_CACHE_HOME') or
+                  os.path.join(os.getenv('HOME'), '.cache'))
+    store_dir = os.path.join(maninex.get_real_path(cache_home), 'maninex')
+    os.makedirs(store_dir, exist_ok=True)
+    return maninex.CrxStore(store_dir)
+
+
+class Mirror(object):
+    """The extensions the mirror knows about and their files. config_struct
+    provides the upstream update service and the settings for contacting it,
+    store keeps the files and session is used for all upstream requests.
+    Lookups are cached in a ResolveCache inside the store for cache_ttl
+    seconds. Older entries are answered with right away and refreshed in
+    the background. After a failed upstream request, the upstream service
+    is left alone for UPSTREAM_BACKOFF seconds."""
+    def __init__(self, config_struct, store, session):
+        self.config_struct = config_struct
+        self.store = store
+        self.session = session
+        self.cache = maninex.ResolveCache(
+            config_struct, path=os.path.join(store.path, MIRROR_CACHE_FILE))
+        self.cache.load()
+        self.failed_at = None
+        # upstream lookups wait for each other, so that clients asking for
+        # the same extensions at the same time cause a single request
+        self._lock = threading.Lock()
+        # ids being refreshed in the background
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def backing_off(self):
+        """Check if the upstream service failed less than UPSTREAM_BACKOFF
+        seconds ago."""
+        return (self.failed_at is not None and
+                time.monotonic() - self.failed_at < UPSTREAM_BACKOFF)
+
+    def check(self, ext_ids):
+        """Look up the extensions in ext_ids without a fresh entry upstream
+        and cache the results, unless the upstream service is backed off
+        from. Has to be called with _lock held."""
+        ext_ids = [ext_id for ext_id in ext_ids
+                   if self.cache.lookup(ext_id) is None]
+        if not ext_ids or self.backing_off():
+            return
+        results = maninex.check_updates(self.config_struct, ext_ids,
+                                        self.session, self.cache)
+        self.failed_at = (time.monotonic() if len(results) < len(ext_ids)
+                          else None)
+        self.cache.save()
+
+    def refresh(self, ext_ids):
+        """Look up the extensions in ext_ids in a background thread, leaving
+        out those that are being refreshed already."""
+        with self._refreshing_lock:
+            ext_ids = set(ext_ids) - self._refreshing
+            if not ext_ids or self.backing_off():
+                return
+            self._refreshing |= ext_ids
+
+        def run():
+            try:
+                with self._lock:
+                    self.check(sorted(ext_ids))
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing -= ext_ids
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def lookup(self, ext_ids):
+        """Return a dict mapping the ids in ext_ids to the CacheEntry of
+        their latest version (whose url is None for unknown extensions).
+        Stale entries are returned as they are and refreshed in the
+        background. Extensions that couldn't be looked up and never were
+        before are left out."""
+        fresh = self.cache.lookup_updates(ext_ids)
+        stale = [ext_id for ext_id in ext_ids if ext_id not in fresh and
+                 self.cache.entry(ext_id) is not None]
+        unknown = [ext_id for ext_id in ext_ids if
+                   self.cache.entry(ext_id) is None]
+        if stale:
+            self.refresh(stale)
+        if unknown:
+            with self._lock:
+                self.check(unknown)
+        entries = {ext_id: self.cache.entry(ext_id) for ext_id in ext_ids}
+        return {ext_id: entry for ext_id, entry in entries.items()
+                if entry is not None}
+
+    def peek_file(self, ext_id, filename):
+        """Return a FileInfo object for the file filename of ext_id without
+        contacting the upstream service: from the store or, for the latest
+        version, from what the update service announced. Return None if
+        neither knows the file."""
+        file_info = self.store.lookup(ext_id, filename)
+        if file_info is not None:
+            return file_info
+        entry = self.cache.entry(ext_id)
+        if (entry is None or entry.url is None or entry.sha256 is None or
+                entry.size is None or
+                mirror_filename(entry.version) != filename):
+            return None
+        return maninex.FileInfo(size=entry.size, sha256=entry.sha256)
+
+    def get_file(self, ext_id, filename):
+        """Return a FileInfo object for the file filename of ext_id or None if
+        the mirror can't serve it. Files that aren't stored yet are only
+        downloaded if they belong to the latest version."""
+        file_info = self.store.lookup(ext_id, filename)
+        if file_info is not None:
+            return file_info
+        entry = self.lookup([ext_id]).get(ext_id)
+        if (entry is None or entry.url is None or
+                mirror_filename(entry.version) != filename):
+            return None
+        update_info = maninex.UpdateInfo(
+            ext_id=ext_id, url=entry.url, version=entry.version,
+            sha256=entry.sha256, size=entry.size)
+
+        def fetch(part_file):
+            ext_obj = maninex.ExtensionOnline(
+                self.config_struct, ext_id, update_info, self.session)
+            ext_obj.fetch(part_file)
+            print('Mirrored "{}" {}.'.format(ext_id, entry.version),
+                  flush=True)
+
+        return self.store.fetch(ext_id, filename, fetch)
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """Answers requests with the help of the server's Mirror object."""
+    protocol_version = 'HTTP/1.1'
+    server_version = 'maninex'
+
+    def send_empty(self, status, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        crx_match = CRX_PATH_PATTERN.fullmatch(url.path)
+        if url.path == UPDATE_PATH:
+            self.update_check(parse_qs(url.query))
+        elif crx_match:
+            self.send_crx(*crx_match.groups())
+        else:
+            self.send_empty(404)
+
+    def crx_url(self, ext_id, version):
+        """Return the url of the file of version of ext_id on this mirror, as
+        seen by the client."""
+        host = self.headers.get('Host') or '{}:{}'.format(
+            *self.server.server_address[:2])
+        return 'http://{}/crx/{}/{}'.format(host, ext_id,
+                                            mirror_filename(version))
+
+    def update_check(self, query):
+        """Answer a redirect or update manifest request."""
+        ext_ids = [parse_qs(x).get('id', [''])[0]
+                   for x in query.get('x', [])]
+        if not ext_ids or not all(maninex.EXT_ID_PATTERN.fullmatch(ext_id)
+                                  for ext_id in ext_ids):
+            self.send_empty(400)
+            return
+        entries = self.server.mirror.lookup(ext_ids)
+        if query.get('response') == ['redirect']:
+            entry = entries.get(ext_ids[0])
+            if entry is None:
+                # neither known nor known to be unknown
+                self.send_empty(503)
+            elif entry.url is None:
+                self.send_empty(204)
+            else:
+                self.send_empty(302, [('Location', self.crx_url(
+                    ext_ids[0], entry.version))])
+            return
+
+        apps = []
+        for ext_id in ext_ids:
+            entry = entries.get(ext_id)
+            if entry is None:
+                # left out, so that the client asks again on its own
+                continue
+            elif entry.url is None:
+                apps.append('<app appid="{}" status="error-unknownApplication'
+                            '"/>'.format(ext_id))
+                continue
+            attributes = [('codebase', self.crx_url(ext_id, entry.version)),
+                          ('status', 'ok'), ('version', entry.version)]
+            file_info = self.server.mirror.store.lookup(
+                ext_id, mirror_filename(entry.version))
+            if file_info is not None:
+                attributes += [('hash_sha256', file_info.sha256),
+                               ('size', str(file_info.size))]
+            elif entry.sha256 is not None and entry.size is not None:
+                attributes += [('hash_sha256', entry.sha256),
+                               ('size', str(entry.size))]
+            apps.append('<app appid="{}" status="ok"><updatecheck {}/></app>'
+                        .format(ext_id, ' '.join(
+                            '{}={}'.format(key, quoteattr(value))
+                            for key, value in attributes)))
+        body = MANIFEST_TEMPLATE.format(''.join(apps)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    def get_range(self, size, etag):
+        """Return the first and last byte the client asked for, or None if
+        it wants the whole file. Ranges that don't fit the file of size
+        bytes are returned as they are, multiple ranges are ignored."""
+        match = RANGE_PATTERN.fullmatch(self.headers.get('Range', ''))
+        if (not match or not any(match.groups()) or
+                self.headers.get('If-Range', etag) != etag):
+            return None
+        first, last = match.groups()
+        if not first:
+            # the last bytes of the file
+            return max(size - int(last), 0), size - 1
+        return int(first), min(int(last), size - 1) if last else size - 1
+
+    def send_crx(self, ext_id, filename):
+        """Send an extension file, downloading it first if necessary. HEAD
+        requests are answered from what the mirror knows already. Range,
+        If-Range and If-None-Match are supported, with the file's digest as
+        its ETag."""
+        try:
+            if self.command == 'HEAD':
+                file_info = self.server.mirror.peek_file(ext_id, filename)
+            else:
+                file_info = self.server.mirror.get_file(ext_id, filename)
+        except (requests.RequestException, OSError,
+                maninex.VerificationError) as error:
+            self.log_error('fetching %s failed: %s', self.path, error)
+            self.send_empty(502)
+            return
+        if file_info is None:
+            self.send_empty(404)
+            return
+
+        etag = '"{}"'.format(file_info.sha256)
+        headers = [('ETag', etag), ('Accept-Ranges', 'bytes')]
+        none_match = self.headers.get('If-None-Match', '')
+        if etag in none_match or none_match.strip() == '*':
+            self.send_empty(304, headers)
+            return
+        status = 200
+        first, last = 0, file_info.size - 1
+        requested = self.get_range(file_info.size, etag)
+        if requested is not None:
+            first, last = requested
+            if first > last:
+                self.send_empty(416, [('Content-Range', 'bytes */{}'.format(
+                    file_info.size))])
+                return
+            status = 206
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(
+                first, last, file_info.size)))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-chrome-extension')
+        self.send_header('Content-Length', str(last - first + 1))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == 'GET':
+            blob_path = self.server.mirror.store.blob_path(file_info.sha256)
+            with open(blob_path, 'rb') as blob_file:
+                # the headers are out already, the file is copied by the
+                # kernel
+                self.connection.sendfile(blob_file, first, last - first + 1)
+
+
+class MirrorServer(ThreadingHTTPServer):
+    """Serves mirror on address (a tuple of host and port), answering each
+    request in its own thread."""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, mirror):
+        if ':' in address[0]:
+            self.address_family = socket.AF_INET6
+        self.mirror = mirror
+        super().__init__(address, MirrorHandler)
+
+    @property
+    def update_url(self):
+        host, port = self.server_address[:2]
+        if ':' in host:
+            host = '[{}]'.format(host)
+        return 'http://{}:{}{}'.format(host, port, UPDATE_PATH)
+
+
+def serve(config_struct, jobs=None):
+    """Run a mirror of the update service set up in config_struct until
+    SIGTERM or SIGINT arrives. Up to jobs requests are sent upstream at the
+    same time."""
+    config = config_struct.config
+    address = get_serve_address(config)
+    store = get_mirror_store(config)
+    with maninex.make_session(maninex.get_jobs(config, jobs)) as session:
+        try:
+            server = MirrorServer(address,
+                                  Mirror(config_struct, store, session))
+        except OSError as error:
+            print("Can't listen on {}:{}: {}".format(
+                *address, error.strerror), file=sys.stderr)
+            sys.exit(1)
+
+        def stop(signum, frame):
+            # shutdown waits for serve_forever, which runs in this thread
+            threading.Thread(target=server.shutdown).start()
+
+        old_handlers = {signum: signal.signal(signum, stop)
+                        for signum in (signal.SIGTERM, signal.SIGINT)}
+        print('maninex mirror serving {}.'.format(server.update_url),
+              flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
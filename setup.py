@@ -18,7 +18,8 @@ setup(
                   ],
       keywords='chromium extension webstore inox iridium',
       install_requires=['requests'],
-      python_requires='>=3.5',
+      extras_require={'asyncio': ['aiohttp']},
+      python_requires='>=3.7',
       entry_points={
                     'console_scripts': [
                                         'maninex = maninex:main'
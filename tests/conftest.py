@@ -0,0 +1,44 @@
+import string
+import configparser
+import pytest
+from stub_server import StubServer
+from maninex import maninex
+
+
+def make_ext_id(number):
+    """Return a valid extension id (32 letters from a to p) for number."""
+    letters = string.ascii_lowercase[:16]
+    ext_id = ''
+    for _ in range(32):
+        ext_id = letters[number % 16] + ext_id
+        number //= 16
+    return ext_id
+
+
+def make_config_struct(tmpdir, ext_ids, settings=None):
+    """Create a Configs object with fresh directories below tmpdir that lists
+    all extensions in ext_ids."""
+    json_dir = tmpdir.mkdir('json')
+    ext_dir = tmpdir.mkdir('ext')
+    config_file = tmpdir.join('maninex.conf')
+
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.optionxform = lambda option: option
+    config['directories'] = {'json_dir': str(json_dir),
+                             'extension_dir': str(ext_dir)}
+    config['settings'] = settings or {}
+    config['extensions'] = {}
+    for ext_id in ext_ids:
+        config['extensions'][ext_id] = None
+    with open(str(config_file), 'w') as c_file:
+        config.write(c_file)
+
+    return maninex.Configs(json_dir=str(json_dir), ext_dir=str(ext_dir),
+                           config_file=str(config_file), config=config)
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer().start()
+    yield server
+    server.stop()
@@ -0,0 +1,331 @@
+"""A local stand-in for the update2 endpoint of the Chrome WebStore.
+
+The server knows a set of extensions (id -> version) and answers both kinds of
+requests maninex sends: redirect requests that lead to the CRX file of an
+extension and update manifest requests that ask for the versions of several
+extensions at once. CRX files are generated on the fly. Downloads can be
+resumed with Range requests and the server can be told to drop connections
+partway through a transfer."""
+
+import io
+import re
+import json
+import time
+import struct
+import hashlib
+import zipfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, unquote
+
+UPDATE_PATH = '/service/update2/crx'
+MANIFEST_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?><gupdate xmlns='
+                     '"http://www.google.com/update2/response" protocol="2.0" '
+                     'server="stub">{}</gupdate>')
+
+
+def proto_field(number, value):
+    """Return the protobuf encoding of the bytes value as field number."""
+    encoded = b''
+    for item in (number << 3 | 2, len(value)):
+        while item > 0x7f:
+            encoded += bytes([item & 0x7f | 0x80])
+            item >>= 7
+        encoded += bytes([item])
+    return encoded + value
+
+
+def make_crx_header(ext_id):
+    """Return a CRX3 header for ext_id. It has the structure of a real one,
+    but the key and signature are made up."""
+    crx_id = bytes.fromhex(''.join('{:x}'.format(ord(letter) - ord('a'))
+                                   for letter in ext_id))
+    proof = proto_field(1, b'public key') + proto_field(2, b'signature')
+    return proto_field(2, proof) + proto_field(10000, proto_field(1, crx_id))
+
+
+def make_crx(ext_id, version, size=1024):
+    """Return the content of a CRX3 file for ext_id whose zip archive contains
+    a manifest.json and enough padding to make the file about size bytes."""
+    archive = io.BytesIO()
+    manifest = json.dumps({'name': 'Extension {}'.format(ext_id[:8]),
+                           'version': version,
+                           'manifest_version': 2})
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+        zip_file.writestr('manifest.json', manifest)
+        padding = max(size - 300 - len(manifest), 0)
+        zip_file.writestr('payload.bin', b'\0' * padding)
+    header = make_crx_header(ext_id)
+    return (b'Cr24' + struct.pack('<II', 3, len(header)) + header +
+            archive.getvalue())
+
+
+def crx_filename(version):
+    return 'extension_{}.crx'.format(version.replace('.', '_'))
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent separately, which Nagle's algorithm would
+    # delay until the client acknowledges the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.stub.open_connection(1)
+
+    def finish(self):
+        super().finish()
+        self.server.stub.open_connection(-1)
+
+    def send_body(self, status, body, content_type, headers=(), cut=None):
+        """Send a response. If cut is given, the connection is closed after
+        sending that many bytes of body."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            if cut is not None:
+                body = body[:cut]
+                self.close_connection = True
+            self.wfile.write(body)
+            self.server.stub.count_bytes(len(body))
+            if cut is not None:
+                # let the client read the data before the connection breaks
+                self.wfile.flush()
+                time.sleep(0.05)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def count(self, kind):
+        # HEAD requests are counted separately, so that tests can tell
+        # metadata requests from downloads
+        if self.command == 'HEAD':
+            kind += '_head'
+        self.server.stub.count(kind)
+
+    def do_GET(self):
+        stub = self.server.stub
+        if stub.take_token() is False:
+            self.count('throttled')
+            headers = []
+            if stub.retry_after is not None:
+                headers.append(('Retry-After', str(stub.retry_after)))
+            self.send_body(429, b'', 'text/plain', headers)
+            return
+        if stub.latency:
+            time.sleep(stub.latency)
+        url = urlsplit(self.path)
+        if url.path == UPDATE_PATH:
+            query = parse_qs(url.query)
+            ext_ids = [parse_qs(unquote(x))['id'][0] for x in query['x']]
+            if query.get('response') == ['redirect']:
+                self.count('redirect')
+                self.redirect(ext_ids[0])
+            else:
+                self.count('manifest')
+                self.manifest(ext_ids)
+        elif url.path.startswith('/crx/'):
+            self.count('crx')
+            self.crx(url.path.split('/')[2])
+        else:
+            self.send_body(404, b'', 'text/plain')
+
+    def redirect(self, ext_id):
+        stub = self.server.stub
+        if ext_id not in stub.extensions:
+            self.send_body(204, b'', 'text/plain')
+            return
+        self.send_body(302, b'', 'text/plain',
+                       [('Location', stub.crx_url(ext_id))])
+
+    def manifest(self, ext_ids):
+        stub = self.server.stub
+        apps = []
+        for ext_id in ext_ids:
+            if ext_id in stub.extensions:
+                content = stub.crx_content(ext_id, corrupt=False)
+                digest = ''
+                if stub.digests:
+                    digest = 'hash_sha256="{}" size="{}" '.format(
+                        hashlib.sha256(content).hexdigest(), len(content))
+                apps.append(
+                    '<app appid="{}" status="ok"><updatecheck codebase="{}" '
+                    '{}status="ok" version="{}"/></app>'.format(
+                        ext_id, stub.crx_url(ext_id), digest,
+                        stub.extensions[ext_id]))
+            else:
+                apps.append('<app appid="{}" status="error-unknownApplication'
+                            '"/>'.format(ext_id))
+        body = MANIFEST_TEMPLATE.format(''.join(apps)).encode()
+        self.send_body(200, body, 'text/xml')
+
+    def crx(self, ext_id):
+        stub = self.server.stub
+        if ext_id not in stub.extensions:
+            self.send_body(404, b'', 'text/plain')
+            return
+        if ext_id in stub.failing:
+            self.send_body(500, b'', 'text/plain')
+            return
+        etag = '"{}-{}"'.format(ext_id, stub.extensions[ext_id])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(304, b'', 'application/x-chrome-extension',
+                           [('ETag', etag)])
+            return
+
+        content = stub.crx_content(ext_id)
+        headers = [('ETag', etag)]
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if (stub.ranges and match and
+                self.headers.get('If-Range', etag) == etag):
+            start = int(match.group(1))
+            headers.append(('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(content) - 1, len(content))))
+            self.count('crx_range')
+        cut = stub.take_drop() if self.command == 'GET' else None
+        self.send_body(206 if start else 200, content[start:],
+                       'application/x-chrome-extension', headers, cut)
+
+
+class StubServer(object):
+    """Serve the extensions in the dict extensions (id -> version) on a local
+    port. Every CRX file is about crx_size bytes large unless sizes (id ->
+    size) says otherwise and every request is answered after waiting latency
+    seconds. The next drops downloads are
+    broken off after drop_after bytes and downloads of the extensions in
+    failing always fail. The extensions in corrupt are served with a damaged
+    archive, while update manifests announce the digest of the intact file.
+    Range requests are only answered if ranges is True and update manifests
+    only announce digests and sizes if digests is True. If max_rate is set,
+    requests beyond that many per second (with bursts of up to a tenth of
+    that) are answered with 429 and a Retry-After header if retry_after is
+    set."""
+    def __init__(self, extensions=None, crx_size=1024, latency=0):
+        self.extensions = dict(extensions or {})
+        self.crx_size = crx_size
+        self.sizes = {}
+        self.latency = latency
+        self.drops = 0
+        self.drop_after = 0
+        self.ranges = True
+        self.digests = True
+        self.failing = set()
+        self.corrupt = set()
+        self.max_rate = None
+        self.retry_after = None
+        self._tokens = 0
+        self._last_refill = None
+        self.hits = Counter()
+        self.bytes_sent = 0
+        self.connections = 0
+        self.peak_connections = 0
+        self._crx_cache = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingServer(('127.0.0.1', 0), StubHandler)
+        self.httpd.stub = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    @property
+    def update_url(self):
+        return self.base_url + UPDATE_PATH
+
+    def crx_url(self, ext_id):
+        return '{}/crx/{}/{}'.format(self.base_url, ext_id,
+                                     crx_filename(self.extensions[ext_id]))
+
+    def crx_content(self, ext_id, corrupt=None):
+        """Return the CRX file served for ext_id. It is damaged if corrupt is
+        True or, by default, if ext_id is in the set corrupt."""
+        key = (ext_id, self.extensions[ext_id])
+        with self._lock:
+            if key not in self._crx_cache:
+                self._crx_cache[key] = make_crx(
+                    ext_id, key[1], self.sizes.get(ext_id, self.crx_size))
+            content = self._crx_cache[key]
+        if corrupt is None:
+            corrupt = ext_id in self.corrupt
+        if corrupt:
+            # flip a byte in the middle of the archive's padding
+            middle = len(content) // 2
+            content = (content[:middle] + bytes([content[middle] ^ 1]) +
+                       content[middle + 1:])
+        return content
+
+    def count(self, kind):
+        with self._lock:
+            self.hits[kind] += 1
+
+    def take_token(self):
+        """Return if the current request may be answered given max_rate,
+        or None if there is no max_rate."""
+        if self.max_rate is None:
+            return None
+        burst = max(self.max_rate / 10, 1)
+        with self._lock:
+            now = time.monotonic()
+            if self._last_refill is None:
+                self._tokens = burst
+            else:
+                self._tokens = min(burst, self._tokens + self.max_rate *
+                                   (now - self._last_refill))
+            self._last_refill = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def take_drop(self):
+        """Return after how many bytes the current download should be broken
+        off or None if it should be completed."""
+        with self._lock:
+            if not self.drops:
+                return None
+            self.drops -= 1
+            return self.drop_after
+
+    def count_bytes(self, amount):
+        with self._lock:
+            self.bytes_sent += amount
+
+    def open_connection(self, change):
+        with self._lock:
+            self.connections += change
+            self.peak_connections = max(self.peak_connections,
+                                        self.connections)
+
+    def reset_counters(self):
+        with self._lock:
+            self.hits.clear()
+            self.bytes_sent = 0
+            self.peak_connections = self.connections
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,85 @@
+import os
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+pytest.importorskip('aiohttp')
+from maninex import aio  # noqa: E402
+
+
+def snapshot(config_struct):
+    """Return the files below both directories of config_struct and the
+    contents of all json files."""
+    files = {}
+    for directory in (config_struct.ext_dir, config_struct.json_dir):
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                with open(path, 'rb') as file_:
+                    content = file_.read()
+                files[os.path.relpath(path, directory)] = (
+                    content.replace(directory.encode(), b'')
+                    if filename.endswith('.json') else len(content))
+    return files
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_engines_agree(tmpdir, stub_server, engine):
+    """Both engines should leave the same files behind and report the same
+    results."""
+    ext_ids = [make_ext_id(n) for n in range(30)]
+    for ext_id in ext_ids[:-1]:
+        stub_server.extensions[ext_id] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, ext_ids, {'update_url': stub_server.update_url})
+    install, update = maninex.get_engine(engine)
+
+    messages = [maninex.format_result(result)
+                for result in install(config_struct, 4)]
+    for ext_id in ext_ids[:5]:
+        stub_server.extensions[ext_id] = '1.1'
+    messages += [maninex.format_result(result)
+                 for result in update(config_struct, 4)]
+
+    expected = ([maninex.MESSAGES['installed'].format(ext_id[:11])
+                 for ext_id in ext_ids[:-1]] +
+                [maninex.MESSAGES['not_found'].format(ext_ids[-1][:11])] +
+                [maninex.MESSAGES['updated'].format(ext_id[:11])
+                 for ext_id in ext_ids[:5]] +
+                [maninex.MESSAGES['up_to_date'].format(ext_id[:11])
+                 for ext_id in ext_ids[5:-1]] +
+                [maninex.MESSAGES['not_installed'].format(ext_ids[-1][:11])])
+    assert messages == expected
+
+    files = snapshot(config_struct)
+    # a ref and a file in the archive for every update
+    assert len(files) == 29 * 2 + 5 * 2
+    assert os.path.join(maninex.ARCHIVE_DIR, 'refs', ext_ids[0],
+                        'extension_1_0.crx') in files
+    assert (os.path.join(ext_ids[0], 'extension_1_1.crx') in
+            files[ext_ids[0] + '.json'].decode())
+
+
+def test_async_failures_become_results(tmpdir):
+    config_struct = make_config_struct(
+        tmpdir, [make_ext_id(0)], {'update_url': 'http://127.0.0.1:1/',
+                                   'retries': '0'})
+    results = list(aio.install_extensions(config_struct, 4))
+    assert results[0].status == 'failed'
+
+
+def test_async_download_resumes(tmpdir, stub_server, monkeypatch):
+    monkeypatch.setattr(maninex, 'BACKOFF_BASE', 0)
+    ext_id = make_ext_id(0)
+    stub_server.extensions[ext_id] = '1.0'
+    stub_server.crx_size = 3 * maninex.CHUNK_SIZE
+    stub_server.drops = 2
+    stub_server.drop_after = maninex.CHUNK_SIZE // 2
+    config_struct = make_config_struct(
+        tmpdir, [ext_id], {'update_url': stub_server.update_url})
+    results = list(aio.install_extensions(config_struct, 4))
+    assert results[0].status == 'installed'
+    assert stub_server.hits['crx_range'] == 2
+    path = os.path.join(config_struct.ext_dir, ext_id, 'extension_1_0.crx')
+    with open(path, 'rb') as file_:
+        assert file_.read() == stub_server.crx_content(ext_id)
@@ -0,0 +1,146 @@
+import os
+import sys
+import subprocess
+import pytest
+from conftest import make_ext_id, make_config_struct
+import maninex
+from maninex import Manager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXT_IDS = [make_ext_id(n) for n in range(4)]
+
+
+@pytest.fixture
+def config_struct(tmpdir, stub_server):
+    for ext_id in EXT_IDS:
+        stub_server.extensions[ext_id] = '1.0'
+    return make_config_struct(tmpdir, EXT_IDS[:3],
+                              {'update_url': stub_server.update_url})
+
+
+def statuses(results):
+    return [result.status for result in results]
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_batches(config_struct, stub_server, engine):
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+    with Manager(config_struct, engine=engine) as manager:
+        # extensions don't have to be in the config file
+        results = manager.install(EXT_IDS[1:])
+        assert statuses(results) == ['installed'] * 3
+        assert [result.ext_ref.idstr for result in results] == EXT_IDS[1:]
+        for result in results:
+            assert result.version == '1.0'
+            assert result.stats.bytes == len(
+                stub_server.crx_content(result.ext_ref.idstr))
+            assert result.stats.phases['transfer'] > 0
+            assert result.stats.elapsed > 0
+        assert statuses(manager.install()) == (['installed'] +
+                                               ['already_installed'] * 2)
+
+        stub_server.extensions[EXT_IDS[3]] = '1.1'
+        results = manager.update([EXT_IDS[0], EXT_IDS[3]], refresh=True)
+        assert statuses(results) == ['up_to_date', 'updated']
+        assert results[1].version == '1.1'
+        assert [(result.status, result.version) for result in
+                manager.status([EXT_IDS[3], make_ext_id(9)])] == [
+            ('installed', '1.1'), ('not_installed', None)]
+
+
+def test_session_is_reused(config_struct, stub_server):
+    manager = Manager(config_struct)
+    assert manager.session is None
+    manager.install(EXT_IDS[:1])
+    session = manager.session
+    manager.install(EXT_IDS[1:2])
+    manager.update()
+    assert manager.session is session
+    manager.close()
+    assert manager.session is None
+
+
+def test_remove(config_struct):
+    with Manager(config_struct) as manager:
+        manager.install(EXT_IDS)
+        # by default, only extensions missing from the config file go
+        results = manager.remove()
+        assert [(result.ext_ref.idstr, result.status)
+                for result in results] == [(EXT_IDS[3], 'removed')]
+        assert statuses(manager.remove(EXT_IDS[:2] + EXT_IDS[3:])) == [
+            'removed', 'removed', 'not_installed']
+        assert statuses(manager.status()) == ['not_installed'] * 2 + [
+            'installed']
+    for ext_id in EXT_IDS[:2]:
+        assert not os.path.exists(os.path.join(config_struct.ext_dir, ext_id))
+        assert not os.path.exists(os.path.join(config_struct.json_dir,
+                                               ext_id + '.json'))
+
+
+def test_remove_other_names(config_struct):
+    """Folders and JSON files whose names aren't extension ids are removed
+    like other extensions missing from the config file."""
+    name = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ012345'
+    os.makedirs(os.path.join(config_struct.ext_dir, name, 'sub'))
+    open(os.path.join(config_struct.json_dir, 'policy.json'), 'w').close()
+    results = Manager(config_struct).remove()
+    assert sorted((result.ext_ref.idstr, result.status)
+                  for result in results) == [(name, 'removed'),
+                                             ('policy', 'removed')]
+    assert not os.listdir(config_struct.json_dir)
+    with pytest.raises(ValueError):
+        Manager(config_struct).remove([name])
+
+
+def test_profiles_from_path(tmpdir):
+    config_struct = make_config_struct(tmpdir, EXT_IDS)
+    with open(config_struct.config_file, 'a') as config_file:
+        config_file.write('[directories:work]\njson_dir = {}\n'
+                          'extension_dir = {}\n'.format(tmpdir, tmpdir))
+    manager = Manager(config_struct.config_file)
+    assert [profile.profile for profile in manager.profiles] == [
+        'default', 'work']
+    results = manager.status(EXT_IDS[:1])
+    assert [result.stats.profile for result in results] == ['default', 'work']
+
+
+def test_bad_ids(config_struct):
+    manager = Manager(config_struct)
+    with pytest.raises(ValueError):
+        manager.install(['../../etc'])
+    with pytest.raises(ValueError):
+        list(manager.run('reinstall'))
+
+
+def test_import_has_no_side_effects(tmpdir):
+    """Importing the package and creating a Manager shouldn't go online or
+    pull in the HTTP stack."""
+    config_struct = make_config_struct(tmpdir, EXT_IDS)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, maninex; maninex.Manager(sys.argv[1]).status(); '
+         'print(sorted(name for name in ("urllib3", "http.client", "ssl") '
+         'if name in sys.modules))', config_struct.config_file],
+        env=env, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    assert process.stdout == '[]\n'
+    assert maninex.ExtResult._fields[-1] == 'stats'
+
+
+def test_config_errors(tmpdir, monkeypatch, capsys):
+    """Settings that can't be used raise ConfigError instead of ending the
+    program; the command line turns them into a message."""
+    config_struct = make_config_struct(tmpdir, EXT_IDS, {'jobs': 'many'})
+    with pytest.raises(maninex.ConfigError) as error_info:
+        Manager(config_struct).install()
+    assert str(error_info.value) == (
+        'The jobs setting in maninex.conf has to be a number of at least 1.')
+    with pytest.raises(maninex.ConfigError):
+        Manager(str(tmpdir.join('missing.conf')))
+
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir))
+    with pytest.raises(SystemExit) as exit_info:
+        maninex.main(['--install'])
+    assert exit_info.value.code == 1
+    assert capsys.readouterr().err == str(error_info.value) + '\n'
@@ -0,0 +1,139 @@
+import os
+import time
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+EXT_IDS = [make_ext_id(n) for n in range(3)]
+
+
+@pytest.fixture
+def archive(tmpdir):
+    return maninex.Archive(str(tmpdir))
+
+
+def add_version(archive, ext_id, filename, content):
+    """Create an extension file in the folder of ext_id and archive it."""
+    ext_path = os.path.join(os.path.dirname(archive.path), ext_id)
+    os.makedirs(ext_path, exist_ok=True)
+    path = os.path.join(ext_path, filename)
+    with open(path, 'wb') as file_:
+        file_.write(content)
+    archive.add(ext_id, path)
+    # refs are ordered by their modification time
+    time.sleep(0.01)
+    assert not os.path.exists(path)
+
+
+def filenames(archive, ext_id):
+    return [entry[1] for entry in archive.versions().get(ext_id, [])]
+
+
+def blob_count(archive):
+    return sum(len(filenames) for _, _, filenames in
+               os.walk(os.path.join(archive.path, 'blobs')))
+
+
+def test_keep_versions(archive):
+    for number in range(5):
+        add_version(archive, EXT_IDS[0], 'extension_1_{}.crx'.format(number),
+                    bytes([number]) * 100)
+    add_version(archive, EXT_IDS[1], 'extension_2_0.crx.old', b'x' * 100)
+    assert archive.prune(2) == 300
+    assert filenames(archive, EXT_IDS[0]) == ['extension_1_4.crx',
+                                              'extension_1_3.crx']
+    # the suffix of backups made by earlier versions is dropped
+    assert filenames(archive, EXT_IDS[1]) == ['extension_2_0.crx']
+    assert blob_count(archive) == 3
+
+
+def test_identical_files_are_stored_once(archive):
+    for ext_id in EXT_IDS:
+        add_version(archive, ext_id, 'extension_1_0.crx', b'same' * 100)
+    assert blob_count(archive) == 1
+    archive.discard(EXT_IDS[0])
+    archive.prune(1)
+    assert blob_count(archive) == 1
+    assert sorted(archive.versions()) == EXT_IDS[1:]
+
+
+def test_max_size(archive):
+    for number, ext_id in enumerate(EXT_IDS):
+        add_version(archive, ext_id, 'extension_1_0.crx',
+                    bytes([number]) * 1000)
+    # the oldest versions go first, whichever extension they belong to
+    assert archive.prune(3, 2000) == 1000
+    assert sorted(archive.versions()) == EXT_IDS[1:]
+    assert archive.prune(0) == 2000
+    assert archive.versions() == {}
+
+
+def test_empty_archive(archive):
+    assert archive.versions() == {}
+    assert archive.prune(0) == 0
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_updates_are_pruned(tmpdir, stub_server, engine):
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+    stub_server.extensions[EXT_IDS[0]] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, EXT_IDS[:1], {'update_url': stub_server.update_url,
+                              'keep_versions': '2'})
+    install, update = maninex.get_engine(engine)
+    list(install(config_struct, 1))
+    for minor in range(1, 5):
+        stub_server.extensions[EXT_IDS[0]] = '1.{}'.format(minor)
+        assert [result.status for result in update(config_struct, 1)] == [
+            'updated']
+        time.sleep(0.01)
+
+    ext_path = os.path.join(config_struct.ext_dir, EXT_IDS[0])
+    assert os.listdir(ext_path) == ['extension_1_4.crx']
+    archive = maninex.Archive(config_struct.ext_dir)
+    assert filenames(archive, EXT_IDS[0]) == ['extension_1_3.crx',
+                                              'extension_1_2.crx']
+    assert blob_count(archive) == 2
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='changing owners needs root')
+def test_archive_belongs_to_owner_of_ext_dir(archive):
+    os.chown(os.path.dirname(archive.path), 4321, 4321)
+    add_version(archive, EXT_IDS[0], 'extension_1_0.crx', b'x' * 100)
+    # blobs keep the owner of the extension file
+    paths = [archive.ref_path(EXT_IDS[0], 'extension_1_0.crx')]
+    for root, _, _ in os.walk(archive.path):
+        paths.append(root)
+    for path in paths:
+        assert os.stat(path).st_uid == 4321
+
+
+def test_failed_archiving_keeps_backups(tmpdir, stub_server, monkeypatch):
+    """An archive that can't be written to doesn't fail updates."""
+    stub_server.extensions[EXT_IDS[0]] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, EXT_IDS[:1], {'update_url': stub_server.update_url})
+    index = maninex.StateIndex(config_struct)
+    list(maninex.install_extensions(config_struct, 1, index))
+
+    def read_only(self, path):
+        raise PermissionError(path)
+    monkeypatch.setattr(maninex.Archive, 'make_dir', read_only)
+    stub_server.extensions[EXT_IDS[0]] = '1.1'
+    assert [(result.status, result.version) for result in
+            maninex.update_extensions(config_struct, 1, index)] == [
+        ('updated', '1.1')]
+    assert index.get(EXT_IDS[0]).version == '1.1'
+    ext_path = os.path.join(config_struct.ext_dir, EXT_IDS[0])
+    assert sorted(os.listdir(ext_path)) == ['extension_1_0.crx.old',
+                                            'extension_1_1.crx']
+
+    # the next update archives the backup
+    monkeypatch.undo()
+    stub_server.extensions[EXT_IDS[0]] = '1.2'
+    list(maninex.update_extensions(config_struct, 1, index))
+    assert os.listdir(ext_path) == ['extension_1_2.crx']
+    archive = maninex.Archive(config_struct.ext_dir)
+    assert sorted(filenames(archive, EXT_IDS[0])) == ['extension_1_0.crx',
+                                                      'extension_1_1.crx']
@@ -0,0 +1,96 @@
+import os
+import json
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+UNKNOWN = make_ext_id(3)
+
+
+def setup_config(tmpdir, stub_server, monkeypatch, settings):
+    ext_ids = [make_ext_id(n) for n in range(4)]
+    for ext_id in ext_ids[:-1]:
+        stub_server.extensions[ext_id] = '1.0'
+    settings['update_url'] = stub_server.update_url
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir))
+    return make_config_struct(tmpdir, ext_ids, settings)
+
+
+def age_cache(config_struct, seconds):
+    """Pretend that all cache entries were stored seconds earlier."""
+    path = os.path.join(config_struct.ext_dir, maninex.CACHE_FILE)
+    with open(path) as cache_file:
+        data = json.load(cache_file)
+    for entry in data.values():
+        entry['checked'] -= seconds
+    with open(path, 'w') as cache_file:
+        json.dump(data, cache_file)
+
+
+def test_fresh_cache_skips_network(tmpdir, stub_server, monkeypatch, capsys):
+    setup_config(tmpdir, stub_server, monkeypatch, {})
+    maninex.install_mode()
+    stub_server.reset_counters()
+
+    maninex.update_mode()
+    maninex.install_mode()
+    assert stub_server.hits == {}
+    out = capsys.readouterr().out
+    assert out.count('up-to-date') == 3
+    assert out.count('not found') == 2
+
+    maninex.update_mode(refresh=True)
+    assert stub_server.hits == {'manifest': 1}
+
+
+def test_stale_entries_are_revalidated(tmpdir, stub_server, monkeypatch):
+    config_struct = setup_config(tmpdir, stub_server, monkeypatch,
+                                 {'negative_cache_ttl': '1000'})
+    maninex.install_mode()
+    # remove an installed extension, so that install has to look it up again
+    ext_id = make_ext_id(0)
+    os.remove(os.path.join(config_struct.json_dir, ext_id + '.json'))
+    maninex.reindex_mode()
+    age_cache(config_struct, maninex.DEFAULT_CACHE_TTL + 1)
+    stub_server.reset_counters()
+
+    maninex.install_mode()
+    # the unknown extension is still cached, the other one is revalidated
+    # and only downloaded afterwards
+    assert stub_server.hits == {'redirect_head': 1, 'crx_head': 1, 'crx': 1}
+    assert stub_server.bytes_sent == len(stub_server.crx_content(ext_id))
+
+    age_cache(config_struct, 1000)
+    stub_server.reset_counters()
+    maninex.install_mode()
+    assert stub_server.hits == {'redirect_head': 1}
+
+
+def test_revalidation_without_changes(tmpdir, stub_server):
+    config_struct = make_config_struct(
+        tmpdir, [make_ext_id(0)],
+        {'update_url': stub_server.update_url, 'cache_ttl': '0'})
+    stub_server.extensions[make_ext_id(0)] = '1.0'
+    cache = maninex.ResolveCache(config_struct)
+    first = maninex.ExtensionOnline(config_struct, make_ext_id(0),
+                                    cache=cache)
+    assert cache.entries[make_ext_id(0)].etag is not None
+
+    second = maninex.ExtensionOnline(config_struct, make_ext_id(0),
+                                     cache=cache)
+    assert second.requests_object.status_code == 304
+    assert second.url == first.url
+    assert second.version == '1.0'
+
+    stub_server.extensions[make_ext_id(0)] = '1.1'
+    third = maninex.ExtensionOnline(config_struct, make_ext_id(0),
+                                    cache=cache)
+    assert third.version == '1.1'
+    assert cache.entries[make_ext_id(0)].version == '1.1'
+
+
+@pytest.mark.parametrize('value', ['-1', 'soon'])
+def test_invalid_ttl(tmpdir, value):
+    config_struct = make_config_struct(tmpdir, [], {'cache_ttl': value})
+    with pytest.raises(maninex.ConfigError):
+        maninex.ResolveCache(config_struct)
@@ -0,0 +1,131 @@
+import time
+import threading
+import pytest
+from email.utils import formatdate
+from conftest import make_ext_id, make_config_struct
+from stub_server import StubServer
+from maninex import maninex
+
+
+def answer(limit, status=200, headers=None, latency=0.0):
+    """Send a request through limit that is answered after latency
+    seconds."""
+    started = limit.acquire()
+    time.sleep(latency)
+    limit.release(started, status, headers)
+
+
+def test_limit_grows_up_to_ceiling():
+    limit = maninex.ConcurrencyLimit(5)
+    assert limit.limit == maninex.INITIAL_JOBS
+    for _ in range(30):
+        answer(limit)
+    assert limit.limit == 5
+
+
+def test_requests_wait_for_free_slots():
+    limit = maninex.ConcurrencyLimit(5, initial=2)
+    started = [limit.acquire(), limit.acquire()]
+    thread = threading.Thread(target=limit.acquire)
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+    limit.release(started[0], 200)
+    thread.join(1)
+    assert not thread.is_alive()
+    assert limit.in_flight == 2
+
+
+def test_overload_halves_limit_once_per_round():
+    limit = maninex.ConcurrencyLimit(16, initial=8)
+    started = [limit.acquire() for _ in range(8)]
+    for start in started:
+        limit.release(start, 429)
+    # all eight were sent before the first answer, so they count once
+    assert limit.limit == 4
+    answer(limit, 503)
+    assert limit.limit == 2
+    # failures without an answer count as well
+    started = limit.acquire()
+    limit.release(started)
+    assert limit.limit == 1
+
+
+def test_rising_latency_shrinks_limit():
+    limit = maninex.ConcurrencyLimit(16, initial=8)
+    for _ in range(3):
+        answer(limit, latency=0.001)
+    before = limit.limit
+    for _ in range(5):
+        answer(limit, latency=0.2)
+    assert limit.limit < before
+
+
+def test_retry_after_holds_back_requests():
+    limit = maninex.ConcurrencyLimit(4)
+    answer(limit, 429, {'Retry-After': '0.3'})
+    start = time.monotonic()
+    limit.release(limit.acquire(), 200)
+    assert time.monotonic() - start >= 0.25
+
+
+def test_get_retry_after():
+    assert maninex.get_retry_after({}) is None
+    assert maninex.get_retry_after({'Retry-After': '5'}) == 5
+    assert maninex.get_retry_after({'Retry-After': 'soon'}) is None
+    assert maninex.get_retry_after(
+        {'Retry-After': '86400'}) == maninex.MAX_RETRY_AFTER
+    in_a_minute = formatdate(time.time() + 60, usegmt=True)
+    assert 55 < maninex.get_retry_after({'Retry-After': in_a_minute}) <= 60
+
+
+@pytest.fixture
+def throttling_server():
+    """A server that answers 100 requests per second at most."""
+    server = StubServer(latency=0.02).start()
+    server.max_rate = 100
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_throttling_server(tmpdir, throttling_server, engine, monkeypatch):
+    """Starting all requests at once would run into the server's rate
+    limit over and over. Throttled extensions must not be reported as not
+    found."""
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+    monkeypatch.setattr(maninex, 'BACKOFF_BASE', 0.05)
+    jobs = 32
+    ext_ids = [make_ext_id(n) for n in range(60)]
+    for ext_id in ext_ids:
+        throttling_server.extensions[ext_id] = '1.0'
+    # on a loaded machine, an unlucky extension can run into the limit a
+    # few times in a row, which ten retries with growing backoff outlast
+    config_struct = make_config_struct(
+        tmpdir, ext_ids, {'update_url': throttling_server.update_url,
+                          'retries': '10'})
+    install, _ = maninex.get_engine(engine)
+    results = list(install(config_struct, jobs))
+
+    assert [result.status for result in results] == ['installed'] * 60
+    hits = throttling_server.hits
+    throttled = hits['throttled'] + hits['throttled_head']
+    assert throttled < 0.3 * sum(hits.values())
+    assert throttling_server.peak_connections < jobs / 2
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_retry_after_is_honored(tmpdir, throttling_server, engine):
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+    throttling_server.retry_after = 0.2
+    ext_ids = [make_ext_id(n) for n in range(20)]
+    for ext_id in ext_ids:
+        throttling_server.extensions[ext_id] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, ext_ids, {'update_url': throttling_server.update_url,
+                          'retries': '5'})
+    install, _ = maninex.get_engine(engine)
+    results = list(install(config_struct, 16))
+    assert [result.status for result in results] == ['installed'] * 20
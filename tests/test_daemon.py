@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for(condition, timeout=10):
+    """Wait until condition() is true and return if it ever was."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def write_config(config_struct):
+    temp_path = config_struct.config_file + '.new'
+    with open(temp_path, 'w') as c_file:
+        config_struct.config.write(c_file)
+    os.replace(temp_path, config_struct.config_file)
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_config_watcher(tmpdir, use_inotify):
+    path = str(tmpdir.join('maninex.conf'))
+    with open(path, 'w') as c_file:
+        c_file.write('[extensions]\n')
+    watcher = maninex.ConfigWatcher(path, use_inotify)
+    if use_inotify and watcher.inotify_fd is None:
+        pytest.skip('inotify is not available')
+    try:
+        assert not watcher.changed()
+        start = time.monotonic()
+        watcher.wait(0.2)
+        assert time.monotonic() - start >= 0.2
+        assert not watcher.changed()
+
+        with open(path + '.new', 'w') as c_file:
+            c_file.write('[extensions]\nabc\n')
+        os.replace(path + '.new', path)
+        start = time.monotonic()
+        watcher.wait(10)
+        assert time.monotonic() - start < maninex.POLL_INTERVAL + 1
+        assert watcher.changed()
+        assert not watcher.changed()
+    finally:
+        watcher.close()
+
+
+def test_index_isnt_reread_while_unchanged(tmpdir, stub_server):
+    config_struct = make_config_struct(
+        tmpdir, [make_ext_id(0)], {'update_url': stub_server.update_url})
+    state = maninex.ExtState(version='1.0', filename='extension_1_0.crx',
+                             size=1, sha256='0',
+                             json_path=os.path.join(config_struct.json_dir,
+                                                    'x.json'))
+    index = maninex.StateIndex(config_struct)
+    with index.transaction():
+        index.record('x', state)
+    # entries in memory are used as they are
+    index.entries['x'] = state._replace(version='2.0')
+    with index.transaction():
+        assert index.get('x').version == '2.0'
+    # another process writes the index
+    other = maninex.StateIndex(config_struct)
+    with other.transaction():
+        other.discard('x')
+    with index.transaction():
+        assert 'x' not in index.entries
+
+
+def test_daemon(tmpdir, stub_server):
+    """The daemon should install new extensions when the config changes,
+    look for updates regularly and stop on SIGTERM."""
+    ext_ids = [make_ext_id(n) for n in range(3)]
+    for ext_id in ext_ids:
+        stub_server.extensions[ext_id] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, ext_ids[:1], {'update_url': stub_server.update_url,
+                              'update_interval': '1', 'update_jitter': '0',
+                              'cache_ttl': '0'})
+    env = dict(os.environ, XDG_CONFIG_HOME=str(tmpdir), PYTHONPATH=ROOT)
+    daemon = subprocess.Popen(
+        [sys.executable, '-c', 'import maninex; maninex.main()', '--daemon'],
+        env=env, stdout=subprocess.PIPE, universal_newlines=True)
+
+    def installed(ext_id, version='1.0'):
+        path = os.path.join(config_struct.json_dir, ext_id + '.json')
+        try:
+            with open(path) as json_file:
+                return json.load(json_file)['external_version'] == version
+        except (OSError, ValueError):
+            return False
+
+    try:
+        assert wait_for(lambda: installed(ext_ids[0]))
+
+        config_struct.config['extensions'][ext_ids[1]] = None
+        write_config(config_struct)
+        assert wait_for(lambda: installed(ext_ids[1]))
+
+        stub_server.extensions[ext_ids[0]] = '1.1'
+        assert wait_for(lambda: installed(ext_ids[0], '1.1'))
+
+        # config changes made while the daemon is busy aren't lost either
+        daemon.send_signal(signal.SIGHUP)
+        config_struct.config['extensions'][ext_ids[2]] = None
+        write_config(config_struct)
+        assert wait_for(lambda: installed(ext_ids[2]))
+
+        daemon.send_signal(signal.SIGTERM)
+        output, _ = daemon.communicate(timeout=10)
+    finally:
+        if daemon.poll() is None:
+            daemon.kill()
+            daemon.communicate()
+    assert daemon.returncode == 0
+    lines = output.splitlines()
+    assert lines[0] == 'maninex daemon started.'
+    assert lines[-1] == 'maninex daemon stopped.'
+    assert 'Configuration reloaded.' in lines
+    assert maninex.MESSAGES['updated'].format(ext_ids[0][:11]) in lines
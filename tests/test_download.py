@@ -0,0 +1,128 @@
+import os
+import time
+import pytest
+from conftest import make_ext_id, make_config_struct
+from stub_server import StubServer
+from maninex import maninex
+
+
+def test_interrupted_download_leaves_nothing(tmpdir):
+    """An error while downloading should neither leave a partial file nor
+    touch an existing file."""
+    ext_path = str(tmpdir.mkdir('ext'))
+    ext_path_file = os.path.join(ext_path, 'extension_1_0.crx')
+    maninex.download_ext(ext_path, ext_path_file, b'complete')
+
+    def chunks():
+        yield b'trunc'
+        raise ConnectionError('connection lost')
+
+    with pytest.raises(ConnectionError):
+        maninex.download_ext(ext_path, ext_path_file, chunks())
+    assert os.listdir(ext_path) == ['extension_1_0.crx']
+    with open(ext_path_file, 'rb') as file_:
+        assert file_.read() == b'complete'
+
+
+def test_streamed_install(tmpdir):
+    """Large files should arrive complete and without leftovers."""
+    server = StubServer(crx_size=5 * maninex.CHUNK_SIZE + 123).start()
+    try:
+        ext_id = make_ext_id(0)
+        server.extensions[ext_id] = '2.0'
+        config_struct = make_config_struct(
+            tmpdir, [ext_id], {'update_url': server.update_url})
+        ext_ref = next(maninex.get_exts_from_config(config_struct.config))
+        result = maninex.process_extension_install(config_struct, ext_ref)
+        assert result.status == 'installed'
+        ext_path = os.path.join(config_struct.ext_dir, ext_id)
+        assert os.listdir(ext_path) == ['extension_2_0.crx']
+        with open(os.path.join(ext_path, 'extension_2_0.crx'), 'rb') as f:
+            assert f.read() == server.crx_content(ext_id)
+    finally:
+        server.stop()
+
+
+@pytest.fixture
+def flaky_server(tmpdir, monkeypatch):
+    """A server whose 4 chunk downloads break off in the middle of the second
+    chunk, plus a config_struct for its only extension."""
+    monkeypatch.setattr(maninex, 'BACKOFF_BASE', 0)
+    server = StubServer(crx_size=4 * maninex.CHUNK_SIZE).start()
+    server.drop_after = maninex.CHUNK_SIZE + 1000
+    ext_id = make_ext_id(0)
+    server.extensions[ext_id] = '1.0'
+    server.config_struct = make_config_struct(
+        tmpdir, [ext_id], {'update_url': server.update_url, 'retries': '3'})
+    yield server
+    server.stop()
+
+
+def install(config_struct):
+    return next(maninex.install_extensions(config_struct, 1))
+
+
+def crx_content(config_struct, ext_id=make_ext_id(0)):
+    ext_path = os.path.join(config_struct.ext_dir, ext_id)
+    assert os.listdir(ext_path) == ['extension_1_0.crx']
+    with open(os.path.join(ext_path, 'extension_1_0.crx'), 'rb') as file_:
+        return file_.read()
+
+
+def test_dropped_download_resumes(flaky_server):
+    """Broken off downloads should continue where they stopped."""
+    flaky_server.drops = 2
+    assert install(flaky_server.config_struct).status == 'installed'
+    content = flaky_server.crx_content(make_ext_id(0))
+    assert crx_content(flaky_server.config_struct) == content
+    assert flaky_server.hits['crx'] == 3
+    assert flaky_server.hits['crx_range'] == 2
+    # data that arrived after the last complete chunk is fetched again
+    assert flaky_server.bytes_sent < len(content) + flaky_server.drop_after
+
+
+def test_dropped_download_restarts_without_ranges(flaky_server):
+    flaky_server.drops = 2
+    flaky_server.ranges = False
+    assert install(flaky_server.config_struct).status == 'installed'
+    content = flaky_server.crx_content(make_ext_id(0))
+    assert crx_content(flaky_server.config_struct) == content
+    assert flaky_server.hits['crx'] == 3
+    assert flaky_server.bytes_sent == len(content) + 2 * (
+        flaky_server.drop_after)
+
+
+def test_retries_are_bounded(flaky_server):
+    """Downloads that keep failing should fail without leaving anything
+    behind."""
+    flaky_server.drops = 10
+    flaky_server.drop_after = 0
+    result = install(flaky_server.config_struct)
+    assert result.status == 'failed'
+    assert flaky_server.hits['crx'] == 4
+    ext_path = os.path.join(flaky_server.config_struct.ext_dir,
+                            make_ext_id(0))
+    assert os.listdir(ext_path) == []
+
+
+def test_read_timeout(tmpdir):
+    server = StubServer(latency=3).start()
+    try:
+        ext_id = make_ext_id(0)
+        server.extensions[ext_id] = '1.0'
+        config_struct = make_config_struct(
+            tmpdir, [ext_id], {'update_url': server.update_url,
+                               'read_timeout': '1', 'retries': '0'})
+        start = time.monotonic()
+        result = install(config_struct)
+        assert result.status == 'failed'
+        assert time.monotonic() - start < 2.5
+    finally:
+        server.stop()
+
+
+def test_backoff_delay():
+    for attempt in range(20):
+        delay = maninex.backoff_delay(attempt)
+        assert 0 <= delay <= min(maninex.BACKOFF_MAX,
+                                 maninex.BACKOFF_BASE * 2 ** attempt)
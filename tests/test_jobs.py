@@ -0,0 +1,57 @@
+import time
+import pytest
+from conftest import make_ext_id, make_config_struct
+from stub_server import StubServer
+from maninex import maninex
+
+LATENCY = 0.02
+JOBS = 4
+
+
+@pytest.fixture
+def slow_server():
+    server = StubServer(latency=LATENCY).start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize('count', [20, 80])
+def test_install_is_bounded(tmpdir, slow_server, count):
+    """Installing should never use more than JOBS connections and should
+    clearly be faster than processing all extensions one after another."""
+    ext_ids = [make_ext_id(n) for n in range(count)]
+    for ext_id in ext_ids:
+        slow_server.extensions[ext_id] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, ext_ids, {'update_url': slow_server.update_url})
+
+    start = time.perf_counter()
+    results = list(maninex.install_extensions(config_struct, JOBS))
+    elapsed = time.perf_counter() - start
+
+    assert [result.status for result in results] == ['installed'] * count
+    assert [result.ext_ref.idstr for result in results] == ext_ids
+    assert slow_server.peak_connections <= JOBS
+    # every installation takes three requests
+    serial_time = count * 3 * LATENCY
+    assert elapsed < serial_time / 2
+
+
+def test_failures_become_results(tmpdir):
+    """Network errors shouldn't escape from the worker threads."""
+    ext_ids = [make_ext_id(0)]
+    config_struct = make_config_struct(
+        tmpdir, ext_ids, {'update_url': 'http://127.0.0.1:1/',
+                          'retries': '0'})
+    results = list(maninex.install_extensions(config_struct, JOBS))
+    assert results[0].status == 'failed'
+    assert maninex.format_result(results[0]).startswith(
+        'Extension "{}" failed: '.format(ext_ids[0][:11]))
+
+
+def test_get_jobs():
+    config = maninex.configparser.ConfigParser()
+    assert maninex.get_jobs(config) == maninex.DEFAULT_JOBS
+    config['settings'] = {'jobs': '3'}
+    assert maninex.get_jobs(config) == 3
+    assert maninex.get_jobs(config, 5) == 5
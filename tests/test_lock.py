@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex, Manager
+
+EXT_IDS = [make_ext_id(n) for n in range(3)]
+
+
+@pytest.fixture
+def config_struct(tmpdir, stub_server):
+    for ext_id in EXT_IDS:
+        stub_server.extensions[ext_id] = '1.0'
+    return make_config_struct(tmpdir.mkdir('reference'), EXT_IDS,
+                              {'update_url': stub_server.update_url})
+
+
+def statuses(results):
+    return [result.status for result in results]
+
+
+def make_client(tmpdir, config_struct):
+    """Return the Configs object of a fresh machine with the config file and
+    the lockfile of config_struct."""
+    client = make_config_struct(tmpdir.mkdir('client'), [])
+    with open(client.config_file, 'w') as config_file:
+        config_struct.config.write(config_file)
+    os.link(maninex.get_lock_path(config_struct.config_file),
+            maninex.get_lock_path(client.config_file))
+    return client._replace(config=config_struct.config)
+
+
+@pytest.mark.parametrize('digests', [True, False])
+def test_lock(config_struct, stub_server, digests):
+    """Digests the update service doesn't announce are taken from the
+    files."""
+    stub_server.digests = digests
+    with Manager(config_struct) as manager:
+        manager.install(EXT_IDS[:1])
+        stub_server.reset_counters()
+        assert statuses(manager.lock()) == ['locked'] * 3
+    # only the files that aren't installed are downloaded for hashing
+    assert stub_server.hits['crx'] == (0 if digests else 2)
+
+    lock_path = os.path.join(os.path.dirname(config_struct.config_file),
+                             'maninex.lock')
+    with open(lock_path) as lock_file:
+        entries = json.load(lock_file)['extensions']
+    assert sorted(entries) == EXT_IDS
+    for ext_id, entry in entries.items():
+        content = stub_server.crx_content(ext_id)
+        assert entry == {'version': '1.0', 'url': stub_server.crx_url(ext_id),
+                         'sha256': hashlib.sha256(content).hexdigest(),
+                         'size': len(content)}
+    # nothing is left behind by hashing
+    assert not [name for name in os.listdir(config_struct.ext_dir)
+                if name.endswith('.part')]
+    assert maninex.get_existing_folders(config_struct.ext_dir) == {
+        EXT_IDS[0]}
+
+
+def test_failed_lookups_keep_the_lockfile(config_struct, stub_server,
+                                          monkeypatch):
+    monkeypatch.setattr(maninex, 'BACKOFF_BASE', 0.01)
+    with Manager(config_struct) as manager:
+        manager.lock()
+        stub_server.extensions[EXT_IDS[0]] = '1.1'
+        stub_server.stop()
+        # drop connections the stub would still answer on
+        manager.close()
+        assert set(statuses(manager.lock(refresh=True))) == {'failed'}
+    lock = maninex.read_lock(maninex.get_lock_path(config_struct.config_file))
+    assert lock[EXT_IDS[0]].version == '1.0'
+
+
+def test_locked_install(tmpdir, config_struct, stub_server):
+    with Manager(config_struct) as manager:
+        manager.lock()
+    client = make_client(tmpdir, config_struct)
+    with Manager(client) as manager:
+        assert statuses(manager.install(EXT_IDS[:2], locked=True)) == [
+            'installed'] * 2
+        assert statuses(manager.verify()) == ['as_locked'] * 2 + ['missing']
+
+        # newer files don't match the locked digests
+        stub_server.extensions[EXT_IDS[2]] = '1.1'
+        result, = manager.install(EXT_IDS[2:], locked=True)
+        assert result.status == 'failed'
+        assert isinstance(result.error, maninex.VerificationError)
+
+        # other installed versions are replaced with the locked one
+        manager.update(EXT_IDS[2:])
+        manager.install(EXT_IDS[1:2])
+        stub_server.extensions[EXT_IDS[1]] = '1.1'
+        manager.update(EXT_IDS[1:2], refresh=True)
+        assert statuses(manager.verify(EXT_IDS[1:2])) == ['not_as_locked']
+        stub_server.extensions[EXT_IDS[1]] = '1.0'
+        assert [(result.status, result.version) for result in
+                manager.install(EXT_IDS[1:2], locked=True)] == [
+            ('updated', '1.0')]
+        assert statuses(manager.verify(EXT_IDS[1:2])) == ['as_locked']
+
+        result, = manager.install([make_ext_id(9)], locked=True)
+        assert result.status == 'not_locked'
+
+
+def test_status_mode(config_struct, stub_server, monkeypatch, capsys):
+    monkeypatch.setenv('XDG_CONFIG_HOME', os.path.dirname(
+        config_struct.config_file))
+    with pytest.raises(SystemExit):
+        maninex.main(['--status'])
+    maninex.main(['--lock'])
+    maninex.main(['--install', '--locked'])
+    stub_server.stop()
+    capsys.readouterr()
+    # no network needed
+    maninex.main(['--status'])
+    names = [ext_id[:11] for ext_id in EXT_IDS]
+    assert capsys.readouterr().out.splitlines() == [
+        maninex.MESSAGES['as_locked'].format(name) for name in names]
+
+    # a file changed behind maninex's back
+    ext_path = os.path.join(config_struct.ext_dir, EXT_IDS[0])
+    with open(os.path.join(ext_path, 'extension_1_0.crx'), 'ab') as crx:
+        crx.write(b'more')
+    with pytest.raises(SystemExit) as exit_info:
+        maninex.main(['--status'])
+    assert exit_info.value.code == 1
+    assert capsys.readouterr().out.splitlines()[0] == maninex.MESSAGES[
+        'not_as_locked'].format(names[0])
+
+
+def test_locked_needs_install(capsys):
+    maninex.main(['--update', '--locked'])
+    assert capsys.readouterr().out == '--locked only works with --install.\n'
+
+
+def test_locked_digests_are_checked(tmpdir, config_struct, stub_server):
+    """Neither files in the store nor installed ones are taken on trust."""
+    config_struct.config['settings']['store_dir'] = str(tmpdir.mkdir('store'))
+    with Manager(config_struct) as manager:
+        manager.install()
+        manager.lock()
+    lock_path = maninex.get_lock_path(config_struct.config_file)
+    lock = maninex.read_lock(lock_path)
+    maninex.write_lock(lock_path, {
+        ext_id: info._replace(sha256='0' * 64) for ext_id, info in
+        lock.items()})
+
+    client = make_client(tmpdir, config_struct)
+    with Manager(client) as manager:
+        results = manager.install(EXT_IDS[:1], locked=True)
+    with Manager(config_struct) as manager:
+        results += manager.install(EXT_IDS[1:2], locked=True)
+    for result in results:
+        assert result.status == 'failed'
+        assert str(result.error) == 'SHA-256 digest mismatch'
@@ -0,0 +1,119 @@
+import io
+import os
+import json
+import zipfile
+import pytest
+from conftest import make_ext_id, make_config_struct
+from stub_server import make_crx, make_crx_header
+from maninex import maninex
+
+EXT_ID = make_ext_id(3)
+
+
+def build_crx(files, compression=zipfile.ZIP_DEFLATED, ext_id=EXT_ID):
+    """Return a CRX3 file whose archive contains files (a dict mapping names
+    to contents)."""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', compression) as zip_file:
+        for name, content in files.items():
+            zip_file.writestr(name, content)
+    header = make_crx_header(ext_id)
+    return (b'Cr24' + (3).to_bytes(4, 'little') +
+            len(header).to_bytes(4, 'little') + header + archive.getvalue())
+
+
+def write_file(tmpdir, content, name='extension_1_0.crx'):
+    path = str(tmpdir.join(name))
+    with open(path, 'wb') as file_:
+        file_.write(content)
+    return path
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_STORED,
+                                         zipfile.ZIP_DEFLATED])
+def test_manifest_is_read(tmpdir, compression):
+    manifest = {'name': 'Some Extension', 'version': '2.10.3'}
+    path = write_file(tmpdir, build_crx(
+        {'background.js': 'x' * 5000, 'manifest.json': json.dumps(manifest)},
+        compression))
+    assert maninex.read_crx_manifest(path) == maninex.CrxManifest(
+        version='2.10.3', name='Some Extension')
+
+
+def test_localized_name(tmpdir):
+    manifest = {'name': '__MSG_extName__', 'version': '1',
+                'default_locale': 'en'}
+    messages = {'ExtName': {'message': 'Localized Name'}}
+    path = write_file(tmpdir, build_crx(
+        {'manifest.json': json.dumps(manifest),
+         '_locales/en/messages.json': json.dumps(messages)}))
+    assert maninex.read_crx_manifest(path).name == 'Localized Name'
+
+
+@pytest.mark.parametrize('content', [
+    b'',
+    b'Cr24',
+    make_crx(EXT_ID, '1.0')[:-30],
+    build_crx({'background.js': 'x'}),
+    build_crx({'manifest.json': '{"version": '}),
+], ids=['empty', 'header', 'truncated', 'no_manifest', 'bad_json'])
+def test_damaged_files(tmpdir, content):
+    path = write_file(tmpdir, content)
+    with pytest.raises(maninex.VerificationError):
+        maninex.read_crx_manifest(path)
+
+
+def test_version_doesnt_depend_on_filename(tmpdir):
+    ext_path = tmpdir.mkdir(EXT_ID)
+    write_file(ext_path, make_crx(EXT_ID, '3.1'), 'extension_foo.crx')
+    assert maninex.get_local_version(str(tmpdir), EXT_ID) == '3.1'
+    # files that can't be read fall back to the version in their name
+    os.remove(str(ext_path.join('extension_foo.crx')))
+    write_file(ext_path, b'no crx', 'extension_4_2.crx')
+    assert maninex.get_local_version(str(tmpdir), EXT_ID) == '4.2'
+
+
+def test_installed_version_comes_from_manifest(tmpdir, stub_server):
+    """The JSON file should name the version in the manifest, even if the
+    update service says something else."""
+    stub_server.extensions[EXT_ID] = '1.0'
+    content = stub_server.crx_content(EXT_ID)
+    stub_server.extensions[EXT_ID] = '1.1'
+    stub_server._crx_cache[(EXT_ID, '1.1')] = content
+    config_struct = make_config_struct(
+        tmpdir, [EXT_ID], {'update_url': stub_server.update_url})
+    ext_ref = next(maninex.get_exts_from_config(config_struct.config))
+    result = maninex.process_extension_install(config_struct, ext_ref)
+    assert result.version == '1.0'
+    with open(os.path.join(config_struct.json_dir, EXT_ID + '.json')) as f:
+        assert json.load(f)['external_version'] == '1.0'
+
+
+def test_scan_uses_manifest_names(tmpdir, stub_server, monkeypatch, capsys):
+    ext_ids = [make_ext_id(n) for n in range(4)]
+    for ext_id in ext_ids:
+        stub_server.extensions[ext_id] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, ext_ids, {'update_url': stub_server.update_url})
+    list(maninex.install_extensions(config_struct, 4))
+    # the second extension gets an unusable name, the third the name of
+    # the fourth and the fourth is listed already
+    for ext_id, name in [(ext_ids[1], '#: ='), (ext_ids[2], 'Extension 4')]:
+        write_file(tmpdir.join('ext', ext_id), build_crx(
+            {'manifest.json': json.dumps({'name': name, 'version': '1.0'})},
+            ext_id=ext_id))
+    config = config_struct.config
+    config['extensions'] = {'Extension 4': ext_ids[3]}
+    with open(config_struct.config_file, 'w') as c_file:
+        config.write(c_file)
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir))
+
+    maninex.scan_mode()
+    config = maninex.get_config().config
+    assert dict(config['extensions']) == {
+        'Extension 4': ext_ids[3],
+        'Extension ' + ext_ids[0][:8]: ext_ids[0],
+        ext_ids[1]: None,
+        ext_ids[2]: None}
+    out = capsys.readouterr().out
+    assert 'Extension Extension {} added.'.format(ext_ids[0][:8]) in out
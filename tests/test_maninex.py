@@ -5,6 +5,7 @@ import shutil
 import configparser
 from threading import Thread
 import pytest
+from stub_server import make_crx
 from maninex import maninex
 
 CONF_CONTENT = '''
@@ -83,11 +84,14 @@ def test_update_extensions(config_struct):
 
     for ext_ref in exts:
         ext_obj = maninex.ExtensionOnline(config_struct, ext_ref.idstr)
-        # rename the extension files, so they appear out of date
+        # replace the extension files with files of an old version under
+        # another name, so they appear out of date
         filepath = ext_obj.ext_path_file
         new_filename = re.sub(r'(\d[\d_]+)', 'foo', os.path.basename(filepath))
         new_filepath = os.path.join(os.path.dirname(filepath), new_filename)
-        os.rename(filepath, new_filepath)
+        os.remove(filepath)
+        with open(new_filepath, 'wb') as file_:
+            file_.write(make_crx(ext_ref.idstr, '0.1'))
 
     threads = []
     dir_list = maninex.get_existing_folders(config_struct.ext_dir)
@@ -107,10 +111,7 @@ def test_update_extensions(config_struct):
         local_version = maninex.get_local_version(config_struct.ext_dir,
                                                   ext_ref.idstr)
         assert local_version == ext_obj.version
-        # assume there's an .old backup file for every extension in their
-        # respective directory
-        for f in os.scandir(ext_obj.ext_path):
-            if f.name.endswith('.foo.old'):
-                break
-        else:
-            raise FileNotFoundError
+        # the old file of every extension went to the archive
+        archive = maninex.Archive(config_struct.ext_dir)
+        assert any(name.endswith('.foo') for name in
+                   os.listdir(archive.ref_path(ext_ref.idstr)))
@@ -0,0 +1,236 @@
+import time
+import socket
+import hashlib
+import threading
+import configparser
+import pytest
+import requests
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex, mirror
+
+EXT_IDS = [make_ext_id(n) for n in range(5)]
+
+
+@pytest.fixture
+def mirror_server(tmpdir, stub_server):
+    """A mirror of stub_server, storing its files below tmpdir."""
+    store_dir = tmpdir.mkdir('store')
+    config_struct = make_config_struct(
+        tmpdir.mkdir('mirror'), [], {'update_url': stub_server.update_url,
+                                     'store_dir': str(store_dir)})
+    for ext_id in EXT_IDS:
+        stub_server.extensions[ext_id] = '1.0'
+    with maninex.make_session(8) as session:
+        server = mirror.MirrorServer(('127.0.0.1', 0), mirror.Mirror(
+            config_struct, maninex.CrxStore(str(store_dir)), session))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+
+def install_client(tmpdir, server, ext_ids=EXT_IDS, engine='threads'):
+    """Install ext_ids into a fresh client below tmpdir that uses server as
+    its update service and return the results."""
+    config_struct = make_config_struct(tmpdir, ext_ids,
+                                       {'update_url': server.update_url})
+    install, _ = maninex.get_engine(engine)
+    return config_struct, list(install(config_struct, 4))
+
+
+def wait_for_refresh(server):
+    """Wait until the background lookups of server's mirror are done."""
+    while server.mirror._refreshing:
+        time.sleep(0.05)
+
+
+def crx_url(server, ext_id, version='1.0'):
+    return server.update_url.replace(
+        mirror.UPDATE_PATH, '/crx/{}/{}'.format(
+            ext_id, mirror.mirror_filename(version)))
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_fleet_downloads_once(tmpdir, stub_server, mirror_server, engine):
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+    for number in range(3):
+        _, results = install_client(
+            tmpdir.mkdir('client{}'.format(number)), mirror_server,
+            engine=engine)
+        assert [result.status for result in results] == ['installed'] * 5
+    assert stub_server.hits['crx'] == 5
+    for ext_id in EXT_IDS:
+        path = tmpdir.join('client2', 'ext', ext_id, 'extension_1_0.crx')
+        assert path.read_binary() == stub_server.crx_content(ext_id)
+
+
+def test_updates_are_mirrored(tmpdir, stub_server, mirror_server):
+    mirror_server.mirror.cache.ttl = 0
+    config_struct, _ = install_client(tmpdir, mirror_server)
+    stub_server.extensions[EXT_IDS[0]] = '1.1'
+    _, update = maninex.get_engine('threads')
+    # the first client to ask gets the stale entries, which are refreshed
+    # in the background
+    assert [result.status for result in update(config_struct, 4)] == [
+        'up_to_date'] * 5
+    wait_for_refresh(mirror_server)
+    results = list(update(config_struct, 4))
+    assert [result.status for result in results] == (
+        ['updated'] + ['up_to_date'] * 4)
+    assert results[0].version == '1.1'
+    assert stub_server.hits['crx'] == 6
+
+
+def test_upstream_outage(tmpdir, stub_server, mirror_server, monkeypatch):
+    """Once the mirror has seen an extension, clients can install it without
+    the upstream service. Extensions it never saw fail instead of being
+    reported as not found."""
+    monkeypatch.setattr(maninex, 'BACKOFF_BASE', 0.01)
+    mirror_server.mirror.cache.ttl = 0
+    install_client(tmpdir.mkdir('first'), mirror_server, EXT_IDS[:2])
+    stub_server.stop()
+    # drop connections the stub would still answer on
+    mirror_server.mirror.session.close()
+    _, results = install_client(tmpdir.mkdir('second'), mirror_server,
+                                EXT_IDS[:3])
+    assert [result.status for result in results] == [
+        'installed', 'installed', 'failed']
+
+
+def test_unresponsive_upstream(tmpdir, mirror_server, monkeypatch):
+    """An upstream service that accepts connections but never answers
+    doesn't hold up clients: they get the entries the mirror has, and
+    lookups the mirror can't answer fail once and then right away."""
+    monkeypatch.setattr(maninex, 'BACKOFF_BASE', 0.01)
+    mirror_ = mirror_server.mirror
+    install_client(tmpdir.mkdir('first'), mirror_server, EXT_IDS[:2])
+    with socket.socket() as black_hole:
+        black_hole.bind(('127.0.0.1', 0))
+        black_hole.listen(16)
+        settings = mirror_.config_struct.config['settings']
+        settings['update_url'] = 'http://127.0.0.1:{}{}'.format(
+            black_hole.getsockname()[1], mirror.UPDATE_PATH)
+        settings['read_timeout'] = '1'
+        settings['retries'] = '0'
+        mirror_.cache.ttl = 0
+
+        start = time.monotonic()
+        _, results = install_client(tmpdir.mkdir('second'), mirror_server,
+                                    EXT_IDS[:2])
+        assert [result.status for result in results] == ['installed'] * 2
+        assert time.monotonic() - start < 1
+        # the stale entries were refreshed in the background, which failed
+        wait_for_refresh(mirror_server)
+        assert mirror_.backing_off()
+        start = time.monotonic()
+        _, results = install_client(tmpdir.mkdir('third'), mirror_server,
+                                    EXT_IDS[2:3])
+        assert results[0].status == 'failed'
+        assert time.monotonic() - start < 1
+
+
+def test_unknown_extensions(tmpdir, mirror_server):
+    _, results = install_client(tmpdir, mirror_server, [make_ext_id(99)])
+    assert results[0].status == 'not_found'
+
+
+def test_ranges_and_etags(stub_server, mirror_server):
+    url = crx_url(mirror_server, EXT_IDS[0])
+    content = stub_server.crx_content(EXT_IDS[0])
+    response = requests.get(url)
+    assert response.content == content
+    etag = response.headers['ETag']
+    assert etag == '"{}"'.format(hashlib.sha256(content).hexdigest())
+    size = len(content)
+
+    def get(**headers):
+        return requests.get(url, headers=headers)
+
+    response = get(Range='bytes=10-')
+    assert response.status_code == 206
+    assert response.content == content[10:]
+    assert response.headers['Content-Range'] == 'bytes 10-{}/{}'.format(
+        size - 1, size)
+    assert get(Range='bytes=5-9').content == content[5:10]
+    assert get(Range='bytes=-4').content == content[-4:]
+    response = get(Range='bytes=10-', **{'If-Range': '"other"'})
+    assert (response.status_code, response.content) == (200, content)
+    response = get(Range='bytes=10-', **{'If-Range': etag})
+    assert response.status_code == 206
+    assert get(Range='bytes={}-'.format(size)).status_code == 416
+    assert get(**{'If-None-Match': etag}).status_code == 304
+    response = requests.head(url)
+    assert response.headers['Content-Length'] == str(size)
+    assert response.content == b''
+    assert stub_server.hits['crx'] == 1
+
+
+def test_head_requests_stay_local(stub_server, mirror_server):
+    """HEAD requests are answered from the announced size and digest of
+    files that aren't stored yet, without downloading them."""
+    ext_id = EXT_IDS[0]
+    requests.get(mirror_server.update_url,
+                 params={'x': 'id={}&uc'.format(ext_id)})
+    content = stub_server.crx_content(ext_id)
+    response = requests.head(crx_url(mirror_server, ext_id))
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(len(content))
+    assert response.headers['ETag'] == '"{}"'.format(
+        hashlib.sha256(content).hexdigest())
+    # nothing is known about other files
+    assert requests.head(crx_url(mirror_server, EXT_IDS[1])
+                         ).status_code == 404
+    assert not stub_server.hits['crx']
+    assert mirror_server.mirror.store.lookup(
+        ext_id, mirror.mirror_filename('1.0')) is None
+
+
+def test_unavailable_files(stub_server, mirror_server):
+    # versions other than the latest one aren't fetched
+    response = requests.get(crx_url(mirror_server, EXT_IDS[0], '0.9'))
+    assert response.status_code == 404
+    assert requests.get(crx_url(mirror_server, make_ext_id(99))
+                        ).status_code == 404
+    # failing and damaged downloads aren't stored
+    stub_server.failing.add(EXT_IDS[1])
+    stub_server.corrupt.add(EXT_IDS[2])
+    for ext_id in EXT_IDS[1:3]:
+        url = crx_url(mirror_server, ext_id)
+        assert requests.get(url).status_code == 502
+        assert mirror_server.mirror.store.lookup(
+            ext_id, mirror.mirror_filename('1.0')) is None
+    stub_server.failing.clear()
+    stub_server.corrupt.clear()
+    assert requests.get(crx_url(mirror_server, EXT_IDS[1])).ok
+
+
+def test_bad_requests(mirror_server):
+    update_url = mirror_server.update_url
+    assert requests.get(update_url).status_code == 400
+    assert requests.get(update_url,
+                        params={'x': 'id=../etc&uc'}).status_code == 400
+    assert requests.get(update_url.replace(
+        mirror.UPDATE_PATH, '/crx/../../etc/passwd')).status_code == 404
+
+
+@pytest.mark.parametrize('address, expected', [
+    (None, ('localhost', 8080)),
+    ('0.0.0.0:80', ('0.0.0.0', 80)),
+    (':8000', ('', 8000)),
+    ('[::1]:8000', ('::1', 8000)),
+])
+def test_serve_address(address, expected):
+    config = configparser.ConfigParser()
+    config['settings'] = {'serve_address': address} if address else {}
+    assert mirror.get_serve_address(config) == expected
+
+
+@pytest.mark.parametrize('address', ['localhost', 'localhost:http',
+                                     'localhost:70000'])
+def test_bad_serve_address(address):
+    config = configparser.ConfigParser()
+    config['settings'] = {'serve_address': address}
+    with pytest.raises(maninex.ConfigError):
+        mirror.get_serve_address(config)
@@ -0,0 +1,117 @@
+import os
+import time
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+# installed, not installed, json without folder, empty folder
+CONFIGURED = [make_ext_id(n) for n in range(4)]
+# installed, folder only, json only
+UNLISTED = [make_ext_id(n) for n in range(4, 7)]
+
+
+def add_files(config_struct, ext_ids, json=True, folder=True):
+    """Create the JSON file and a folder with an extension file for each of
+    ext_ids."""
+    for ext_id in ext_ids:
+        if json:
+            with open(os.path.join(config_struct.json_dir,
+                                   ext_id + '.json'), 'w') as json_file:
+                json_file.write('{}')
+        if folder:
+            ext_path = os.path.join(config_struct.ext_dir, ext_id)
+            os.mkdir(ext_path)
+            open(os.path.join(ext_path, 'extension_1_0.crx'), 'w').close()
+
+
+@pytest.fixture
+def config_struct(tmpdir):
+    config_struct = make_config_struct(tmpdir, CONFIGURED)
+    add_files(config_struct, [CONFIGURED[0], UNLISTED[0]])
+    add_files(config_struct, [CONFIGURED[2], UNLISTED[2]], folder=False)
+    add_files(config_struct, [UNLISTED[1]], json=False)
+    os.mkdir(os.path.join(config_struct.ext_dir, CONFIGURED[3]))
+    # files that don't belong to any extension
+    os.mkdir(os.path.join(config_struct.ext_dir, 'not an extension'))
+    open(os.path.join(config_struct.json_dir, 'notes.txt'), 'w').close()
+    return config_struct
+
+
+def ids(ext_refs):
+    return [ext_ref.idstr for ext_ref in ext_refs]
+
+
+def test_plan(config_struct):
+    plan = maninex.make_plan(config_struct)
+    assert ids(plan.install) == CONFIGURED[1:]
+    assert ids(plan.update) == CONFIGURED[:1]
+    assert plan.orphaned_folders == UNLISTED[:2]
+    assert plan.orphaned_jsons == [UNLISTED[0], UNLISTED[2]]
+    assert plan.dangling_jsons == [CONFIGURED[2], UNLISTED[2]]
+
+
+def test_plan_from_index(config_struct):
+    index = maninex.StateIndex(config_struct)
+    for ext_id in CONFIGURED[:2] + UNLISTED[:1]:
+        index.record(ext_id, None)
+    plan = maninex.make_plan(config_struct, index, scan=False)
+    assert ids(plan.install) == CONFIGURED[1:]
+    assert ids(plan.update) == CONFIGURED[:1]
+    assert plan.orphaned_folders is None
+    # entries of extensions whose files are gone are dropped
+    assert sorted(index.entries) == [CONFIGURED[0], UNLISTED[0]]
+    # the directories are still read for the other lists
+    plan = maninex.make_plan(config_struct, index)
+    assert plan.orphaned_folders == UNLISTED[:2]
+    assert plan.dangling_jsons == [CONFIGURED[2], UNLISTED[2]]
+
+
+@pytest.mark.parametrize('option', ['--plan', '--dry-run'])
+def test_plan_mode(config_struct, monkeypatch, capsys, option):
+    monkeypatch.setenv('XDG_CONFIG_HOME', os.path.dirname(
+        config_struct.config_file))
+    before = sorted(os.listdir(config_struct.ext_dir))
+    maninex.main([option])
+    names = [ext_id[:11] for ext_id in CONFIGURED]
+    expected = [('To install (3):', names[1:]),
+                ('To check for updates (1):', names[:1]),
+                ('Folders to remove (2):', UNLISTED[:2]),
+                ('JSON files to remove (2):', [UNLISTED[0] + '.json',
+                                               UNLISTED[2] + '.json']),
+                ('JSON files without a folder (2):',
+                 [CONFIGURED[2] + '.json', UNLISTED[2] + '.json'])]
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == [line for title, items in expected
+                     for line in [title] + ['    ' + item for item in items]]
+    # nothing changes, not even the index is written
+    assert sorted(os.listdir(config_struct.ext_dir)) == before
+
+
+def test_nothing_to_do(tmpdir):
+    config_struct = make_config_struct(tmpdir, [])
+    assert maninex.format_plan(maninex.make_plan(config_struct)) == [
+        'Nothing to do.']
+
+
+def time_plan(tmpdir, count):
+    """Return how long planning takes with count extensions in the config
+    file, half of them installed and as many unlisted ones installed."""
+    config_struct = make_config_struct(
+        tmpdir, [make_ext_id(n) for n in range(count)])
+    add_files(config_struct, [make_ext_id(n)
+                              for n in range(count // 2, count * 3 // 2)])
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        plan = maninex.make_plan(config_struct)
+        times.append(time.perf_counter() - start)
+    assert len(plan.install) == len(plan.orphaned_folders) == count // 2
+    return min(times)
+
+
+def test_plan_scales_linearly(tmpdir):
+    """Ten times as many extensions should take about ten times as long,
+    not a hundred times as long as with lists."""
+    small = time_plan(tmpdir.mkdir('small'), 1000)
+    large = time_plan(tmpdir.mkdir('large'), 10000)
+    assert large < 30 * small
@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex, Manager
+
+EXT_IDS = [make_ext_id(n) for n in range(4)]
+RATE = 200 * 1024
+CRX_SIZE = 150 * 1024
+
+
+@pytest.fixture
+def config_struct(tmpdir, stub_server):
+    stub_server.crx_size = CRX_SIZE
+    for ext_id in EXT_IDS:
+        stub_server.extensions[ext_id] = '1.0'
+    return make_config_struct(tmpdir, EXT_IDS,
+                              {'update_url': stub_server.update_url})
+
+
+def min_seconds(size, rate):
+    """Return how long receiving size bytes takes at least with a RateLimit
+    of rate bytes per second: the burst and the last chunk, which overdraws
+    the bucket, go through without waiting."""
+    return (size - rate - maninex.CHUNK_SIZE) / rate
+
+
+def test_rate_limit():
+    limit = maninex.RateLimit(100000, burst=10000)
+    start = time.monotonic()
+    for _ in range(6):
+        limit.take(10000)
+    # the burst and the last take are free
+    assert time.monotonic() - start >= 0.38
+
+
+def test_fewest_bytes_left_go_first():
+    limit = maninex.RateLimit(100000, burst=1)
+    limit.take(20000)
+    order = []
+
+    def take(name, left):
+        limit.take(1000, left)
+        order.append(name)
+
+    big = threading.Thread(target=take, args=('big', 10 ** 6))
+    big.start()
+    # the big download waits before the small one arrives
+    time.sleep(0.05)
+    small = threading.Thread(target=take, args=('small', 10))
+    small.start()
+    big.join()
+    small.join()
+    assert order == ['small', 'big']
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_max_rate(config_struct, stub_server, engine):
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+    with Manager(config_struct, jobs=4, engine=engine,
+                 max_rate=RATE) as manager:
+        start = time.monotonic()
+        results = manager.install()
+        elapsed = time.monotonic() - start
+    assert [result.status for result in results] == ['installed'] * 4
+    total = sum(result.stats.bytes for result in results)
+    assert total == stub_server.bytes_sent
+    # the downloads share the limit instead of getting it each
+    assert elapsed >= min_seconds(total, RATE)
+    # but still use most of it
+    assert (total - RATE) / elapsed > RATE / 4
+
+
+def test_max_rate_setting(config_struct, stub_server):
+    config_struct.config['settings']['max_rate'] = '200K'
+    start = time.monotonic()
+    list(maninex.install_extensions(config_struct, 4))
+    assert time.monotonic() - start >= min_seconds(4 * CRX_SIZE, RATE)
+
+
+def test_max_download_rate(config_struct, stub_server):
+    """Each download is held to max_download_rate on its own."""
+    config_struct.config['settings']['max_download_rate'] = '50K'
+    start = time.monotonic()
+    with Manager(config_struct, jobs=4) as manager:
+        results = manager.install()
+    elapsed = time.monotonic() - start
+    assert all(result.stats.elapsed >= min_seconds(CRX_SIZE, 50 * 1024)
+               for result in results)
+    # in parallel
+    assert elapsed < 4 * min_seconds(CRX_SIZE, 50 * 1024)
+
+
+def test_small_extensions_finish_first(config_struct, stub_server):
+    stub_server.sizes[EXT_IDS[0]] = 4 * CRX_SIZE
+    for ext_id in EXT_IDS[1:]:
+        stub_server.sizes[ext_id] = CRX_SIZE // 4
+    with Manager(config_struct, jobs=4, max_rate=RATE) as manager:
+        results = manager.install()
+    big = results[0].stats.elapsed
+    # the small ones don't wait for their share of the big one's chunks
+    assert all(result.stats.elapsed < big / 2 for result in results[1:])
+
+
+@pytest.mark.parametrize('value, rate', [('100', 100), ('1.5K', 1536),
+                                         ('2m', 2 * 1024 ** 2), ('0', 0)])
+def test_parse_rate(value, rate):
+    assert maninex.parse_rate(value) == rate
+
+
+def test_bad_rates(config_struct, monkeypatch, capsys):
+    with pytest.raises(ValueError):
+        maninex.parse_rate('2 MB')
+    config_struct.config['settings']['max_rate'] = 'fast'
+    with pytest.raises(maninex.ConfigError):
+        maninex.get_rate_setting(config_struct.config, 'max_rate')
+    # the command line takes precedence
+    assert maninex.get_rate_setting(config_struct.config, 'max_rate',
+                                    1000) == 1000
+
+    with pytest.raises(SystemExit):
+        maninex.main(['--update', '--max-rate', 'fast'])
+    maninex.main(['--list', '--max-rate', '1M'])
+    assert capsys.readouterr().out.startswith(
+        '--max-rate and --idle only work with')
+
+
+def test_idle(config_struct, monkeypatch):
+    monkeypatch.setenv('XDG_CONFIG_HOME', os.path.dirname(
+        config_struct.config_file))
+    niceness = []
+    monkeypatch.setattr(os, 'nice', niceness.append)
+    monkeypatch.setattr(maninex, 'IOPRIO_SET', {})
+    maninex.main(['--install', '--idle', '--max-rate', '1M'])
+    assert niceness == [maninex.LOW_PRIORITY_NICENESS]
+    assert os.listdir(config_struct.ext_dir)
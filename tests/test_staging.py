@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex, Manager
+
+EXT_IDS = [make_ext_id(n) for n in range(3)]
+
+
+@pytest.fixture
+def config_struct(tmpdir, stub_server):
+    for ext_id in EXT_IDS:
+        stub_server.extensions[ext_id] = '1.0'
+    return make_config_struct(tmpdir, EXT_IDS,
+                              {'update_url': stub_server.update_url})
+
+
+@pytest.fixture
+def manager(config_struct):
+    with Manager(config_struct) as manager:
+        manager.install()
+        yield manager
+
+
+def statuses(results):
+    return [result.status for result in results]
+
+
+def json_target(config_struct, ext_id):
+    """Return the version and the name of the file the JSON file of ext_id
+    points at."""
+    with open(os.path.join(config_struct.json_dir,
+                           ext_id + '.json')) as json_file:
+        data = json.load(json_file)
+    return (data['external_version'],
+            os.path.basename(data['external_crx']))
+
+
+def test_prefetch_and_activate(config_struct, stub_server, manager):
+    for ext_id in EXT_IDS[:2]:
+        stub_server.extensions[ext_id] = '1.1'
+    assert statuses(manager.prefetch(refresh=True)) == [
+        'staged', 'staged', 'up_to_date']
+    # the browser still sees the old versions
+    for ext_id in EXT_IDS:
+        assert json_target(config_struct, ext_id) == (
+            '1.0', 'extension_1_0.crx')
+        assert os.listdir(os.path.join(config_struct.ext_dir, ext_id)) == [
+            'extension_1_0.crx']
+    assert maninex.get_staged(config_struct.ext_dir) == EXT_IDS[:2]
+    # staged files aren't downloaded again
+    assert statuses(manager.prefetch(refresh=True)) == [
+        'staged', 'staged', 'up_to_date']
+    assert stub_server.hits['crx'] == 5
+
+    stub_server.reset_counters()
+    results = manager.activate()
+    assert not stub_server.hits
+    assert [(result.ext_ref.idstr, result.status, result.version)
+            for result in results] == [(ext_id, 'activated', '1.1')
+                                       for ext_id in EXT_IDS[:2]]
+    for ext_id in EXT_IDS[:2]:
+        assert json_target(config_struct, ext_id) == (
+            '1.1', 'extension_1_1.crx')
+        assert os.listdir(os.path.join(config_struct.ext_dir, ext_id)) == [
+            'extension_1_1.crx']
+    assert [result.version for result in manager.status()] == [
+        '1.1', '1.1', '1.0']
+    assert maninex.get_staged(config_struct.ext_dir) == []
+    assert manager.activate() == []
+
+
+def test_activate_reads_no_files(config_struct, stub_server, manager,
+                                 monkeypatch):
+    """The digests of the replaced files come from the index."""
+    digest = hashlib.sha256(stub_server.crx_content(EXT_IDS[0])).hexdigest()
+    stub_server.extensions[EXT_IDS[0]] = '1.1'
+    manager.prefetch(refresh=True)
+
+    def forbidden(path):
+        raise AssertionError('{} hashed'.format(path))
+    monkeypatch.setattr(maninex, 'hash_file', forbidden)
+    assert statuses(manager.activate()) == ['activated']
+    versions = maninex.Archive(config_struct.ext_dir).versions()
+    assert versions[EXT_IDS[0]][0][1:] == ('extension_1_0.crx', digest)
+
+
+def test_rollback(config_struct, stub_server, manager):
+    old_content = stub_server.crx_content(EXT_IDS[0])
+    stub_server.extensions[EXT_IDS[0]] = '1.1'
+    manager.update(refresh=True)
+    stub_server.reset_counters()
+
+    results = manager.rollback(EXT_IDS[:2])
+    assert [(result.status, result.version) for result in results] == [
+        ('rolled_back', '1.0'), ('nothing_archived', None)]
+    assert not stub_server.hits
+    assert json_target(config_struct, EXT_IDS[0]) == (
+        '1.0', 'extension_1_0.crx')
+    ext_path = os.path.join(config_struct.ext_dir, EXT_IDS[0])
+    with open(os.path.join(ext_path, 'extension_1_0.crx'), 'rb') as crx:
+        assert crx.read() == old_content
+    assert manager.status(EXT_IDS[:1])[0].version == '1.0'
+    # rolling back again undoes the rollback
+    assert manager.rollback(EXT_IDS[:1])[0].version == '1.1'
+    assert os.listdir(ext_path) == ['extension_1_1.crx']
+
+
+def test_stale_staged_updates(config_struct, stub_server, manager):
+    stub_server.extensions[EXT_IDS[0]] = '1.1'
+    manager.prefetch(refresh=True)
+    # a regular update makes the staged one pointless
+    manager.update()
+    assert maninex.get_staged(config_struct.ext_dir) == []
+
+    stub_server.extensions[EXT_IDS[1]] = '1.1'
+    manager.prefetch(EXT_IDS[1:2], refresh=True)
+    manager.remove(EXT_IDS[1:2])
+    assert statuses(manager.activate()) == ['not_installed']
+    assert maninex.get_staged(config_struct.ext_dir) == []
+
+
+def test_modes(config_struct, stub_server, manager, monkeypatch, capsys):
+    monkeypatch.setenv('XDG_CONFIG_HOME', os.path.dirname(
+        config_struct.config_file))
+    niceness = []
+    monkeypatch.setattr(os, 'nice', niceness.append)
+    monkeypatch.setattr(maninex, 'IOPRIO_SET', {})
+    stub_server.extensions[EXT_IDS[0]] = '1.1'
+
+    maninex.main(['--prefetch', '--refresh'])
+    assert niceness == [maninex.LOW_PRIORITY_NICENESS]
+    maninex.main(['--activate'])
+    maninex.main(['--rollback', EXT_IDS[0]])
+    maninex.main(['--rollback', 'foo'])
+    name = EXT_IDS[0][:11]
+    assert capsys.readouterr().out.splitlines()[-4:] == [
+        maninex.MESSAGES['up_to_date'].format(EXT_IDS[2][:11]),
+        maninex.MESSAGES['activated'].format(name),
+        maninex.MESSAGES['rolled_back'].format(name),
+        "'foo' is no extension id"]
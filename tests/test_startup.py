@@ -0,0 +1,72 @@
+import os
+import sys
+import compileall
+import subprocess
+import pytest
+from conftest import make_ext_id, make_config_struct
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules only the modes that go online should need
+NETWORK_MODULES = ['requests', 'urllib3', 'ssl', 'http.client', 'aiohttp']
+# leaves room for slow and busy machines; importing maninex takes about a
+# third of it on a desktop machine
+IMPORT_BUDGET_US = 80000
+
+
+@pytest.fixture(scope='module', autouse=True)
+def bytecode():
+    """Make sure the timings don't include compiling maninex."""
+    compileall.compile_dir(os.path.join(ROOT, 'maninex'), quiet=1)
+
+
+def import_times(tmpdir, *args):
+    """Run maninex with args and return the cumulative import time of every
+    module imported on the way in microseconds."""
+    env = dict(os.environ, XDG_CONFIG_HOME=str(tmpdir), PYTHONPATH=ROOT)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import maninex; maninex.main()'] + list(args),
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize('mode', ['--list', '--clean', '--print-skel',
+                                  '--remove'])
+def test_offline_modes_skip_network_imports(tmpdir, mode):
+    make_config_struct(tmpdir, [make_ext_id(0)],
+                       {'update_url': 'http://127.0.0.1:1/'})
+    times = import_times(tmpdir, mode)
+    assert 'maninex' in times
+    for name in NETWORK_MODULES:
+        assert name not in times
+    assert times['maninex'] < IMPORT_BUDGET_US
+
+
+def test_import_leaves_network_modules_alone():
+    """Importing maninex must not put any network module into sys.modules,
+    not even a placeholder."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.run(
+        [sys.executable, '-c', 'import sys, maninex; print(*sys.modules)'],
+        env=env, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = process.stdout.split()
+    assert 'maninex.maninex' in modules
+    for name in NETWORK_MODULES:
+        assert name not in modules
+
+
+def test_import_ignores_command_line(tmpdir):
+    """Importing maninex shouldn't look at the arguments of the program that
+    imports it."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.run(
+        [sys.executable, '-c', 'import maninex', '--no-such-option'],
+        env=env, stderr=subprocess.PIPE, universal_newlines=True)
+    assert process.returncode == 0, process.stderr
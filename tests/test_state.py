@@ -0,0 +1,135 @@
+import os
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+
+@pytest.fixture
+def config_struct(tmpdir, stub_server, monkeypatch):
+    ext_ids = [make_ext_id(n) for n in range(6)]
+    for ext_id in ext_ids[:-1]:
+        stub_server.extensions[ext_id] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, ext_ids, {'update_url': stub_server.update_url})
+    # let the modes find the config file of config_struct
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir))
+    return config_struct
+
+
+def test_install_records_state(config_struct, stub_server):
+    maninex.install_mode()
+    index = maninex.load_index(config_struct)
+    assert len(index.entries) == 5
+    ext_id = make_ext_id(0)
+    state = index.get(ext_id)
+    assert state.version == '1.0'
+    assert state.filename == 'extension_1_0.crx'
+    assert state.json_path == os.path.join(config_struct.json_dir,
+                                           ext_id + '.json')
+    crx_path = os.path.join(config_struct.ext_dir, ext_id, state.filename)
+    assert maninex.hash_file(crx_path) == (state.size, state.sha256)
+
+    stub_server.extensions[ext_id] = '1.1'
+    maninex.update_mode(refresh=True)
+    state = maninex.load_index(config_struct).get(ext_id)
+    assert state.version == '1.1'
+    assert state.filename == 'extension_1_1.crx'
+
+
+def test_list_reads_only_index(config_struct, monkeypatch, capsys):
+    maninex.install_mode()
+    capsys.readouterr()
+
+    def forbidden(*args, **kwargs):
+        raise AssertionError('directory scanned')
+    monkeypatch.setattr(os, 'listdir', forbidden)
+    monkeypatch.setattr(os, 'scandir', forbidden)
+    maninex.list_mode()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines.count('{}: Installed.'.format(make_ext_id(0)[:11])) == 5
+    assert lines[-1] == '{}: Not installed.'.format(make_ext_id(5)[:11])
+
+
+def test_reindex(config_struct, capsys):
+    maninex.install_mode()
+    before = maninex.load_index(config_struct).entries
+    os.remove(os.path.join(config_struct.ext_dir, maninex.STATE_FILE))
+    # extensions removed behind maninex's back disappear from the index
+    os.remove(os.path.join(config_struct.json_dir, make_ext_id(1) + '.json'))
+
+    maninex.reindex_mode()
+    after = maninex.load_index(config_struct).entries
+    del before[make_ext_id(1)]
+    assert after == before
+    assert capsys.readouterr().out.endswith('Index of 4 extensions rebuilt.\n')
+
+
+def test_read_only_rebuild_hashes_lazily(config_struct, monkeypatch):
+    maninex.install_mode()
+    before = maninex.load_index(config_struct).entries
+    state_path = os.path.join(config_struct.ext_dir, maninex.STATE_FILE)
+    os.remove(state_path)
+    hashed = []
+    hash_file = maninex.hash_file
+    monkeypatch.setattr(maninex, 'hash_file',
+                        lambda path: hashed.append(path) or hash_file(path))
+
+    index = maninex.load_index(config_struct)
+    assert not hashed
+    # the list mode doesn't need any digests
+    maninex.list_mode()
+    assert not hashed
+    ext_id = make_ext_id(0)
+    assert index.get_hashed(ext_id) == before[ext_id]
+    assert len(hashed) == 1
+    # nothing is written by a read-only rebuild
+    assert not os.path.exists(state_path)
+
+
+def test_remove_updates_index(config_struct):
+    maninex.install_mode()
+    del config_struct.config['extensions'][make_ext_id(0)]
+    with open(config_struct.config_file, 'w') as c_file:
+        config_struct.config.write(c_file)
+
+    maninex.remove_mode()
+    assert make_ext_id(0) not in maninex.load_index(config_struct)
+
+
+@pytest.mark.parametrize('mode', ['install', 'update'])
+def test_deleted_by_hand(config_struct, stub_server, mode, capsys):
+    """Install and update notice extensions deleted behind maninex's back,
+    without a --reindex."""
+    maninex.install_mode()
+    ext_id = make_ext_id(0)
+    maninex.rmtree(os.path.join(config_struct.ext_dir, ext_id))
+    os.remove(os.path.join(config_struct.json_dir, ext_id + '.json'))
+    capsys.readouterr()
+
+    if mode == 'install':
+        maninex.install_mode()
+        message = maninex.MESSAGES['installed']
+    else:
+        maninex.update_mode(refresh=True)
+        message = maninex.MESSAGES['not_installed']
+    assert capsys.readouterr().out.splitlines()[0] == message.format(
+        ext_id[:11])
+    assert (ext_id in maninex.load_index(config_struct)) == (
+        mode == 'install')
+
+
+def test_json_is_replaced_atomically(config_struct, monkeypatch):
+    """A JSON file being rewritten is never seen half written."""
+    maninex.install_mode()
+    ext_id = make_ext_id(0)
+    json_path = os.path.join(config_struct.json_dir, ext_id + '.json')
+    with open(json_path) as json_file:
+        before = json_file.read()
+
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(os, 'fsync', fail)
+    with pytest.raises(OSError):
+        maninex.create_json(json_path, '/some/other.crx', '2.0')
+    with open(json_path) as json_file:
+        assert json_file.read() == before
@@ -0,0 +1,82 @@
+import json
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+ENGINES = ['threads', 'asyncio']
+
+
+@pytest.fixture
+def config_struct(tmpdir, stub_server, monkeypatch):
+    monkeypatch.setattr(maninex, 'BACKOFF_BASE', 0)
+    ext_ids = [make_ext_id(n) for n in range(10)]
+    for ext_id in ext_ids[:-1]:
+        stub_server.extensions[ext_id] = '1.0'
+    return make_config_struct(tmpdir, ext_ids,
+                              {'update_url': stub_server.update_url})
+
+
+def collect(function, config_struct, jobs=4):
+    stats = maninex.Stats('install')
+    with maninex.collecting(stats):
+        results = list(function(config_struct, jobs))
+    return stats, results
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_install_stats(config_struct, stub_server, engine):
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+    stub_server.drops = 1
+    stub_server.drop_after = 100
+    install, _ = maninex.get_engine(engine)
+    stats, results = collect(install, config_struct)
+
+    records = {record.ext_ref.idstr: record for record in stats.extensions}
+    assert len(records) == 10
+    crx_size = len(stub_server.crx_content(make_ext_id(0)))
+    for result in results:
+        record = records[result.ext_ref.idstr]
+        assert record.status == result.status
+        assert record.elapsed >= sum(record.phases.values()) * 0.9
+    resumed = [record for record in stats.extensions if record.retries]
+    assert len(resumed) == 1 and resumed[0].status == 'installed'
+    record = records[make_ext_id(0) if resumed[0] is not records[
+        make_ext_id(0)] else make_ext_id(1)]
+    assert record.http_status == 200
+    assert {'resolve', 'transfer', 'write', 'chown'} <= set(record.phases)
+    assert records[make_ext_id(9)].status == 'not_found'
+    assert records[make_ext_id(9)].bytes == 0
+
+    totals = stats.totals()
+    assert totals['statuses'] == {'installed': 9, 'not_found': 1}
+    assert totals['retries'] == 1
+    # the first bytes of the broken off download may arrive twice
+    assert 9 * crx_size <= totals['bytes'] <= 9 * crx_size + 100
+    assert 1 <= totals['peak_concurrency']['extensions'] <= 4
+    assert 1 <= totals['peak_concurrency']['transfers'] <= 4
+
+
+def test_update_check_is_recorded(config_struct):
+    for _ in maninex.install_extensions(config_struct, 4):
+        pass
+    stats, results = collect(maninex.update_extensions, config_struct)
+    assert stats.phases['check'] > 0
+    assert all(record.bytes == 0 for record in stats.extensions)
+    assert 'check' in stats.totals()['phases']
+
+
+def test_report_is_json(config_struct):
+    stats, _ = collect(maninex.install_extensions, config_struct)
+    report = json.loads(json.dumps(stats.report()))
+    assert report['mode'] == 'install'
+    assert len(report['extensions']) == 10
+    assert report['totals']['bytes'] > 0
+    lines = maninex.format_stats(stats)
+    assert len(lines) == 1 + 10 + 3
+
+
+def test_nothing_recorded_without_stats(config_struct):
+    results = list(maninex.install_extensions(config_struct, 4))
+    assert maninex.current_stats.get() is None
+    assert [result.status for result in results].count('installed') == 9
@@ -0,0 +1,93 @@
+import os
+import threading
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+
+@pytest.fixture
+def profiles(tmpdir, stub_server, monkeypatch):
+    ext_ids = [make_ext_id(n) for n in range(4)]
+    for ext_id in ext_ids:
+        stub_server.extensions[ext_id] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, ext_ids, {'update_url': stub_server.update_url,
+                          'store_dir': str(tmpdir.join('store'))})
+    config = config_struct.config
+    config['directories:second'] = {
+        'json_dir': str(tmpdir.mkdir('json2')),
+        'extension_dir': str(tmpdir.mkdir('ext2'))}
+    with open(config_struct.config_file, 'w') as c_file:
+        config.write(c_file)
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir))
+    return maninex.get_profiles()
+
+
+def crx_path(config_struct, ext_id, filename='extension_1_0.crx'):
+    return os.path.join(config_struct.ext_dir, ext_id, filename)
+
+
+def test_get_profiles(profiles):
+    assert [p.profile for p in profiles] == ['default', 'second']
+    assert profiles[0].ext_dir != profiles[1].ext_dir
+
+
+def test_profiles_share_downloads(profiles, stub_server, capsys):
+    """Every file should be downloaded once and hard linked into all
+    profiles."""
+    maninex.install_mode()
+    out = capsys.readouterr().out
+    assert 'Profile "second":' in out
+    assert stub_server.hits['crx'] == 4
+
+    ext_id = make_ext_id(0)
+    first = os.stat(crx_path(profiles[0], ext_id))
+    second = os.stat(crx_path(profiles[1], ext_id))
+    assert first.st_ino == second.st_ino
+    # the stored file and its links in both profiles
+    assert first.st_nlink == 3
+    for config_struct in profiles:
+        state = maninex.load_index(config_struct).get(ext_id)
+        assert state.version == '1.0'
+
+    stub_server.extensions[ext_id] = '1.1'
+    stub_server.reset_counters()
+    maninex.update_mode(refresh=True)
+    assert stub_server.hits['crx'] == 1
+    for config_struct in profiles:
+        assert maninex.get_local_version(config_struct.ext_dir,
+                                         ext_id) == '1.1'
+
+
+def test_concurrent_fetches_store_once(profiles, stub_server):
+    store = maninex.get_store(profiles[0].config)
+    ext_ref = maninex.ExtRef(name='a', idstr=make_ext_id(1))
+    threads = [threading.Thread(target=maninex.process_extension_install,
+                                args=(config_struct, ext_ref),
+                                kwargs={'store': store})
+               for config_struct in profiles * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert stub_server.hits['crx'] == 1
+    blobs = [name for _, _, files in os.walk(os.path.join(store.path, 'blobs'))
+             for name in files]
+    assert len(blobs) == 1 and blobs[0].endswith('.crx')
+
+
+def test_link_falls_back_to_copy(profiles, monkeypatch):
+    store = maninex.get_store(profiles[0].config)
+
+    def no_link(*args):
+        raise OSError('cross-device link')
+    monkeypatch.setattr(os, 'link', no_link)
+    ext_ref = maninex.ExtRef(name='a', idstr=make_ext_id(2))
+    result = maninex.process_extension_install(profiles[0], ext_ref,
+                                               store=store)
+    assert result.status == 'installed'
+    file_stat = os.stat(crx_path(profiles[0], ext_ref.idstr))
+    assert file_stat.st_nlink == 1
+    file_info = store.lookup(ext_ref.idstr, 'extension_1_0.crx')
+    assert maninex.hash_file(crx_path(profiles[0], ext_ref.idstr)) == file_info
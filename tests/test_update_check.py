@@ -0,0 +1,119 @@
+import os
+import pytest
+from conftest import make_ext_id, make_config_struct
+from maninex import maninex
+
+
+@pytest.fixture
+def config_struct(tmpdir, stub_server):
+    ext_ids = [make_ext_id(n) for n in range(120)]
+    for ext_id in ext_ids[:-1]:
+        stub_server.extensions[ext_id] = '1.0.0'
+    return make_config_struct(tmpdir, ext_ids,
+                              {'update_url': stub_server.update_url})
+
+
+def test_check_updates_batches_requests(config_struct, stub_server):
+    """Versions of 120 extensions should be looked up with three requests."""
+    ext_ids = list(config_struct.config['extensions'])
+    updates = maninex.check_updates(config_struct, ext_ids)
+    assert stub_server.hits['manifest'] == 3
+    assert stub_server.hits['redirect'] == 0
+    assert len(updates) == 120
+    assert updates[ext_ids[-1]] is None
+    for ext_id in ext_ids[:-1]:
+        assert updates[ext_id].version == '1.0.0'
+        assert updates[ext_id].url.endswith('extension_1_0_0.crx')
+
+
+def test_manifest_errors():
+    """Only unknown extensions map to None; other errors and answers without
+    a file count as failed lookups, which are left out."""
+    ext_ids = [make_ext_id(n) for n in range(5)]
+    apps = [
+        '<app appid="{}" status="ok"><updatecheck codebase="http://x/a.crx" '
+        'status="ok" version="1.0"/></app>',
+        '<app appid="{}" status="error-unknownApplication"/>',
+        '<app appid="{}" status="error-internal"/>',
+        '<app appid="{}" status="ok"><updatecheck status="noupdate"/></app>',
+        '<app appid="{}" status="ok"><updatecheck status="error-internal"/>'
+        '</app>']
+    manifest = ('<?xml version="1.0" encoding="UTF-8"?><gupdate xmlns='
+                '"http://www.google.com/update2/response" protocol="2.0">'
+                '{}</gupdate>').format(''.join(
+                    app.format(ext_id) for app, ext_id in zip(apps, ext_ids)))
+    results = maninex.parse_update_manifest(manifest.encode())
+    assert sorted(results) == ext_ids[:2]
+    assert results[ext_ids[0]].version == '1.0'
+    assert results[ext_ids[1]] is None
+
+
+def test_update_downloads_only_outdated(config_struct, stub_server):
+    """Only extensions with a new version online should be downloaded."""
+    ext_refs = list(maninex.get_exts_from_config(config_struct.config))[:4]
+    for ext_ref in ext_refs:
+        maninex.process_extension_install(config_struct, ext_ref)
+    stub_server.extensions[ext_refs[0].idstr] = '1.1'
+    stub_server.reset_counters()
+
+    dir_list = maninex.get_existing_folders(config_struct.ext_dir)
+    updates = maninex.check_updates(config_struct,
+                                    [ext_ref.idstr for ext_ref in ext_refs])
+    statuses = [maninex.process_extension_update(config_struct, ext_ref,
+                                                 dir_list, updates).status
+                for ext_ref in ext_refs]
+
+    assert stub_server.hits == {'manifest': 1, 'crx': 1}
+    assert statuses == ['updated'] + ['up_to_date'] * 3
+    assert maninex.get_local_version(config_struct.ext_dir,
+                                     ext_refs[0].idstr) == '1.1'
+    files = os.listdir(os.path.join(config_struct.ext_dir, ext_refs[0].idstr))
+    assert files == ['extension_1_1.crx']
+    versions = maninex.Archive(config_struct.ext_dir).versions()
+    assert [entry[1] for entry in versions[ext_refs[0].idstr]] == [
+        'extension_1_0_0.crx']
+
+
+def test_same_version():
+    assert maninex.same_version('1.2.0.0', '1.2')
+    assert maninex.same_version('1.02', '1.2')
+    assert not maninex.same_version('1.2.1', '1.2')
+    assert not maninex.same_version('1.2', None)
+
+
+def test_up_to_date_check_downloads_nothing(config_struct, stub_server):
+    """Checking extensions one by one shouldn't transfer the CRX files of
+    extensions that are already up-to-date."""
+    ext_ref = next(maninex.get_exts_from_config(config_struct.config))
+    maninex.process_extension_install(config_struct, ext_ref)
+    assert stub_server.bytes_sent > 0
+    stub_server.reset_counters()
+
+    dir_list = maninex.get_existing_folders(config_struct.ext_dir)
+    maninex.process_extension_update(config_struct, ext_ref, dir_list)
+    assert stub_server.hits == {'redirect_head': 1, 'crx_head': 1}
+    assert stub_server.bytes_sent == 0
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_vanished_without_update_check(config_struct, stub_server,
+                                       monkeypatch, engine):
+    """Extensions that are gone from the update service are reported as
+    such when the batched check failed, rather than as failed downloads."""
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+        from maninex import aio
+
+        async def no_updates(*args):
+            return {}
+        monkeypatch.setattr(aio, 'check_updates', no_updates)
+    monkeypatch.setattr(maninex, 'check_updates', lambda *args: {})
+    ext_ref = next(maninex.get_exts_from_config(config_struct.config))
+    maninex.process_extension_install(config_struct, ext_ref)
+    del stub_server.extensions[ext_ref.idstr]
+
+    update = maninex.get_engine(engine)[1]
+    results = list(update(config_struct, 4, ext_refs=[ext_ref]))
+    assert [result.status for result in results] == ['not_found']
+    assert os.listdir(os.path.join(config_struct.ext_dir, ext_ref.idstr)) == [
+        'extension_1_0_0.crx']
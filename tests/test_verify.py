@@ -0,0 +1,131 @@
+import os
+import struct
+import hashlib
+import pytest
+from conftest import make_ext_id, make_config_struct
+from stub_server import make_crx, make_crx_header
+from maninex import maninex
+
+EXT_ID = make_ext_id(7)
+
+
+def verify(content, ext_id=EXT_ID, expected=None, chunk_size=1000):
+    """Feed content to a CrxVerifier in chunks of chunk_size bytes."""
+    verifier = maninex.CrxVerifier(ext_id, expected)
+    for start in range(0, len(content), chunk_size):
+        verifier.update(content[start:start + chunk_size])
+    verifier.finish(maninex.FileInfo(
+        size=len(content), sha256=hashlib.sha256(content).hexdigest()))
+
+
+def make_crx2(key, archive):
+    signature = b'signature'
+    return (b'Cr24' + struct.pack('<III', 2, len(key), len(signature)) +
+            key + signature + archive)
+
+
+def get_archive(content):
+    return content[content.index(b'PK\x03\x04'):]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000, maninex.CHUNK_SIZE])
+def test_intact_file_passes(chunk_size):
+    content = make_crx(EXT_ID, '1.0', 3 * maninex.CHUNK_SIZE)
+    verify(content, chunk_size=chunk_size,
+           expected=maninex.FileInfo(
+               size=len(content),
+               sha256=hashlib.sha256(content).hexdigest().upper()))
+
+
+def test_crx2_id_comes_from_key():
+    key = b'public key'
+    ext_id = maninex.get_ext_id(hashlib.sha256(key).digest()[:16])
+    archive = get_archive(make_crx(EXT_ID, '1.0'))
+    verify(make_crx2(key, archive), ext_id)
+    with pytest.raises(maninex.VerificationError, match='another extension'):
+        verify(make_crx2(key, archive), EXT_ID)
+
+
+def test_reset_starts_over():
+    content = make_crx(EXT_ID, '1.0')
+    verifier = maninex.CrxVerifier(EXT_ID)
+    verifier.update(b'garbage that is no CRX file'[:3])
+    verifier.reset()
+    verifier.update(content)
+    verifier.finish(maninex.FileInfo(size=len(content), sha256=None))
+
+
+def corrupt(content, position, replacement):
+    return content[:position] + replacement + content[position +
+                                                      len(replacement):]
+
+
+CONTENT = make_crx(EXT_ID, '1.0')
+HEADER_SIZE = 12 + len(make_crx_header(EXT_ID))
+
+
+@pytest.mark.parametrize('content, message', [
+    (b'', 'incomplete CRX header'),
+    (b'PK\x03\x04' + CONTENT[4:], 'not a CRX file'),
+    (corrupt(CONTENT, 4, struct.pack('<I', 4)), 'unsupported CRX version'),
+    (CONTENT[:HEADER_SIZE - 1], 'incomplete CRX header'),
+    (b'Cr24' + struct.pack('<II', 3, 0) + CONTENT[HEADER_SIZE:],
+     'unsigned CRX file'),
+    (corrupt(CONTENT, 8, struct.pack('<I', 2 ** 30)), 'header too large'),
+    (make_crx(make_ext_id(8), '1.0'), 'another extension'),
+    (CONTENT[:HEADER_SIZE] + b'\0' * 100, 'no zip archive'),
+    (CONTENT[:-10], 'truncated'),
+    (CONTENT[:len(CONTENT) // 2] + CONTENT[len(CONTENT) // 2 + 10:],
+     'damaged'),
+], ids=['empty', 'magic', 'version', 'short_header', 'unsigned',
+        'large_header', 'other_id', 'no_zip', 'truncated', 'damaged'])
+def test_damaged_files_are_rejected(content, message):
+    with pytest.raises(maninex.VerificationError, match=message):
+        verify(content)
+
+
+def test_expected_digest_and_size():
+    with pytest.raises(maninex.VerificationError, match='size'):
+        verify(CONTENT, expected=maninex.FileInfo(size=1, sha256=None))
+    with pytest.raises(maninex.VerificationError, match='digest'):
+        verify(CONTENT, expected=maninex.FileInfo(size=None, sha256='0' * 64))
+
+
+def test_manifest_announces_digest(tmpdir, stub_server):
+    stub_server.extensions[EXT_ID] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, [EXT_ID], {'update_url': stub_server.update_url})
+    update_info = maninex.check_updates(config_struct, [EXT_ID])[EXT_ID]
+    content = stub_server.crx_content(EXT_ID)
+    assert update_info.sha256 == hashlib.sha256(content).hexdigest()
+    assert update_info.size == len(content)
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_damaged_update_is_rejected(tmpdir, stub_server, engine):
+    """A download that doesn't match the digest announced by the update
+    service should fail and leave the installed version alone."""
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+    ext_id = make_ext_id(0)
+    stub_server.extensions[ext_id] = '1.0'
+    config_struct = make_config_struct(
+        tmpdir, [ext_id], {'update_url': stub_server.update_url})
+    install, update = maninex.get_engine(engine)
+    with maninex.StateIndex(config_struct).transaction() as index:
+        assert [r.status for r in install(config_struct, 2, index)] == [
+            'installed']
+
+    stub_server.extensions[ext_id] = '1.1'
+    stub_server.corrupt.add(ext_id)
+    with maninex.StateIndex(config_struct).transaction() as index:
+        results = list(update(config_struct, 2, index))
+    assert results[0].status == 'failed'
+    assert isinstance(results[0].error, maninex.VerificationError)
+
+    ext_path = os.path.join(config_struct.ext_dir, ext_id)
+    assert os.listdir(ext_path) == ['extension_1_0.crx']
+    state = maninex.load_index(config_struct).get(ext_id)
+    assert state.version == '1.0'
+    assert state.sha256 == maninex.hash_file(
+        os.path.join(ext_path, 'extension_1_0.crx')).sha256